@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Assembles the benchmark programs into hex images (run_bench.py)
+#
+#==========================================================================
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from isa import *
+
+
+#--------------------------------------------------------------------------
+#   Asm: a two-pass assembler for straight TSC code with labels
+#--------------------------------------------------------------------------
+#
+#   Instructions are written as calls, e.g. a.ADI(0, 0, -1) for
+#   "ADI $0, $0, -1" or a.BGZ(0, 'loop'). Operands follow the order of
+#   the disassembly: rd, rs, rt for R-type, rt, rs, imm for I-type
+#   (LWD/SWD: rt, imm, rs), rs, rt, target for branches.
+
+R_FUNCT = { 'ADD': ADD, 'SUB': SUB, 'AND': AND, 'ORR': ORR }
+R_UNARY = { 'NOT': NOT, 'TCP': TCP, 'SHL': SHL, 'SHR': SHR }
+
+class Asm(object):
+
+    def __init__(self):
+        self.words  = []        # instruction words, or (opcode, rs, rt, label) for branches/jumps
+        self.labels = {}
+
+    def label(self, name):
+        self.labels[name] = len(self.words)
+
+    def emit(self, word):
+        self.words.append(int(word))
+
+    def __getattr__(self, name):
+        if name in R_FUNCT:
+            return lambda rd, rs, rt: self.emit(R_FUNCT[name] | rs << 10 | rt << 8 | rd << 6)
+        if name in R_UNARY:
+            return lambda rd, rs: self.emit(R_UNARY[name] | rs << 10 | rd << 6)
+        raise AttributeError(name)
+
+    def ADI(self, rt, rs, imm):
+        assert -128 <= imm < 128
+        self.emit(ADI | rs << 10 | rt << 8 | (imm & 0xff))
+
+    def ORI(self, rt, rs, imm):
+        assert 0 <= imm < 256
+        self.emit(ORI | rs << 10 | rt << 8 | imm)
+
+    def LHI(self, rt, imm):
+        assert 0 <= imm < 256
+        self.emit(LHI | rt << 8 | imm)
+
+    def LWD(self, rt, imm, rs):
+        assert -128 <= imm < 128
+        self.emit(LWD | rs << 10 | rt << 8 | (imm & 0xff))
+
+    def SWD(self, rt, imm, rs):
+        assert -128 <= imm < 128
+        self.emit(SWD | rs << 10 | rt << 8 | (imm & 0xff))
+
+    def LI(self, rt, value):
+        self.LHI(rt, value >> 8)
+        self.ORI(rt, rt, value & 0xff)
+
+    def BNE(self, rs, rt, target):  self.words.append((BNE, rs, rt, target))
+    def BEQ(self, rs, rt, target):  self.words.append((BEQ, rs, rt, target))
+    def BGZ(self, rs, target):      self.words.append((BGZ, rs, 0, target))
+    def BLZ(self, rs, target):      self.words.append((BLZ, rs, 0, target))
+    def JMP(self, target):          self.words.append((JMP, 0, 0, target))
+    def JAL(self, target):          self.words.append((JAL, 0, 0, target))
+
+    def JPR(self, rs):              self.emit(JPR | rs << 10)
+    def JRL(self, rs):              self.emit(JRL | rs << 10)
+    def HLT(self):                  self.emit(HLT)
+
+    def assemble(self):
+        """
+        returns the image as big-endian words, the format of run_tsc.py --hex
+        """
+        image = bytearray()
+        for (pc, w) in enumerate(self.words):
+            if isinstance(w, tuple):
+                (opcode, rs, rt, target) = w
+                addr = self.labels[target]
+                if opcode in (JMP, JAL):
+                    assert addr >> 12 == pc >> 12
+                    w = opcode | (addr & 0xfff)
+                else:
+                    offset = addr - (pc + 1)
+                    assert -128 <= offset < 128, target
+                    w = opcode | rs << 10 | rt << 8 | (offset & 0xff)
+            image += int(w).to_bytes(2, 'big')
+        return bytes(image)
+
+
+#--------------------------------------------------------------------------
+#   Benchmarks
+#--------------------------------------------------------------------------
+
+def alu_loop():
+    """
+    tight loop of ALU instructions: 20000 iterations of 10 instructions
+    """
+    a = Asm()
+    a.LI(0, 20000)
+    a.LI(1, 0x1234)
+    a.LI(2, 0x0f0f)
+    a.label('loop')
+    a.ADD(3, 1, 2)
+    a.SUB(1, 3, 0)
+    a.AND(2, 1, 3)
+    a.ORR(3, 3, 2)
+    a.SHL(1, 3)
+    a.SHR(2, 1)
+    a.NOT(3, 2)
+    a.ADI(1, 1, 77)
+    a.ADI(0, 0, -1)
+    a.BGZ(0, 'loop')
+    a.SWD(1, 0, 0)
+    a.HLT()
+    return a
+
+
+def mem_copy():
+    """
+    fills 4096 words at 0x1000, then copies them to 0x2000 16 times,
+    4 words per iteration
+    """
+    a = Asm()
+    a.LHI(0, 0x10)                  # fill: word i = i * 3
+    a.LI(3, 4096)
+    a.ORI(1, 1, 0)
+    a.label('fill')
+    a.SWD(1, 0, 0)
+    a.ADI(1, 1, 3)
+    a.ADI(0, 0, 1)
+    a.ADI(3, 3, -1)
+    a.BGZ(3, 'fill')
+
+    a.LHI(0, 0x10)                  # repeat count, kept at 0x0fff
+    a.ADI(1, 3, 16)
+    a.SWD(1, -1, 0)
+    a.label('again')
+    a.LHI(0, 0x10)
+    a.LHI(1, 0x20)
+    a.LI(3, 1024)
+    a.label('copy')
+    for k in range(4):
+        a.LWD(2, k, 0)
+        a.SWD(2, k, 1)
+    a.ADI(0, 0, 4)
+    a.ADI(1, 1, 4)
+    a.ADI(3, 3, -1)
+    a.BGZ(3, 'copy')
+    a.LHI(0, 0x10)
+    a.LWD(1, -1, 0)
+    a.ADI(1, 1, -1)
+    a.SWD(1, -1, 0)
+    a.BGZ(1, 'again')
+    a.HLT()
+    return a
+
+
+def fib_rec():
+    """
+    recursive fib(19) through JAL/JPR, with a stack of 3-word frames at 0x4000.
+    main calls fib with JRL and stores the result (4181) at 0x0fff.
+    """
+    a = Asm()
+    a.LHI(3, 0x40)                  # sp
+    a.ORI(0, 0, 19)                 # n
+    a.LI(1, 0)
+    a.label('fib_addr')
+    a.ADI(1, 1, 0)                  # patched below: r1 = address of fib
+    a.JRL(1)
+    a.LHI(0, 0x10)
+    a.SWD(1, -1, 0)
+    a.HLT()
+
+    a.label('fib')                  # r1 = fib(r0), r2: return address, r3: sp
+    a.ADI(1, 0, -2)
+    a.BLZ(1, 'leaf')
+    a.SWD(2, 0, 3)                  # frame: return address, n, fib(n - 1)
+    a.SWD(0, 1, 3)
+    a.ADI(3, 3, 3)
+    a.ADI(0, 0, -1)
+    a.JAL('fib')
+    a.SWD(1, -1, 3)
+    a.LWD(0, -2, 3)
+    a.ADI(0, 0, -2)
+    a.JAL('fib')
+    a.LWD(0, -1, 3)
+    a.ADD(1, 1, 0)
+    a.ADI(3, 3, -3)
+    a.LWD(2, 0, 3)
+    a.JPR(2)
+    a.label('leaf')
+    a.ORI(1, 0, 0)
+    a.JPR(2)
+
+    a.words[a.labels['fib_addr']] = int(ADI | 1 << 10 | 1 << 8 | a.labels['fib'])
+    return a
+
+
+def bubble_sort():
+    """
+    bubble sort of 160 pseudo-random words at 0x1000, from an LCG
+    (x = 5x + 59) scaled down to [-8192, 8191] so that SUB never overflows
+    """
+    N = 160
+    a = Asm()
+    a.LHI(0, 0x10)
+    a.ORI(3, 3, N)
+    a.ORI(1, 1, 1)
+    a.label('gen')
+    a.SHL(2, 1)
+    a.SHL(2, 2)
+    a.ADD(1, 1, 2)
+    a.ADI(1, 1, 59)
+    a.SHR(2, 1)
+    a.SHR(2, 2)
+    a.SWD(2, 0, 0)
+    a.ADI(0, 0, 1)
+    a.ADI(3, 3, -1)
+    a.BGZ(3, 'gen')
+
+    a.ADI(3, 0, -1)                 # r3: address of the last word to compare
+    a.label('pass')
+    a.LHI(0, 0x10)
+    a.label('inner')
+    a.LWD(1, 0, 0)
+    a.LWD(2, 1, 0)
+    a.SUB(2, 2, 1)
+    a.BLZ(2, 'swap')
+    a.label('next')
+    a.ADI(0, 0, 1)
+    a.SUB(2, 3, 0)
+    a.BGZ(2, 'inner')
+    a.ADI(3, 3, -1)
+    a.LHI(0, 0x10)
+    a.SUB(2, 3, 0)
+    a.BGZ(2, 'pass')
+    a.HLT()
+    a.label('swap')
+    a.LWD(2, 1, 0)
+    a.SWD(1, 1, 0)
+    a.SWD(2, 0, 0)
+    a.JMP('next')
+    return a
+
+
+BENCHMARKS = {
+    'alu_loop'      : alu_loop,
+    'mem_copy'      : mem_copy,
+    'fib_rec'       : fib_rec,
+    'bubble_sort'   : bubble_sort,
+}
+
+
+if __name__ == '__main__':
+    here = os.path.dirname(os.path.abspath(__file__))
+    for (name, build) in BENCHMARKS.items():
+        image = build().assemble()
+        with open(os.path.join(here, name + '.hex'), 'wb') as f:
+            f.write(image)
+        print("%-12s %4d words" % (name, len(image) // 2))
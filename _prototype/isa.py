@@ -114,6 +114,24 @@ isa         = {
 }
 
 
+#--------------------------------------------------------------------------
+#   Opcode table: opcode of every 16-bit instruction word
+#--------------------------------------------------------------------------
+
+opcode_table    = [ ILLEGAL ] * (1 << BITWIDTH)
+
+# Walk the ISA table backwards so that earlier entries take precedence,
+# which is the same order the masked linear search used to match them.
+for k, v in reversed(isa.items()):
+    free = ~int(v[IN_MASK]) & 0xffff
+    sub = free
+    while True:
+        opcode_table[int(k) | sub] = k
+        if sub == 0:
+            break
+        sub = (sub - 1) & free
+
+
 #--------------------------------------------------------------------------
 #   TSC: decodes TSC instructions
 #--------------------------------------------------------------------------
@@ -127,10 +145,7 @@ class TSC(object):
 
     @staticmethod
     def opcode(inst):
-        for k, v in isa.items():
-            if not (inst & v[IN_MASK]) ^ k:
-                return k
-        return ILLEGAL
+        return opcode_table[inst]
 
     @staticmethod
     def opcode_name(opcode):
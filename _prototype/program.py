@@ -2,7 +2,7 @@
 #
 #   The PyTSC Project
 #
-#   Classes for program loading, disassembling, logging, and run-time stats.
+#   Classes for program loading, disassembling, logging, run-time stats, profiles, and snapshots.
 #
 # + based on: -------------------------------------------------------------
 #   The PyRISC Project
@@ -11,9 +11,24 @@
 #
 #==========================================================================
 
+import cProfile
+import json
+import platform
+import struct
+import sys
+import time
+import tracemalloc
+from array import array
+
+try:
+    import resource
+except ImportError:
+    resource = None                 # not available on Windows
+
 from elftools.elf import elffile as elf
 from isa import *
 from sim_consts import *
+from sim_control import *
 from sim_modules import *
 
 
@@ -36,8 +51,55 @@ ELF_ERR_MSG = {
     ELF_ERR_MACH    : 'File %s is not an TSC executable file',
 }
 
+#--------------------------------------------------------------------------
+#   AsmCache: memoizes disassembled instructions
+#--------------------------------------------------------------------------
+
+class AsmCache(object):
+
+    # Instruction types whose text depends on the pc (branch/jump targets)
+    PC_RELATIVE     = [ J_TYPE, B_TYPE, B_1OPR ]
+
+    def __init__(self):
+        # Both tables are direct-mapped over the 16-bit space, so the cache
+        # never grows beyond 2 x 64K entries.
+        self.insts  = [ None ] * (1 << BITWIDTH)   # inst -> asm
+        self.pcs    = [ None ] * (1 << BITWIDTH)   # pc -> (inst, asm)
+
+    def lookup(self, pc, inst):
+        """
+        returns the cached disassembly of inst at pc, or None
+        """
+        asm = self.insts[inst]
+        if asm is None:
+            entry = self.pcs[pc]
+            if entry is not None and entry[0] == inst:
+                asm = entry[1]
+        return asm
+
+    def add(self, pc, inst, asm):
+        """
+        caches the disassembly of inst at pc
+        """
+        dec = decode_table[inst]
+        if dec is not None and dec[DC_TYPE] in AsmCache.PC_RELATIVE \
+                and inst != BUBBLE and inst != NOP:
+            self.pcs[pc] = (inst, asm)
+        else:
+            self.insts[inst] = asm
+
+    def clear(self):
+        self.insts  = [ None ] * (1 << BITWIDTH)
+        self.pcs    = [ None ] * (1 << BITWIDTH)
+
+
+#--------------------------------------------------------------------------
+#   Program: loads an ELF file into memory and supports disassembling
+#--------------------------------------------------------------------------
+
 class Program(object):
 
+    asmcache        = AsmCache()
 
     def __init__(self):
         pass
@@ -106,6 +168,15 @@ class Program(object):
     @staticmethod
     def disasm(pc, inst):
 
+        asm = Program.asmcache.lookup(pc, inst)
+        if asm is None:
+            asm = Program.disasm_uncached(pc, inst)
+            Program.asmcache.add(pc, inst, asm)
+        return asm
+
+    @staticmethod
+    def disasm_uncached(pc, inst):
+
         if inst == BUBBLE:
             asm = "BUBBLE"
             return asm
@@ -113,47 +184,45 @@ class Program(object):
             asm = "nop"
             return asm
 
-        opcode = TSC.opcode(inst)
-        if opcode == ILLEGAL:
+        dec = decode_table[inst]
+        if dec is None:
             asm = "(illegal)"
-            Program.asmcache.add(pc, asm)
             return asm
 
-        info    = isa[opcode]
-        opname  = TSC.opcode_name(opcode)
-        rs      = TSC.rs(inst)
-        rt      = TSC.rt(inst)
-        rd      = TSC.rd(inst)
-        imm_i   = TSC.imm_i(inst)
-        imm_h   = TSC.imm_h(inst)
-        imm_u   = TSC.imm_u(inst)
-        imm_j   = TSC.imm_j(inst)
-        if info[IN_TYPE] == R_TYPE:
+        opname  = TSC.opcode_name(dec[DC_OPCODE])
+        itype   = dec[DC_TYPE]
+        rs      = dec[DC_RS]
+        rt      = dec[DC_RT]
+        rd      = dec[DC_RD]
+        imm_i   = dec[DC_IMM_I]
+        imm_s   = dec[DC_IMM_S]
+        imm_j   = dec[DC_IMM_J]
+        if itype == R_TYPE:
             asm = "%-7s %s, %s, %s" % (opname, rname[rd], rname[rs], rname[rt])
-        elif info[IN_TYPE] == R_JUMP:
+        elif itype == R_JUMP:
             asm = "%-7s %s" % (opname, rname[rs])
-        elif info[IN_TYPE] == R_MISC:
+        elif itype == R_MISC:
             asm = "%-7s" % (opname)
-        elif info[IN_TYPE] == R_1OSD:
+        elif itype == R_1OSD:
             asm = "%-7s %s, %s" % (opname, rname[rd], rname[rs])
-        elif info[IN_TYPE] == R_1OPS:
+        elif itype == R_1OPS:
             asm = "%-7s %s" % (opname, rname[rs])
-        elif info[IN_TYPE] == R_1OPD:
+        elif itype == R_1OPD:
             asm = "%-7s %s" % (opname, rname[rd])
-        elif info[IN_TYPE] == J_TYPE:
+        elif itype == J_TYPE:
             asm = "%-7s 0x%04x" % (opname, (pc & 0xf000) | imm_j)
-        elif info[IN_TYPE] == I_ZEXT:
-            asm = "%-7s %s, %s, %d" % (opname, rname[rt], rname[rs], WORD(imm_i))
-        elif info[IN_TYPE] == I_TYPE:
-            asm = "%-7s %s, %s, %d" % (opname, rname[rt], rname[rs], SWORD(imm_i))
-        elif info[IN_TYPE] == I_1OPR:
-            asm = "%-7s %s, 0x%x" % (opname, rname[rt], WORD(imm_i))
-        elif info[IN_TYPE] == B_TYPE:
-            asm = "%-7s %s, %s, 0x%04x" % (opname, rname[rs], rname[rt], pc + 1 + SWORD(imm_i))
-        elif info[IN_TYPE] == B_1OPR:
-            asm = "%-7s %s, 0x%04x" % (opname, rname[rs], pc + 1 + SWORD(imm_i))
-        elif info[IN_TYPE] == X_TYPE:
-            return info[IN_NAME]
+        elif itype == I_ZEXT:
+            asm = "%-7s %s, %s, %d" % (opname, rname[rt], rname[rs], imm_i)
+        elif itype == I_TYPE:
+            asm = "%-7s %s, %s, %d" % (opname, rname[rt], rname[rs], imm_s)
+        elif itype == I_1OPR:
+            asm = "%-7s %s, 0x%x" % (opname, rname[rt], imm_i)
+        elif itype == B_TYPE:
+            asm = "%-7s %s, %s, 0x%04x" % (opname, rname[rs], rname[rt], int(pc) + 1 + imm_s)
+        elif itype == B_1OPR:
+            asm = "%-7s %s, 0x%04x" % (opname, rname[rs], int(pc) + 1 + imm_s)
+        elif itype == X_TYPE:
+            return opname
         else:
             asm = "(unknown)"
 
@@ -167,9 +236,104 @@ class Program(object):
 class Log(object):
 
     MAX_LOG_LEVEL   = 7         # last log level
+    LEVEL           = 4         # default log level
+
+    def __init__(self, level = LEVEL, start_cycle = 0):
+        self.level          = level
+        self.start_cycle    = start_cycle   # instructions are traced from this cycle
+
+
+#--------------------------------------------------------------------------
+#   Trace: buffered sink for instruction traces (log level 3 or higher)
+#--------------------------------------------------------------------------
+
+TRACE_TEXT          = 'text'    # human-readable, same as the console log
+TRACE_JSONL         = 'jsonl'   # one JSON object per instruction
+TRACE_BIN           = 'bin'     # fixed-size binary records
+
+TRACE_FORMATS       = [ TRACE_TEXT, TRACE_JSONL, TRACE_BIN ]
+
+class Trace(object):
+
+    BUFSIZE         = 1 << 20   # write buffer size of trace files
+    MAGIC           = b'TSCTRACE'
+    RECORD          = struct.Struct('>QHHBHH')  # cycle, pc, inst, rd, wbdata, pc_next
+
+    def __init__(self):
+        self.fmt    = TRACE_TEXT
+        self.out    = None      # instruction trace (None: sys.stdout)
+        self.owned  = False     # out is a file opened by the trace
+        self.text   = None      # per-cycle dumps (None: sys.stdout)
+        self.record = self.record_jsonl
+
+    def open(self, filename, fmt = TRACE_TEXT):
+        """
+        send the trace to filename (None: sys.stdout) in the given format.
+        Records mixed with the console output cannot be read back, so
+        jsonl/bin traces need a filename.
+        """
+        if fmt != TRACE_TEXT and not filename:
+            raise ValueError(f"{fmt} traces need a file")
+        if fmt == TRACE_BIN:
+            self.out = open(filename, 'wb', buffering = Trace.BUFSIZE) \
+                       if filename else sys.stdout.buffer
+            self.out.write(Trace.MAGIC)
+            self.record = self.record_bin
+        else:
+            self.out = open(filename, 'w', buffering = Trace.BUFSIZE) \
+                       if filename else sys.stdout
+            self.record = self.record_jsonl
+        # Register and memory dumps are text: keep them out of record files
+        self.text = self.out if fmt == TRACE_TEXT else None
+        self.fmt = fmt
+        self.owned = bool(filename)
+
+    def close(self):
+        if self.out is None:
+            return
+        if self.owned:
+            self.out.close()
+        else:
+            self.out.flush()
+        self.fmt    = TRACE_TEXT
+        self.out    = None
+        self.text   = None
+        self.owned  = False
+
+    def record_jsonl(self, cycle, pc, inst, rd, wbdata, pc_next):
+        self.out.write('{"cycle": %d, "pc": %d, "inst": %d, "rd": %d, "wbdata": %d, "pc_next": %d}\n'
+                       % (cycle, pc, inst, rd, wbdata, pc_next))
 
-    level           = 4         # default log level
-    start_cycle     = 0
+    def record_bin(self, cycle, pc, inst, rd, wbdata, pc_next):
+        self.out.write(Trace.RECORD.pack(cycle, pc, inst, rd, wbdata, pc_next))
+
+    @staticmethod
+    def load(filename):
+        """
+        read back the records of a JSONL or binary trace file
+        """
+        with open(filename, 'rb') as f:
+            if f.read(len(Trace.MAGIC)) == Trace.MAGIC:
+                size = Trace.RECORD.size
+                while True:
+                    data = f.read(size)
+                    if len(data) < size:
+                        return
+                    yield Trace.RECORD.unpack(data)
+            f.seek(0)
+            for line in f:
+                r = json.loads(line)
+                yield (r['cycle'], r['pc'], r['inst'], r['rd'], r['wbdata'], r['pc_next'])
+
+    @staticmethod
+    def format_inst(cycle, pc, inst):
+        return "%5d  0x%04x:  %-24s" % (cycle, pc, Program.disasm(pc, inst))
+
+    @staticmethod
+    def format_full(cycle, pc, inst, rd, wbdata, pc_next):
+        info = "# R[%d] <- 0x%04x, pc_next=0x%04x" % (rd, wbdata, pc_next) if rd else \
+               "# pc_next=0x%04x" % pc_next
+        return "%5d  0x%04x:  %-24s%-s" % (cycle, pc, Program.disasm(pc, inst), info)
 
 
 #--------------------------------------------------------------------------
@@ -178,26 +342,463 @@ class Log(object):
 
 class Stat(object):
 
-    cycle           = 0         # number of CPU cycles
-    icount          = 0         # number of instructions executed
+    # Counters of the sequential machines, which grow by the same amount in
+    # every iteration of a stationary loop
+    LOOP_STATS      = [ 'cycle', 'icount', 'inst_alu', 'inst_mem', 'inst_ctrl',
+                        'cycle_alu', 'cycle_mem', 'cycle_ctrl' ]
+
+    def __init__(self, pipelined = False, multicycle = False):
+        self.pipelined  = pipelined     # shows pipeline hazard stats
+        self.multicycle = multicycle    # shows cycles per instruction class
+        self.reset()
+
+    def reset(self):
+        self.cycle      = 0         # number of CPU cycles
+        self.icount     = 0         # number of instructions executed
+
+        self.inst_alu   = 0         # number of ALU instructions
+        self.inst_mem   = 0         # number of load/store instructions
+        self.inst_ctrl  = 0         # number of control transfer instructions
+
+        self.stalls     = 0         # number of cycles stalled on data hazards
+        self.flushes    = 0         # number of instructions flushed on control hazards
+        self.bp_count   = 0         # number of branches and register jumps predicted
+        self.bp_miss    = 0         # number of mispredictions
+        self.bp_penalty = 0         # number of cycles lost by mispredictions
+
+        self.cycle_alu  = 0         # number of cycles taken by ALU instructions
+        self.cycle_mem  = 0         # number of cycles taken by load/store instructions
+        self.cycle_ctrl = 0         # number of cycles taken by control transfer instructions
+
+    def counters(self):
+        return [ getattr(self, name) for name in Stat.LOOP_STATS ]
+
+    def repeat(self, since, times):
+        """
+        adds the counts made since counters() returned since, times more
+        """
+        for (name, value) in zip(Stat.LOOP_STATS, since):
+            now = getattr(self, name)
+            setattr(self, name, now + (now - value) * times)
+
+    def show(self):
+        print("%d instructions executed in %d cycles. CPI = %.3f" % (self.icount, self.cycle, 0.0 if self.icount == 0 else  self.cycle / self.icount))
+        print("Data transfer:    %d instructions (%.2f%%)" % (self.inst_mem, 0.0 if self.icount == 0 else self.inst_mem * 100.0 / self.icount))
+        print("ALU operation:    %d instructions (%.2f%%)" % (self.inst_alu, 0.0 if self.icount == 0 else self.inst_alu * 100.0 / self.icount))
+        print("Control transfer: %d instructions (%.2f%%)" % (self.inst_ctrl, 0.0 if self.icount == 0 else self.inst_ctrl * 100.0 / self.icount))
+        if self.multicycle:
+            for (name, cycles, count) in [ ("Data transfer:   ", self.cycle_mem, self.inst_mem),
+                                           ("ALU operation:   ", self.cycle_alu, self.inst_alu),
+                                           ("Control transfer:", self.cycle_ctrl, self.inst_ctrl) ]:
+                print("%s %d cycles (%.2f%%), CPI = %.3f" % (name, cycles, 0.0 if self.cycle == 0 else cycles * 100.0 / self.cycle, 0.0 if count == 0 else cycles / count))
+        if self.pipelined:
+            print("Pipeline stalls:  %d cycles (%.2f%%)" % (self.stalls, 0.0 if self.cycle == 0 else self.stalls * 100.0 / self.cycle))
+            print("Pipeline flushes: %d instructions" % (self.flushes))
+            correct = self.bp_count - self.bp_miss
+            print("Branch prediction: %d/%d correct (%.2f%%), %d penalty cycles" % (correct, self.bp_count, 0.0 if self.bp_count == 0 else correct * 100.0 / self.bp_count, self.bp_penalty))
 
-    inst_alu        = 0         # number of ALU instructions
-    inst_mem        = 0         # number of load/store instructions
-    inst_ctrl       = 0         # number of control transfer instructions
+
+#--------------------------------------------------------------------------
+#   HostStat: measures the simulator itself (--host-stats)
+#--------------------------------------------------------------------------
+#
+#   Phases are timed per instruction by engines which run them apart
+#   (Simple, Multi). Fast, DBT and Pipe fuse them, so run_tsc.py does not
+#   allow --host-phases with them.
+
+class HostStat(object):
+
+    VERSION     = 1         # of the summary format
+    PHASES      = [ 'fetch', 'decode', 'execute', 'log' ]
+
+    def __init__(self, phases = False, cprofile = None, trace_malloc = False):
+        self.phases     = dict.fromkeys(HostStat.PHASES, 0) if phases else None    # in ns
+        self.cprofile   = cprofile          # file for the cProfile stats, or None
+        self.trace_malloc = trace_malloc
+        self.wall       = 0.0               # in seconds
+        self.cpu_time   = 0.0
+        self.peak_mem   = None              # peak of the memory traced, in bytes
+        self.top_allocs = []                # [ (size, count, "file:line"), ... ]
+        self.profiler   = None
+
+    def start(self):
+        if self.trace_malloc:
+            tracemalloc.start()
+        if self.cprofile:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.t_wall     = time.perf_counter()
+        self.t_cpu      = time.process_time()
+
+    def stop(self):
+        self.wall      += time.perf_counter() - self.t_wall
+        self.cpu_time  += time.process_time() - self.t_cpu
+        if self.profiler is not None:
+            self.profiler.disable()
+            self.profiler.dump_stats(self.cprofile)
+        if self.trace_malloc:
+            self.peak_mem = tracemalloc.get_traced_memory()[1]
+            stats = tracemalloc.take_snapshot().statistics('lineno')[:10]
+            self.top_allocs = [ (stat.size, stat.count, "%s:%d" % (stat.traceback[0].filename,
+                                stat.traceback[0].lineno)) for stat in stats ]
+            tracemalloc.stop()
+
+    def summary(self, cpu, status, program = None):
+        """
+        returns the measurements of a run as a JSON-serializable dict
+        """
+        stat    = cpu.stat
+        rate    = lambda n: 0.0 if self.wall == 0 else n / self.wall
+        phases  = None
+        if self.phases is not None:
+            phases = { name: ns / 1e9 for (name, ns) in self.phases.items() }
+            phases['other'] = max(0.0, self.wall - sum(phases.values()))
+        return {
+            'version'       : HostStat.VERSION,
+            'time'          : time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'python'        : platform.python_version(),
+            'platform'      : platform.platform(),
+            'machine'       : cpu.NAME,
+            'engine'        : type(cpu.engine).__name__.lower(),
+            'program'       : program,
+            'status'        : EXC_MSG.get(status, str(status)),
+            'instructions'  : stat.icount,
+            'cycles'        : stat.cycle,
+            'wall_s'        : self.wall,
+            'cpu_s'         : self.cpu_time,
+            'ips'           : rate(stat.icount),
+            'cps'           : rate(stat.cycle),
+            'phases_s'      : phases,
+            'max_rss_kb'    : None if resource is None else resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'peak_traced_bytes' : self.peak_mem,
+            'cprofile'      : self.cprofile,
+        }
 
     @staticmethod
-    def reset():
-        Stat.cycle      = 0
-        Stat.icount     = 0
-        Stat.inst_alu   = 0
-        Stat.inst_mem   = 0
-        Stat.inst_ctrl  = 0
+    def show(summary):
+        print("Host: %.3f s wall, %.3f s CPU, %.0f instructions/s, %.0f cycles/s" %
+              (summary['wall_s'], summary['cpu_s'], summary['ips'], summary['cps']))
+        if summary['phases_s'] is not None:
+            wall = summary['wall_s'] or 1.0
+            print("Host phases: " + ", ".join("%s %.3f s (%.1f%%)" % (name, t, t * 100.0 / wall)
+                                              for (name, t) in summary['phases_s'].items()))
+        if summary['peak_traced_bytes'] is not None:
+            print("Host memory: %d bytes at peak (traced)" % summary['peak_traced_bytes'])
+
+    def show_allocs(self, out = None):
+        for (size, count, where) in self.top_allocs:
+            print("  %10d bytes  %8d blocks  %s" % (size, count, where), file = out)
 
     @staticmethod
-    def show():
-        print("%d instructions executed in %d cycles. CPI = %.3f" % (Stat.icount, Stat.cycle, 0.0 if Stat.icount == 0 else  Stat.cycle / Stat.icount))
-        print("Data transfer:    %d instructions (%.2f%%)" % (Stat.inst_mem, 0.0 if Stat.icount == 0 else Stat.inst_mem * 100.0 / Stat.icount))
-        print("ALU operation:    %d instructions (%.2f%%)" % (Stat.inst_alu, 0.0 if Stat.icount == 0 else Stat.inst_alu * 100.0 / Stat.icount))
-        print("Control transfer: %d instructions (%.2f%%)" % (Stat.inst_ctrl, 0.0 if Stat.icount == 0 else Stat.inst_ctrl * 100.0 / Stat.icount))
+    def append(summary, filename):
+        """
+        appends summary to filename as a line of JSON
+        """
+        with open(filename, 'a') as f:
+            f.write(json.dumps(summary) + "\n")
 
 
+#--------------------------------------------------------------------------
+#   Profile: per-PC execution counts and cycle attribution (--profile)
+#--------------------------------------------------------------------------
+#
+#   Engines count every instruction they execute (or retire) in count[] and
+#   opcodes[], and every taken control transfer in taken[], or in indirect
+#   with its target for JPR/JRL. Each instruction is charged the cycles
+#   until the next one starts (or retires), so stalls and flushes go to the
+#   instruction which caused them. Only the cycles beyond the first are
+#   kept, in stalls[], so a single-cycle run without caches has no cycles
+#   to count at all. Basic blocks, branch outcomes and the call graph are
+#   derived from these counters when the report is made, from the code in
+#   memory at that time.
+
+class Profile(object):
+
+    OPCODES     = list(isa.keys())
+    OPID        = None      # instruction word -> index into OPCODES (or len(OPCODES))
+
+    def __init__(self, mem_start, mem_size):
+        if Profile.OPID is None:
+            index = { int(opcode): k for (k, opcode) in enumerate(Profile.OPCODES) }
+            Profile.OPID = array('B', [ index.get(int(opcode), len(Profile.OPCODES))
+                                        for opcode in opcode_table ])
+        self.mem_start  = int(mem_start)
+        self.mem_end    = self.mem_start + int(mem_size)
+        self.count      = array('Q', bytes(8 * int(mem_size)))     # executions per pc
+        self.stalls     = array('Q', bytes(8 * int(mem_size)))     # extra cycles per pc
+        self.opcodes    = array('Q', bytes(8 * (len(Profile.OPCODES) + 1)))
+        self.taken      = array('Q', bytes(8 * int(mem_size)))     # taken transfers per pc
+        self.indirect   = {}        # (pc, target) -> number of JPR/JRL transfers
+        self.entries    = set()     # entry points of the runs
+        self.pending    = None      # offset of the last instruction, and the
+        self.since      = 0         # cycle it started at
+
+    def start(self, entry_point):
+        self.entries.add(int(entry_point) & 0xffff)
+
+    def step(self, pc, inst, cycle):
+        """
+        counts the instruction inst at pc, which starts (or retires) at cycle
+        """
+        if self.pending is not None:
+            self.stalls[self.pending] += cycle - self.since - 1
+            self.pending = None
+        offset = pc - self.mem_start
+        if 0 <= offset < len(self.count):
+            self.count[offset] += 1
+            self.opcodes[Profile.OPID[inst]] += 1
+            self.pending    = offset
+            self.since      = cycle
+
+    def transfer(self, pc, target, indirect):
+        if indirect:
+            key = (pc, target)
+            self.indirect[key] = self.indirect.get(key, 0) + 1
+        else:
+            self.taken[pc - self.mem_start] += 1
+
+    def edges(self, dmem):
+        """
+        returns { (pc, target): number of taken transfers }
+        """
+        edges = dict(self.indirect)
+        for offset in range(len(self.taken)):
+            if self.taken[offset]:
+                pc  = self.mem_start + offset
+                dec = decode_table[self.fetch(dmem, pc)]
+                target = (pc + 1 + dec[DC_IMM_I]) & 0xffff  if dec[DC_CS][CS_BR_TYPE] == BrJ_B  else \
+                         (pc & 0xf000) | dec[DC_IMM_J]
+                edges[(pc, target)] = self.taken[offset]
+        return edges
+
+    def cycles(self, offset):
+        return self.count[offset] + self.stalls[offset]
+
+    def stop(self, cycle):
+        """
+        charges the cycles of the last instruction of a run
+        """
+        self.step(-1, 0, cycle)
+
+    def fetch(self, dmem, pc):
+        inst, ok = dmem.access(True, pc, 0, M_XRD)
+        return int(inst)
+
+    def blocks(self, dmem, edges):
+        """
+        returns [ (first pc, last pc, entries, cycles), ... ] for the basic
+        blocks executed
+        """
+        leaders = set(self.entries) | { target for (_, target) in edges }
+        blocks  = []
+        first   = None
+        for offset in range(len(self.count)):
+            pc = self.mem_start + offset
+            if self.count[offset] == 0:
+                first = None
+                continue
+            if first is None or pc in leaders:
+                if first is not None:
+                    blocks.append((first, pc - 1, self.count[first - self.mem_start], cycles))
+                first, cycles = pc, 0
+            cycles += self.cycles(offset)
+            dec = decode_table[self.fetch(dmem, pc)]
+            if dec is None or dec[DC_CS] is None or dec[DC_CLASS] == CL_CTRL:
+                blocks.append((first, pc, self.count[first - self.mem_start], cycles))
+                first = None
+        if first is not None:
+            blocks.append((first, self.mem_end - 1, self.count[first - self.mem_start], cycles))
+        return blocks
+
+    def report(self, dmem, top = 20, out = None):
+        out     = sys.stdout if out is None else out
+        total   = sum(self.count)
+        cycles  = total + sum(self.stalls)
+        pct     = lambda n, d: 0.0 if d == 0 else n * 100.0 / d
+        edges   = self.edges(dmem)
+        taken   = {}
+        for ((pc, target), n) in edges.items():
+            taken[pc] = taken.get(pc, 0) + n
+
+        print("Profile: %d instructions, %d cycles" % (total, cycles), file = out)
+
+        pcs = sorted((offset for offset in range(len(self.count)) if self.count[offset]),
+                     key = lambda offset: (-self.cycles(offset), offset))
+        print("\nHot spots (top %d of %d instructions, by cycles):" % (min(top, len(pcs)), len(pcs)), file = out)
+        print("      pc       count      cycles        %   instruction", file = out)
+        for offset in pcs[:top]:
+            pc = self.mem_start + offset
+            print("  0x%04x  %10d  %10d  %6.2f%%   %s" % (pc, self.count[offset], self.cycles(offset),
+                  pct(self.cycles(offset), cycles), Program.disasm(pc, self.fetch(dmem, pc))), file = out)
+
+        print("\nOpcodes:", file = out)
+        names = [ TSC.opcode_name(opcode) for opcode in Profile.OPCODES ] + [ "(illegal)" ]
+        for k in sorted(range(len(names)), key = lambda k: -self.opcodes[k]):
+            if self.opcodes[k]:
+                print("  %-10s %10d  %6.2f%%" % (names[k], self.opcodes[k], pct(self.opcodes[k], total)), file = out)
+
+        blocks = sorted(self.blocks(dmem, edges), key = lambda b: (-b[3], b[0]))
+        print("\nBasic blocks (top %d of %d, by cycles):" % (min(top, len(blocks)), len(blocks)), file = out)
+        print("           block   insts     entries      cycles        %", file = out)
+        for (first, last, entries, n) in blocks[:top]:
+            print("  0x%04x - 0x%04x  %6d  %10d  %10d  %6.2f%%" % (first, last, last - first + 1,
+                  entries, n, pct(n, cycles)), file = out)
+
+        # Conditional branches, and the calls (JAL/JRL) and returns (JPR)
+        branches, calls, jumps, returns = [], {}, set(), {}
+        for offset in range(len(self.count)):
+            pc = self.mem_start + offset
+            if self.count[offset] == 0:
+                continue
+            dec = decode_table[self.fetch(dmem, pc)]
+            if dec is None or dec[DC_CS] is None or dec[DC_CLASS] != CL_CTRL:
+                continue
+            cs = dec[DC_CS]
+            if cs[CS_BR_TYPE] == BrJ_B:
+                branches.append((pc, self.count[offset], taken.get(pc, 0)))
+            elif cs[CS_RF_WEN] and cs[CS_WB_SEL] == WB_PC1:
+                calls[pc] = [ (target, n) for ((src, target), n) in edges.items() if src == pc ]
+            elif cs[CS_BR_TYPE] == BrJ_I:
+                jumps.add(pc)
+
+        print("\nBranches (top %d of %d, by count):" % (min(top, len(branches)), len(branches)), file = out)
+        print("      pc       count       taken   not taken   instruction", file = out)
+        for (pc, n, t) in sorted(branches, key = lambda b: (-b[1], b[0]))[:top]:
+            print("  0x%04x  %10d  %10d  %10d   %s" % (pc, n, t, n - t,
+                  Program.disasm(pc, self.fetch(dmem, pc))), file = out)
+
+        # A call belongs to the closest function entry before it
+        functions = sorted(self.entries | { target for sites in calls.values() for (target, _) in sites })
+        owner = lambda pc: max([ f for f in functions if f <= pc ] or [ functions[0] ])
+        graph = {}
+        for (site, sites) in calls.items():
+            for (target, n) in sites:
+                key = (owner(site), target)
+                graph[key] = graph.get(key, 0) + n
+        for ((src, target), n) in edges.items():
+            if src in jumps and ((target - 1) & 0xffff) in calls:
+                callee = owner(src)
+                returns[callee] = returns.get(callee, 0) + n
+
+        print("\nCall graph (%d functions):" % len(functions), file = out)
+        print("  caller    callee       calls     returns (from callee)", file = out)
+        for ((caller, callee), n) in sorted(graph.items(), key = lambda e: (-e[1], e[0])):
+            print("  0x%04x -> 0x%04x  %10d  %10d" % (caller, callee, n, returns.get(callee, 0)), file = out)
+
+
+#--------------------------------------------------------------------------
+#   Snapshot: saves and restores the complete machine state
+#--------------------------------------------------------------------------
+
+class Snapshot(object):
+
+    MAGIC           = b'TSCSTATE'
+    VERSION         = 2
+    HEADER          = struct.Struct('>8sHHIIHH')    # magic, version, pc, mem_start, mem_size, nregs, status
+    COUNT           = struct.Struct('>I')
+    COUNTER         = struct.Struct('>Q')
+    STATS           = [ 'cycle', 'icount', 'inst_alu', 'inst_mem', 'inst_ctrl', 'stalls', 'flushes',
+                        'cycle_alu', 'cycle_mem', 'cycle_ctrl',
+                        'bp_count', 'bp_miss', 'bp_penalty' ]
+
+    # A run which stopped with one of these is over: resuming it must not
+    # execute its last instruction (e.g. the HLT at the pc) again
+    FINAL           = EXC_HALT | EXC_DMEM_ERROR | EXC_ILLEGAL_INST | EXC_IMEM_ERROR
+
+    # Layout (big-endian): header, NUM_REGS register words, the number of
+    # Stat counters and their values, the number of pages stored, and then
+    # each page as its index followed by PAGE_SIZE words. Pages of zeros
+    # are not stored at all.
+
+    @staticmethod
+    def save(cpu, filename, status = EXC_NONE):
+        """
+        write the registers, pc, memory pages, and Stat counters to filename,
+        with the status the run stopped with
+        """
+        with open(filename, 'wb') as f:
+            f.write(Snapshot.dumps(cpu, status))
+
+    @staticmethod
+    def load(cpu, filename):
+        """
+        restore the machine state saved in filename, returns the pc to resume
+        at and the status the run stopped with
+        """
+        with open(filename, 'rb') as f:
+            return Snapshot.loads(cpu, f.read(), filename)
+
+    @staticmethod
+    def dumps(cpu, status = EXC_NONE):
+        """
+        returns the snapshot of cpu as bytes
+        """
+        dmem = cpu.dmem
+        pages = [ (index, page) for (index, page) in enumerate(dmem.pages)
+                  if page is not Memory.ZERO_PAGE and any(page) ]
+
+        data = [ Snapshot.HEADER.pack(Snapshot.MAGIC, Snapshot.VERSION, int(cpu.pc.read()),
+                                      dmem.mem_start, dmem.mem_end - dmem.mem_start, NUM_REGS, status),
+                 struct.pack('>%dH' % NUM_REGS, *[ int(v) for v in cpu.rf.reg ]),
+                 Snapshot.COUNT.pack(len(Snapshot.STATS)) ]
+        for name in Snapshot.STATS:
+            data.append(Snapshot.COUNTER.pack(getattr(cpu.stat, name)))
+        data.append(Snapshot.COUNT.pack(len(pages)))
+        for (index, page) in pages:
+            words = array('H', page)
+            if Memory.SWAP_BYTES:
+                words.byteswap()
+            data.append(Snapshot.COUNT.pack(index))
+            data.append(words.tobytes())
+        return b''.join(data)
+
+    @staticmethod
+    def loads(cpu, data, filename = '<bytes>'):
+        """
+        restore the machine state from the bytes of a snapshot, returns the
+        pc to resume at and the status the run stopped with
+        """
+        dmem = cpu.dmem
+        (magic, version, pc, mem_start, mem_size, nregs, status) = Snapshot.HEADER.unpack_from(data, 0)
+        if magic != Snapshot.MAGIC or version != Snapshot.VERSION:
+            raise Exception(f"{filename} is not a TSC state snapshot (version {Snapshot.VERSION})")
+        if mem_start != dmem.mem_start or mem_size != dmem.mem_end - dmem.mem_start or nregs != NUM_REGS:
+            raise Exception(f"{filename} was saved from a different machine: memory "
+                            f"{mem_start:04x} - {mem_start+mem_size-1:04x}, {nregs} registers")
+        pos = Snapshot.HEADER.size
+
+        regs = struct.unpack_from('>%dH' % NUM_REGS, data, pos)
+        pos += NUM_REGS * 2
+        for i in range(NUM_REGS):
+            cpu.rf.write(i, regs[i])
+        cpu.pc.write(pc)
+
+        (nstats,) = Snapshot.COUNT.unpack_from(data, pos)
+        pos += Snapshot.COUNT.size
+        for i in range(nstats):
+            (value,) = Snapshot.COUNTER.unpack_from(data, pos)
+            pos += Snapshot.COUNTER.size
+            setattr(cpu.stat, Snapshot.STATS[i], value)
+
+        # Pages not in the snapshot are all zeros
+        for (index, page) in enumerate(dmem.pages):
+            if page is Memory.ZERO_PAGE:
+                continue
+            if dmem.mmap is None:
+                dmem.pages[index] = Memory.ZERO_PAGE
+            else:
+                page[:] = Memory.ZERO_PAGE
+
+        (npages,) = Snapshot.COUNT.unpack_from(data, pos)
+        pos += Snapshot.COUNT.size
+        nbytes = Memory.PAGE_SIZE * dmem.word_size
+        for i in range(npages):
+            (index,) = Snapshot.COUNT.unpack_from(data, pos)
+            pos += Snapshot.COUNT.size
+            words = array('H', data[pos:pos + nbytes])
+            pos += nbytes
+            if Memory.SWAP_BYTES:
+                words.byteswap()
+            dmem.page(index)[:] = words
+
+        return (pc, status)
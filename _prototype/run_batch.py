@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Runs many hex images on the single-cycle machine in parallel
+#
+#==========================================================================
+
+import argparse
+import contextlib
+import csv
+import hashlib
+import io
+import json
+import os
+import sys
+import time
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+
+from run_tsc import *
+from sim_vector import *
+
+
+#--------------------------------------------------------------------------
+#   Configurations
+#--------------------------------------------------------------------------
+
+REPORT_FIELDS   = [ 'image', 'status', 'cycle', 'icount', 'inst_alu', 'inst_mem', 'inst_ctrl',
+                    'pc', 'regs', 'mem_digest', 'seconds', 'error' ]
+
+
+#--------------------------------------------------------------------------
+#   Jobs: one image with its input/output files
+#--------------------------------------------------------------------------
+
+def find_jobs(path):
+    """
+    returns the jobs for a directory of *.hex images or a JSON manifest
+    """
+    if os.path.isdir(path):
+        return [ { 'image': os.path.join(path, name) }
+                 for name in sorted(os.listdir(path)) if name.endswith('.hex') ]
+
+    # Manifest: a list of { "image": ..., "input": [[address, maxsize, filename], ...],
+    # "output": [[address, size, filename], ...] }, relative to the manifest
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        jobs = json.load(f)
+    for job in jobs:
+        job['image'] = os.path.join(base, job['image'])
+        for key in ('input', 'output'):
+            job[key] = [ [ str(addr), str(size), os.path.join(base, name) ]
+                         for (addr, size, name) in job.get(key, []) ]
+    return jobs
+
+
+def mem_digest(dmem):
+    """
+    SHA-1 of the whole memory as big-endian words
+    """
+    h = hashlib.sha1()
+    zero = bytes(Memory.PAGE_SIZE * dmem.word_size)
+    for page in dmem.pages:
+        if page is Memory.ZERO_PAGE:
+            h.update(zero)
+            continue
+        words = array('H', page)
+        if Memory.SWAP_BYTES:
+            words.byteswap()
+        h.update(words.tobytes())
+    return h.hexdigest()
+
+
+def new_machine(job, engine, mem_size, max_cycles, max_time = None, idle = IDLE_SKIP):
+    """
+    returns a machine with the image and input files of job loaded
+    """
+    cpu = TSC__1_cycle(0, mem_size, ENGINES[engine])
+    cpu.log.level = 0
+    cpu.max_cycles = max_cycles
+    cpu.max_time = max_time
+    cpu.idle = idle
+    load_file(cpu, '0', str((cpu.dmem.mem_end - cpu.dmem.mem_start) * WORD_SIZE), job['image'])
+    for item in job.get('input', []):
+        load_file(cpu, *item)
+    return cpu
+
+
+def report_row(job, cpu, status, seconds, error = None):
+    row = dict.fromkeys(REPORT_FIELDS, '')
+    row['image']        = job['image']
+    row['seconds']      = '%.6f' % seconds
+    if error is not None:
+        row['status']   = 'error'
+        row['error']    = error
+        return row
+
+    row['status']       = EXC_MSG.get(status, str(status))
+    row['cycle']        = cpu.stat.cycle
+    row['icount']       = cpu.stat.icount
+    row['inst_alu']     = cpu.stat.inst_alu
+    row['inst_mem']     = cpu.stat.inst_mem
+    row['inst_ctrl']    = cpu.stat.inst_ctrl
+    row['pc']           = '%04x' % cpu.pc.read()
+    row['regs']         = ' '.join('%04x' % r for r in cpu.rf.reg)
+    row['mem_digest']   = mem_digest(cpu.dmem)
+    return row
+
+
+def run_job(job, engine, mem_size, max_cycles, max_time = None, idle = IDLE_SKIP):
+    """
+    runs a single job in a worker process, returns its report row
+    """
+    start = time.perf_counter()
+
+    # Messages of the simulator are not part of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            cpu = new_machine(job, engine, mem_size, max_cycles, max_time, idle)
+            status = cpu.run(0)
+            for item in job.get('output', []):
+                save_file(cpu, *item)
+        except Exception as e:
+            return report_row(job, None, None, time.perf_counter() - start, str(e))
+
+    return report_row(job, cpu, status, time.perf_counter() - start)
+
+
+def run_lockstep(jobs, engine, mem_size, max_cycles, max_time = None, idle = IDLE_SKIP):
+    """
+    runs a group of jobs as the lanes of one Lockstep machine, returns
+    their report rows. The seconds of each row are its share of the group.
+    """
+    start = time.perf_counter()
+    rows = [ None ] * len(jobs)
+    lanes = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        cpus = []
+        for (i, job) in enumerate(jobs):
+            try:
+                cpus.append(new_machine(job, engine, mem_size, max_cycles, max_time, idle))
+                lanes.append(i)
+            except Exception as e:
+                rows[i] = report_row(job, None, None, 0.0, str(e))
+
+        statuses = Lockstep(cpus).run(0) if cpus else []
+
+        for (i, cpu, status) in zip(lanes, cpus, statuses):
+            try:
+                for item in jobs[i].get('output', []):
+                    save_file(cpu, *item)
+            except Exception as e:
+                rows[i] = report_row(jobs[i], None, None, 0.0, str(e))
+
+    seconds = (time.perf_counter() - start) / len(jobs)
+    for (i, cpu, status) in zip(lanes, cpus, statuses):
+        if rows[i] is None:
+            rows[i] = report_row(jobs[i], cpu, status, seconds)
+    return rows
+
+
+def write_report(rows, filename, fmt):
+    with (open(filename, 'w', newline='') if filename else contextlib.nullcontext(sys.stdout)) as f:
+        if fmt == 'json':
+            json.dump(rows, f, indent=1)
+            f.write('\n')
+        else:
+            writer = csv.DictWriter(f, fieldnames=REPORT_FIELDS)
+            writer.writeheader()
+            writer.writerows(rows)
+
+
+#--------------------------------------------------------------------------
+#   Batch runner main
+#--------------------------------------------------------------------------
+
+def main():
+
+    parser = argparse.ArgumentParser(usage='%(prog)s --help for more information',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--workers", "-w", type=int, default=os.cpu_count(),
+        help="number of worker processes (default: %(default)s)")
+    parser.add_argument("--engine", "-e", choices=ENGINES.keys(), default='fast',
+        help="execution engine (default: %(default)s)")
+    parser.add_argument("--dmem-size", "-dms", type=lambda x: int(x, 0), default=DMEM_SIZE,
+        help="size of the memory in words (default: %(default)d)")
+    parser.add_argument("--max-cycles", "-mc", type=int, metavar="N",
+        help="stops each run when its cycle count reaches N")
+    parser.add_argument("--max-time", "-mt", type=float, metavar="SECONDS",
+        help="stops each run after SECONDS of wall-clock time")
+    parser.add_argument("--idle", choices=IDLE_MODES, default=IDLE_SKIP,
+        help="what to do with stationary loops, as in run_tsc.py (default: %(default)s)")
+    parser.add_argument("--lockstep", "-ls", action="store_true",
+        help="runs the images of each worker together, as the lanes of one\n"
+             "vectorized machine (sim_vector.py)")
+    parser.add_argument("--lanes", type=int, default=1024,
+        help="max. number of lanes of a --lockstep machine (default: %(default)s)")
+    parser.add_argument("--report", "-r", metavar="FILE",
+        help="writes the report to FILE instead of stdout")
+    parser.add_argument("--format", "-f", choices=['csv', 'json'],
+        help="report format (default: from the extension of FILE, otherwise csv)")
+    parser.add_argument("path", type=str,
+        help="directory of *.hex images, or a JSON manifest of images with input/output files")
+    args = parser.parse_args()
+
+    fmt = args.format or ('json' if args.report and args.report.endswith('.json') else 'csv')
+    jobs = find_jobs(args.path)
+    if not jobs:
+        print(f"No images found in {args.path}", file=sys.stderr)
+        exit(1)
+
+    # Hand out several jobs per round trip, while keeping the workers balanced
+    chunksize = max(1, len(jobs) // (args.workers * 4))
+
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        if args.lockstep:
+            # One group of lanes per worker, unless the groups get too large
+            lanes = min(args.lanes, -(-len(jobs) // args.workers))
+            groups = [ jobs[i:i + lanes] for i in range(0, len(jobs), lanes) ]
+            rows = [ row for group in pool.map(run_lockstep, groups,
+                                               [ args.engine ] * len(groups),
+                                               [ args.dmem_size ] * len(groups),
+                                               [ args.max_cycles ] * len(groups),
+                                               [ args.max_time ] * len(groups),
+                                               [ args.idle ] * len(groups))
+                     for row in group ]
+        else:
+            rows = list(pool.map(run_job, jobs,
+                                 [ args.engine ] * len(jobs),
+                                 [ args.dmem_size ] * len(jobs),
+                                 [ args.max_cycles ] * len(jobs),
+                                 [ args.max_time ] * len(jobs),
+                                 [ args.idle ] * len(jobs),
+                                 chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    write_report(rows, args.report, fmt)
+
+    icount = sum(row['icount'] or 0 for row in rows)
+    errors = sum(row['status'] == 'error' for row in rows)
+    print(f"{len(rows)} images ({errors} errors), {icount} instructions in {elapsed:.3f} s "
+          f"with {args.workers} workers", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Measures the simulator on the benchmark suite (benchmarks/*.hex)
+#
+#==========================================================================
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+#--------------------------------------------------------------------------
+#   Configurations
+#--------------------------------------------------------------------------
+
+HERE            = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR       = os.path.join(HERE, 'benchmarks')
+
+# run_tsc.py arguments of each simulator configuration
+TARGETS         = {
+    'simple'    : [ '-e', 'simple' ],
+    'fast'      : [ '-e', 'fast' ],
+    'dbt'       : [ '-e', 'dbt' ],
+    'multi'     : [ '-m', 'M' ],
+    'pipe'      : [ '-m', 'P' ],
+}
+
+# Engines of the single-cycle machine must retire the same instructions
+SAME_MACHINE    = [ 'simple', 'fast', 'dbt' ]
+
+VERSION         = 1
+
+
+#--------------------------------------------------------------------------
+#   Runs: one run_tsc.py process per measurement
+#--------------------------------------------------------------------------
+
+def run_once(image, target, level):
+    """
+    runs image in a fresh simulator process, returns the --host-json
+    summary with the process wall time added as 'process_s'
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        out = os.path.join(tmp, 'host.jsonl')
+        cmd = [ sys.executable, os.path.join(HERE, 'run_tsc.py'), '--hex', '-l', str(level),
+                '--host-json', out ] + TARGETS[target] + [ image ]
+        start = time.perf_counter()
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, check=True)
+        elapsed = time.perf_counter() - start
+        with open(out) as f:
+            summary = json.loads(f.readline())
+    summary['process_s'] = elapsed
+    return summary
+
+
+def measure(image, target, level, repeat):
+    """
+    runs image repeat times, returns the result record of the configuration
+    """
+    runs = [ run_once(image, target, level) for _ in range(repeat) ]
+    mips = [ r['ips'] / 1e6 for r in runs ]
+    counts = { (r['instructions'], r['cycles'], r['status']) for r in runs }
+    if len(counts) > 1:
+        raise RuntimeError(f"{image} ({target}, log {level}) is not reproducible: {sorted(counts)}")
+
+    return {
+        'benchmark'     : os.path.splitext(os.path.basename(image))[0],
+        'target'        : target,
+        'log'           : level,
+        'status'        : runs[0]['status'],
+        'instructions'  : runs[0]['instructions'],
+        'cycles'        : runs[0]['cycles'],
+        'mips'          : mips,
+        'mips_median'   : statistics.median(mips),
+        'mips_stdev'    : statistics.stdev(mips) if len(mips) > 1 else 0.0,
+        'max_rss_kb'    : max(r['max_rss_kb'] or 0 for r in runs),
+        'startup_s'     : statistics.median(r['process_s'] - r['wall_s'] for r in runs),
+    }
+
+
+def check_counts(results):
+    """
+    returns the benchmarks whose engines of the single-cycle machine
+    disagree on the instructions retired
+    """
+    counts = {}
+    for r in results:
+        if r['target'] in SAME_MACHINE:
+            counts.setdefault(r['benchmark'], set()).add((r['instructions'], r['cycles'], r['status']))
+    return sorted(name for (name, c) in counts.items() if len(c) > 1)
+
+
+def show(results, baseline = None):
+    """
+    prints the results, with the speedup over the baseline results if given
+    """
+    base = { (b['benchmark'], b['target'], b['log']): b['mips_median'] for b in baseline or [] }
+    print("%-12s %-7s %3s %12s %9s %8s %9s %10s%s" % ("benchmark", "target", "log", "instructions",
+          "MIPS", "+/-", "RSS (MB)", "startup", "   speedup" if baseline else ""))
+    for r in results:
+        ref = base.get((r['benchmark'], r['target'], r['log']))
+        print("%-12s %-7s %3d %12d %9.4f %8.4f %9.1f %8.1f ms%s" % (r['benchmark'], r['target'], r['log'],
+              r['instructions'], r['mips_median'], r['mips_stdev'], r['max_rss_kb'] / 1024.0,
+              r['startup_s'] * 1000.0,
+              "" if not baseline else "         -" if not ref else "%9.2fx" % (r['mips_median'] / ref)))
+
+
+#--------------------------------------------------------------------------
+#   Benchmark harness main
+#--------------------------------------------------------------------------
+
+def main():
+
+    benchmarks = sorted(os.path.splitext(name)[0] for name in os.listdir(BENCH_DIR) if name.endswith('.hex'))
+
+    parser = argparse.ArgumentParser(usage='%(prog)s --help for more information',
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--target", "-t", action="append", choices=TARGETS.keys(),
+        help="simulator configuration to measure, may be repeated (default: all of them)")
+    parser.add_argument("--log", "-l", action="append", type=int, choices=range(0, 8),
+        help="log level to measure, may be repeated (default: 0 and 3)")
+    parser.add_argument("--repeat", "-r", type=int, default=5, metavar="N",
+        help="runs of each configuration; the median is reported (default: %(default)s)")
+    parser.add_argument("--json", "-j", metavar="FILE",
+        help="writes the results to FILE, to be used as a --baseline later")
+    parser.add_argument("--baseline", "-b", metavar="FILE",
+        help="shows the speedup over the results in FILE")
+    parser.add_argument("benchmark", nargs="*",
+        help="benchmarks to run (default: all of %s)" % ", ".join(benchmarks))
+    args = parser.parse_args()
+
+    for name in args.benchmark:
+        if name not in benchmarks:
+            parser.error(f"unknown benchmark: {name} (choose from {', '.join(benchmarks)})")
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+
+    results = []
+    for name in args.benchmark or benchmarks:
+        for target in args.target or TARGETS.keys():
+            for level in args.log or [ 0, 3 ]:
+                print(f"Running {name} ({target}, log {level}) x {args.repeat}", file=sys.stderr)
+                results.append(measure(os.path.join(BENCH_DIR, name + '.hex'), target, level, args.repeat))
+
+    show(results, baseline)
+
+    mismatch = check_counts(results)
+    if mismatch:
+        print("Engines disagree on the instructions retired by: " + ", ".join(mismatch), file=sys.stderr)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({ 'version': VERSION, 'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                        'python': platform.python_version(), 'platform': platform.platform(),
+                        'repeat': args.repeat, 'results': results }, f, indent=1)
+            f.write('\n')
+
+    if mismatch:
+        exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Evaluates branch predictors on JSONL/binary traces of run_tsc.py --trace
+#
+#==========================================================================
+
+import argparse
+import time
+
+from sim_bpred import *
+
+
+def main():
+
+    parser = argparse.ArgumentParser(usage='%(prog)s --help for more information')
+    parser.add_argument("--BP", "-BP", dest="predictors", action="append", choices=PREDICTORS.keys(),
+        help="predictor to evaluate, may be repeated (default: all of them)")
+    parser.add_argument("--bp-entries", "-bpe", type=int, default=256, metavar="N",
+        help="number of entries of the 1bit, 2bit and gshare predictors (default: %(default)s)")
+    parser.add_argument("--btb", type=int, default=0, metavar="N",
+        help="predicts JPR/JRL targets with an N-entry BTB (default: %(default)s, no BTB)")
+    parser.add_argument("--penalty", type=int, default=2, metavar="N",
+        help="cycles lost per misprediction (default: %(default)s, as in TSC-P0-5)")
+    parser.add_argument("filename", type=str, help="trace file name (jsonl or bin)")
+    args = parser.parse_args()
+
+    # Decode the trace once: only branches and register jumps are replayed
+    start = time.perf_counter()
+    stream = branch_stream(args.filename)
+    print(f"{len(stream)} branches and register jumps in {args.filename} "
+          f"({time.perf_counter() - start:.3f} s)")
+
+    print("%-8s %10s %10s %9s %10s  %s" % ("BP", "predicted", "missed", "accuracy", "penalty", "configuration"))
+    for name in args.predictors or PREDICTORS.keys():
+        predictor = PREDICTORS[name](args.bp_entries)
+        btb = BTB(args.btb) if args.btb else None
+        count, miss = replay(stream, predictor, btb)
+        print("%-8s %10d %10d %8.2f%% %10d  %s%s" % (name, count, miss,
+              0.0 if count == 0 else (count - miss) * 100.0 / count, miss * args.penalty,
+              predictor.describe(), ", %d-entry BTB" % btb.entries if btb else ""))
+
+
+if __name__ == '__main__':
+    main()
@@ -14,14 +14,21 @@
 #==========================================================================
 
 import argparse
+import contextlib
+import mmap
+import os
+import re
 import sys
+import time
 
 from isa import *
 from program import *
 from sim_consts import *
 from sim_control import *
+from sim_dbt import *
 from sim_machines import *
 from sim_modules import *
+from sim_sample import *
 
 
 #--------------------------------------------------------------------------
@@ -29,16 +36,29 @@ from sim_modules import *
 #--------------------------------------------------------------------------
 
 # Memory configurations
-#   UMEM: 0x0000 - 0x00ff (256 words)
+#   UMEM: 0x0000 - 0xffff (64K words, the whole 16-bit address space)
+#         pages are allocated on first write, so unused space costs nothing
+#         (use --dmem-size 256 for the original 0x0000 - 0x00ff layout)
 
-UMEM_START  = WORD(0x0000)  # IMEM: 0x80000000 - 0x8000ffff (64KB)
-UMEM_SIZE   = WORD(256)
+UMEM_START  = WORD(0x0000)
+UMEM_SIZE   = 1 << BITWIDTH         # in words, does not fit in a WORD
 
-IMEM_START  = WORD(0x0000)  # IMEM: 0x80000000 - 0x8000ffff (64KB)
-IMEM_SIZE   = WORD(256)
+IMEM_START  = WORD(0x0000)
+IMEM_SIZE   = 1 << BITWIDTH
 
-DMEM_START  = WORD(0x0000)  # IMEM: 0x80000000 - 0x8000ffff (64KB)
-DMEM_SIZE   = WORD(256)
+DMEM_START  = WORD(0x0000)
+DMEM_SIZE   = 1 << BITWIDTH
+
+# Execution engines for the single-cycle machine
+#   simple: NumPy-typed datapath modules (reference model)
+#   fast:   plain Python ints, bit-identical results
+#   dbt:    basic blocks translated into Python functions (fast when tracing)
+
+ENGINES     = {
+    'simple'    : Simple,
+    'fast'      : Fast,
+    'dbt'       : DBT,
+}
 
 
 #--------------------------------------------------------------------------
@@ -76,52 +96,143 @@ DMEM_SIZE   = WORD(256)
 #--------------------------------------------------------------------------
 
 #--------------------------------------------------------------------------
-#   TSC-1-0: Target machine to simulate
+#   Caches: attached to any of the machines below
 #--------------------------------------------------------------------------
 
-class TSC__1_cycle(object):
+# Cache configurations, as in the machine names (sizes in words):
+#   U<size>-<block>-<ways>                      unified cache
+#   I<size>-<block>-<ways>-D<size>-<block>-<ways>  split I/D caches
+
+CACHE_SPEC  = re.compile(r'^(?:U(\d+)-(\d+)-(\d+)|I(\d+)-(\d+)-(\d+)-D(\d+)-(\d+)-(\d+))$')
+
+def parse_cache(spec):
+    """
+    returns [ (name, size, block size, ways), ... ] for a cache configuration
+    """
+    m = CACHE_SPEC.match(spec)
+    if m is None:
+        raise argparse.ArgumentTypeError(f"invalid cache configuration: '{spec}' "
+                                         "(expected e.g. U16-4-1 or I16-4-1-D16-4-1)")
+    v = [ None if g is None else int(g) for g in m.groups() ]
+    if v[0] is not None:
+        return [ ('U', v[0], v[1], v[2]) ]
+    return [ ('I', v[3], v[4], v[5]), ('D', v[6], v[7], v[8]) ]
+
+
+def attach_caches(cpu, config, policy = 'lru', write_back = True, miss_latency = 10):
+    """
+    puts the caches of config (from parse_cache) in front of the memory of cpu
+    """
+    caches = [ Cache(name, size, block_size, ways, policy, write_back, miss_latency)
+               for (name, size, block_size, ways) in config ]
+    cpu.icache = caches[0]
+    cpu.dcache = caches[-1]
+
+
+def cache_banner(cpu):
+    if cpu.icache is None:
+        return ""
+    config = cpu.icache.config()
+    if cpu.dcache is not cpu.icache:
+        config += "-" + cpu.dcache.config()
+    return (f"  cache:                 {config} ({cpu.icache.policy}, "
+            f"{'write-back' if cpu.icache.write_back else 'write-through'}, "
+            f"{cpu.icache.miss_latency}-cycle miss)\n")
 
-    def __init__(self, mem_start=UMEM_START, mem_size=UMEM_SIZE):
+
+#--------------------------------------------------------------------------
+#   TSC__machine: the state shared by all target machines
+#--------------------------------------------------------------------------
+
+class TSC__machine(object):
+
+    NAME = None
+
+    def __init__(self, mem_start, mem_size, stat):
         self.pc = Register()
         self.rf = RegisterFile()
         self.alu = ALU()
         self.dmem = Memory(mem_start, mem_size, WORD_SIZE)
+        self.stat = stat
+        self.log = Log()
+        self.trace = Trace()
+        self.max_cycles = None
+        self.max_time = None
+        self.idle = IDLE_SKIP
+        self.skip_loops = False
+        self.icache = None
+        self.dcache = None
+        self.profile = None
+        self.host = None
+        self.engine = None              # set by each machine, once the rest is in place
+
+    def mem_banner(self):
+        return (f"  memory:                {self.dmem.mem_start:04x} - {self.dmem.mem_end-1:04x}"
+                f" ({self.dmem.mem_end - self.dmem.mem_start} words)\n"
+                f"{cache_banner(self)}")
+
+    def run(self, entry_point):
+        return self.engine.run(entry_point)
+
+#--------------------------------------------------------------------------
+#   TSC-1-0: Target machine to simulate
+#--------------------------------------------------------------------------
+
+class TSC__1_cycle(TSC__machine):
+
+    NAME = "TSC-1-0"
+
+    def __init__(self, mem_start=UMEM_START, mem_size=UMEM_SIZE, engine=Simple):
+        TSC__machine.__init__(self, mem_start, mem_size, Stat())
+        self.engine = engine(self)
 
-        print(f"TSC-1-0\n"
+    def banner(self):
+        print(f"{self.NAME}\n"
               f"  architecture:          {BITWIDTH} bit\n"
               f"  pipeline stages:       {1}\n"
               f"\n"
-              f"  memory:                {mem_start:04x} - {mem_start+mem_size-1:04x}"
-              f" ({mem_size} words)\n")
-
-    def run(self, entry_point):
-        Simple.run(self, entry_point)
+              f"{self.mem_banner()}")
 
 #--------------------------------------------------------------------------
 #   TSC-M0-2-5: Target machine to simulate
 #--------------------------------------------------------------------------
 
-class TSC__multi_cycle(object):
+class TSC__multi_cycle(TSC__machine):
+
+    NAME = "TSC-M0-2-5"
 
     def __init__(self, mem_start=UMEM_START, mem_size=UMEM_SIZE):
-        pass
+        TSC__machine.__init__(self, mem_start, mem_size, Stat(multicycle=True))
+        self.engine = Multi(self)
 
-    def run(self, entry_point):
-        # TSC_Multi.run(entry_point)
-        pass
+    def banner(self):
+        print(f"{self.NAME}\n"
+              f"  architecture:          {BITWIDTH} bit\n"
+              f"  cycles per inst.:      {min(Multi.CYCLES.values())}-{max(Multi.CYCLES.values())}\n"
+              f"\n"
+              f"{self.mem_banner()}")
 
 #--------------------------------------------------------------------------
 #   TSC-P0-5: Target machine to simulate
 #--------------------------------------------------------------------------
 
-class TSC__pipe(object):
+class TSC__pipe(TSC__machine):
 
-    def __init__(self, mem_start=UMEM_START, mem_size=UMEM_SIZE):
-        pass
+    NAME = "TSC-P0-5"
 
-    def run(self, entry_point):
-        # Pipe.run(entry_point)
-        pass
+    def __init__(self, mem_start=UMEM_START, mem_size=UMEM_SIZE, forwarding=True, predictor=None, btb=None):
+        TSC__machine.__init__(self, mem_start, mem_size, Stat(pipelined=True))
+        self.engine = Pipe(self, forwarding, predictor, btb)
+
+    def banner(self):
+        print(f"{self.NAME}\n"
+              f"  architecture:          {BITWIDTH} bit\n"
+              f"  pipeline stages:       {5}\n"
+              f"  forwarding:            {'yes' if self.engine.forwarding else 'no (stall)'}\n"
+              f"  branch predictor:      {self.engine.predictor.describe()}\n"
+              f"  BTB:                   {'%d entries' % self.engine.btb.entries if self.engine.btb else 'none'}\n"
+              f"\n"
+              f"{self.mem_banner()}")
 
 
 #--------------------------------------------------------------------------
@@ -133,7 +244,7 @@ def parse_args(args):
     # Parse command line
     parser = argparse.ArgumentParser(usage='%(prog)s --help for more information', 
                                      formatter_class=argparse.RawTextHelpFormatter)
-    parser.add_argument("--log", "-l", type=int, default=Log.level, help='''\
+    parser.add_argument("--log", "-l", type=int, default=Log.LEVEL, help='''\
 sets the desired log level (default: %(default)s)
  0: logging disabled
  1: dumps registers at the end of the execution
@@ -145,12 +256,20 @@ sets the desired log level (default: %(default)s)
  7: 6 + dumps data memory for each cycle''')
     parser.add_argument("--cycle", "-c", type=int, default=0,
         help="shows logs after cycle m (default: %(default)s, only effective for log level 3 or higher)")
+    parser.add_argument("--fast-forward", "-ff", type=int, metavar="N",
+        help="Runs the first N instructions functionally (no logs, stats, caches or timing),\n"
+             "then continues on the selected machine. --cycle and --max-cycles count from there.")
+    parser.add_argument("--ff-pc", type=lambda x: int(x, 0), metavar="ADDR",
+        help="Fast-forwards until the pc reaches ADDR (with --fast-forward: whichever comes first)")
     parser.add_argument("--input", "-i", action="append", 
         nargs=3, metavar=("address", "maxsize", "filename"),
         help="Load file to the indicated address before execution. Aborts of the file is larger than maxsize.")
     parser.add_argument("--output", "-o", action="append", 
         nargs=3, metavar=("address", "size", "filename"),
         help="Save the memory from address to address+size-1 to a file.")
+    parser.add_argument("--mem-file", "-mf", metavar="FILE",
+        help="Backs the whole memory with FILE through mmap. Memory contents are kept in FILE\n"
+             "(words in host byte order), and an existing FILE gives the initial contents.")
     parser.add_argument("--imem-addr", "-ima", type=lambda x: int(x, 0), default=IMEM_START,
         help="Set start address of instruction memory. Default: %(default)08x.")
     parser.add_argument("--imem-size", "-ims", type=lambda x: int(x, 0), default=IMEM_SIZE,
@@ -159,13 +278,134 @@ sets the desired log level (default: %(default)s)
         help="Set start address of data memory. Default: %(default)08x.")
     parser.add_argument("--dmem-size", "-dms", type=lambda x: int(x, 0), default=DMEM_SIZE,
         help="Set size of data memory. Default: %(default)08x.")
+    parser.add_argument("--trace", "-t", metavar="FILE",
+        help="Writes the instruction trace (log level 3 or higher) to FILE instead of stdout")
+    parser.add_argument("--trace-format", "-tf", choices=TRACE_FORMATS, default=TRACE_TEXT,
+        help="Sets the trace format (default: %(default)s)\n"
+             " text:  same as the console log, including per-cycle dumps\n"
+             " jsonl: one JSON object per instruction (cycle, pc, inst, rd, wbdata, pc_next)\n"
+             " bin:   fixed-size binary records of the same fields\n"
+             "jsonl/bin traces need --trace FILE. Use show_trace.py to render them.")
+    parser.add_argument("--max-cycles", "-mc", type=int, metavar="N",
+        help="Stops the simulation when the cycle count reaches N (counted from cycle 0,\n"
+             "also when resuming from --load-state)")
+    parser.add_argument("--sample", "-S", type=int, metavar="N",
+        help="Simulates samples of N instructions in detail, and extrapolates CPI and miss rates:\n"
+             "the basic block vectors of all intervals of N instructions are clustered,\n"
+             "and a few intervals of each cluster are simulated (see --sample-*).\n"
+             "--max-cycles limits the instructions sampled.")
+    parser.add_argument("--sample-k", type=int, default=10, metavar="K",
+        help="Max. number of clusters, the number is chosen by the BIC (default: %(default)s)")
+    parser.add_argument("--sample-per-cluster", type=int, default=2, metavar="S",
+        help="Samples simulated per cluster, for the error estimate (default: %(default)s)")
+    parser.add_argument("--sample-warmup", type=int, default=2000, metavar="N",
+        help="Instructions simulated in detail before each sample, to warm up the\n"
+             "caches and branch predictor (default: %(default)s)")
+    parser.add_argument("--sample-validate", action="store_true",
+        help="Also simulates the whole program in detail, and shows the actual errors")
+    parser.add_argument("--max-time", "-mt", type=float, metavar="SECONDS",
+        help="Stops the simulation after SECONDS of wall-clock time")
+    parser.add_argument("--idle", choices=IDLE_MODES, default=IDLE_SKIP,
+        help="What to do when the program is caught in a stationary loop, which gets back to\n"
+             "the same registers without storing anything (default: %(default)s)\n"
+             " skip: skips ahead to --max-cycles, or stops as 'stop' does without it\n"
+             " stop: stops with the 'idle loop' status\n"
+             " off:  keeps simulating it")
+    parser.add_argument("--save-state", "-ss", metavar="FILE",
+        help="Saves the machine state (registers, pc, memory, stats) to FILE when the run stops")
+    parser.add_argument("--load-state", "-ls", metavar="FILE",
+        help="Resumes from the machine state in FILE instead of loading a program.\n"
+             "Input files (--input) are still loaded on top of the restored memory.")
+    parser.add_argument("--machine", "-m", choices=['1', 'M', 'P'], default='1',
+        help="Selects the machine to simulate (default: %(default)s)\n"
+             " 1: TSC-1-0, single-cycle\n"
+             " M: TSC-M0-2-5, multi-cycle (2-5 cycles per instruction)\n"
+             " P: TSC-P0-5, 5-stage pipeline")
+    fwd = parser.add_mutually_exclusive_group()
+    fwd.add_argument("--FWD", "-F", dest="forwarding", action="store_true", default=True,
+        help="TSC-P0-5 forwards results to the ID stage (default)")
+    fwd.add_argument("--NOFWD", "-NF", dest="forwarding", action="store_false",
+        help="TSC-P0-5 stalls on every data hazard instead of forwarding")
+    parser.add_argument("--BP", "-BP", dest="predictor", choices=PREDICTORS.keys(), default='nt',
+        help="Branch predictor of TSC-P0-5 (default: %(default)s)\n"
+             " nt:     static not-taken\n"
+             " btfn:   static backward-taken, forward-not-taken\n"
+             " 1bit:   1-bit BHT\n"
+             " 2bit:   2-bit BHT (saturating counters)\n"
+             " gshare: 2-bit counters indexed by pc xor global history")
+    parser.add_argument("--bp-entries", "-bpe", type=int, default=256, metavar="N",
+        help="Number of entries of the 1bit, 2bit and gshare predictors (default: %(default)s)")
+    parser.add_argument("--btb", type=int, default=0, metavar="N",
+        help="Predicts JPR/JRL targets with an N-entry BTB (default: %(default)s, no BTB)")
+    parser.add_argument("--engine", "-e", choices=ENGINES.keys(), default='simple',
+        help="Selects the execution engine of the single-cycle machine (default: %(default)s)")
+    parser.add_argument("--skip-loops", "-sl", action="store_true",
+        help="Runs counted loops of ALU instructions in one step, from the trip count\n"
+             "of their closing branch (dbt engine only)")
+    parser.add_argument("--cache", "-C", type=parse_cache, metavar="CONFIG",
+        help="Puts caches in front of the memory (sizes in words, default: no cache)\n"
+             " U<size>-<block>-<ways>:  unified cache, e.g. U16-4-1\n"
+             " I<size>-<block>-<ways>-D<size>-<block>-<ways>:\n"
+             "                          split I/D caches, e.g. I16-4-1-D16-4-1")
+    parser.add_argument("--cache-policy", "-cp", choices=Cache.POLICIES, default='lru',
+        help="Replacement policy of the caches (default: %(default)s)")
+    parser.add_argument("--write-policy", "-wp", choices=['wb', 'wt'], default='wb',
+        help="Write policy of the caches (default: %(default)s)\n"
+             " wb: write-back, write-allocate\n"
+             " wt: write-through (buffered, never stalls), no write-allocate")
+    parser.add_argument("--miss-latency", "-ml", type=int, default=10, metavar="N",
+        help="Stall cycles of a cache miss, and of writing back a dirty block (default: %(default)s)")
+    parser.add_argument("--profile", "-p", action="store_true",
+        help="Counts the instructions and cycles at each pc, and shows the hot spots,\n"
+             "opcodes, basic blocks, branches and call graph after the run")
+    parser.add_argument("--profile-out", "-po", metavar="FILE",
+        help="Writes the --profile report to FILE instead of stdout")
+    parser.add_argument("--profile-top", "-pt", type=int, default=20, metavar="N",
+        help="Number of entries in each list of the --profile report (default: %(default)s)")
+    parser.add_argument("--host-stats", "-hs", action="store_true",
+        help="Shows how long the simulator itself ran, and its throughput")
+    parser.add_argument("--host-json", "-hj", metavar="FILE",
+        help="Appends the --host-stats summary to FILE as a line of JSON (implies --host-stats)")
+    parser.add_argument("--host-phases", action="store_true",
+        help="Splits the host time into fetch, decode, execute and log phases\n"
+             "(simple engine and multi-cycle machine only; implies --host-stats)")
+    parser.add_argument("--cprofile", metavar="FILE",
+        help="Runs the simulation under cProfile and writes the stats to FILE\n"
+             "(see python3 -m pstats FILE; implies --host-stats)")
+    parser.add_argument("--tracemalloc", action="store_true",
+        help="Traces the memory allocations of the simulation, and shows the peak\n"
+             "and the top allocation sites (implies --host-stats)")
     parser.add_argument("--hex", action="store_true",
         help="Use hex file instead of the executable file. In this case entry point is fixed to 0x0")
-    parser.add_argument("filename", type=str, help="TSC executable file name")
+    parser.add_argument("filename", type=str, nargs="?", help="TSC executable file name")
 
     args = parser.parse_args()
 
     # Argument checks
+    if args.filename is None and args.load_state is None:
+        parser.error("the following arguments are required: filename (or --load-state)")
+    if args.trace_format != TRACE_TEXT and args.trace is None:
+        parser.error(f"--trace-format {args.trace_format} requires --trace FILE")
+    if args.fast_forward is not None and args.fast_forward < 0:
+        parser.error("--fast-forward must not be negative")
+    if args.skip_loops and (args.engine != 'dbt' or args.machine != '1'):
+        parser.error("--skip-loops requires the dbt engine of the single-cycle machine")
+    if args.sample is not None:
+        if args.sample <= 0 or args.sample_k <= 0 or args.sample_per_cluster <= 0 or args.sample_warmup < 0:
+            parser.error("--sample, --sample-k and --sample-per-cluster must be positive, "
+                         "and --sample-warmup must not be negative")
+        if args.profile or args.trace or args.output or args.save_state or \
+                args.host_stats or args.host_json or args.host_phases or args.cprofile or args.tracemalloc:
+            parser.error("--sample cannot be combined with --profile, --trace, "
+                         "--output, --save-state or host statistics")
+    if args.host_phases and args.profile:
+        parser.error("--host-phases cannot be combined with --profile")
+    if args.host_phases and (args.machine == 'P' or (args.machine == '1' and args.engine != 'simple')):
+        parser.error("--host-phases requires the simple engine or the multi-cycle machine, "
+                     "the others do not run the phases apart")
+    args.host_stats = args.host_stats or bool(args.host_json or args.host_phases or
+                                              args.cprofile or args.tracemalloc)
+
     if args.log < 0 or args.log > Log.MAX_LOG_LEVEL:
         print("Invalid log level {args.log}. Valid range: 0 .. {Log.MAX_LOG_LEVEL}")
         parser.print_help()
@@ -178,10 +418,6 @@ sets the desired log level (default: %(default)s)
         print(f"         Data memory: {args.dmem_addr:08x} - {args.dmem_addr+args.dmem_size:08x}")
         exit(1)
 
-    # Set arguments
-    Log.level = args.log
-    Log.start_cycle = args.cycle
-
     return args
 
 
@@ -191,12 +427,16 @@ def load_file(cpu, adr_str, maxsize_str, filename):
         maxsize = int(maxsize_str, 0)
 
         with open(filename, 'rb') as f:
-            data = bytearray(f.read())
+            size = os.fstat(f.fileno()).st_size
 
-            if len(data) > maxsize:
+            if size > maxsize:
                 raise ValueError(f"Data of {filename} larger than maximum allowed size ({maxsize})")
 
-            cpu.dmem.copy_to(address, data)
+            # Map the file instead of reading it into a temporary buffer
+            if size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    with memoryview(data) as view:
+                        cpu.dmem.copy_to(address, view)
 
     except ValueError:
         print(f"Invalid data types in input parameter {adr_str} {maxsize_str} {filename}. "
@@ -212,10 +452,8 @@ def save_file(cpu, adr_str, size_str, filename):
         address = int(adr_str, 0)
         size = int(size_str, 0)
 
-        data = cpu.dmem.copy_from(address, size)
-
         with open(filename, 'wb') as f:
-            f.write(data)
+            cpu.dmem.write_to(f, address, size)
 
     except ValueError:
         print(f"Invalid data types in output parameter {adr_str} {size_str} {filename}. "
@@ -227,6 +465,31 @@ def save_file(cpu, adr_str, size_str, filename):
 
 
 
+def build_machine(args):
+    """
+    returns a new machine with the components selected by args
+    """
+    if args.machine == 'P':
+        try:
+            predictor = PREDICTORS[args.predictor](args.bp_entries)
+            btb = BTB(args.btb) if args.btb else None
+        except ValueError as e:
+            print(f"Invalid branch predictor configuration: {e}")
+            exit(1)
+        cpu = TSC__pipe(0, args.dmem_size, args.forwarding, predictor, btb)
+    elif args.machine == 'M':
+        cpu = TSC__multi_cycle(0, args.dmem_size)
+    else:
+        cpu = TSC__1_cycle(0, args.dmem_size, ENGINES[args.engine])
+    if args.cache:
+        try:
+            attach_caches(cpu, args.cache, args.cache_policy, args.write_policy == 'wb', args.miss_latency)
+        except ValueError as e:
+            print(f"Invalid cache configuration: {e}")
+            exit(1)
+    return cpu
+
+
 #--------------------------------------------------------------------------
 #   Simulator main
 #--------------------------------------------------------------------------
@@ -237,14 +500,32 @@ def main():
     args = parse_args(sys.argv[1:])
 
     # Instantiate CPU instance with H/W components
-    cpu = TSC__1_cycle(0, args.dmem_size)
+    cpu = build_machine(args)
+    cpu.banner()
+    cpu.log.level = args.log
+    cpu.log.start_cycle = args.cycle
+    cpu.max_cycles = args.max_cycles
+    cpu.max_time = args.max_time
+    cpu.idle = args.idle
+    cpu.skip_loops = args.skip_loops
+    if args.trace:
+        cpu.trace.open(args.trace, args.trace_format)
+    if args.mem_file:
+        cpu.dmem.map(args.mem_file)
+    if args.profile:
+        cpu.profile = Profile(cpu.dmem.mem_start, cpu.dmem.mem_end - cpu.dmem.mem_start)
+    if args.host_stats:
+        cpu.host = HostStat(args.host_phases, args.cprofile, args.tracemalloc)
 
     # Make program instance
     prog = Program()
 
     # Load the program and get its entry point
-    if args.hex:
-        load_file(cpu, '0', '512', args.filename)
+    resumed = EXC_NONE
+    if args.load_state:
+        (entry_point, resumed) = Snapshot.load(cpu, args.load_state)
+    elif args.hex:
+        load_file(cpu, '0', str((cpu.dmem.mem_end - cpu.dmem.mem_start) * WORD_SIZE), args.filename)
         entry_point = 0
     else:
         entry_point = prog.load(cpu, args.filename)
@@ -256,16 +537,62 @@ def main():
         for item in args.input:
             load_file(cpu, item[0], item[1], item[2])
 
+    # A run which ended with HLT or an exception is over: resuming it
+    # shows its results again, without executing its last instruction
+    finished = bool(resumed & Snapshot.FINAL)
+
+    # Skip to the part of interest without any detail
+    if not finished and (args.fast_forward is not None or args.ff_pc is not None):
+        start = time.perf_counter()
+        count = FastForward(cpu, args.ff_pc).run(entry_point, args.fast_forward)
+        entry_point = cpu.pc.read()
+        print(f"Fast-forwarded {count} instructions to 0x{int(entry_point):04x} "
+              f"in {time.perf_counter() - start:.3f} s")
+
+    # Simulate samples of the program in detail, instead of all of it
+    if args.sample and not finished:
+        sampler = Sampler(lambda: build_machine(args), args.sample, args.sample_k,
+                          args.sample_per_cluster, args.sample_warmup)
+        sampler.run(cpu, entry_point, args.max_cycles, args.sample_validate)
+        return
+
     # Execute program
-    cpu.run(entry_point)
+    if cpu.host is not None:
+        cpu.host.start()
+    if finished:
+        status = resumed
+        cpu.engine.finish(status)
+    else:
+        status = cpu.run(entry_point)
+    if cpu.host is not None:
+        cpu.host.stop()
+    cpu.trace.close()
 
     # Save output files
     if args.output:
         for item in args.output:
             save_file(cpu, item[0], item[1], item[2])
+    if args.save_state:
+        Snapshot.save(cpu, args.save_state, status)
+    cpu.dmem.flush()
 
     # Show statistics
-    Stat.show()
+    cpu.stat.show()
+    if cpu.icache is not None:
+        cpu.icache.show()
+    if cpu.dcache is not None and cpu.dcache is not cpu.icache:
+        cpu.dcache.show()
+    if cpu.profile is not None:
+        with (open(args.profile_out, 'w') if args.profile_out else contextlib.nullcontext(sys.stdout)) as f:
+            cpu.profile.report(cpu.dmem, args.profile_top, f)
+    if cpu.host is not None:
+        summary = cpu.host.summary(cpu, status, args.filename or args.load_state)
+        HostStat.show(summary)
+        if args.tracemalloc:
+            print("Top allocations:")
+            cpu.host.show_allocs()
+        if args.host_json:
+            HostStat.append(summary, args.host_json)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Renders JSONL/binary instruction traces written by run_tsc.py --trace
+#
+#==========================================================================
+
+import argparse
+import sys
+
+from program import *
+
+
+def main():
+
+    parser = argparse.ArgumentParser(usage='%(prog)s --help for more information')
+    parser.add_argument("--log", "-l", type=int, default=5, choices=[3, 5],
+        help="3: shows instructions only, 5: shows full information (default: %(default)s)")
+    parser.add_argument("--cycle", "-c", type=int, default=0,
+        help="shows instructions after cycle m (default: %(default)s)")
+    parser.add_argument("filename", type=str, help="trace file name (jsonl or bin)")
+    args = parser.parse_args()
+
+    out = sys.stdout
+    for (cycle, pc, inst, rd, wbdata, pc_next) in Trace.load(args.filename):
+        if cycle < args.cycle:
+            continue
+        if args.log >= 5:
+            out.write(Trace.format_full(cycle, pc, inst, rd, wbdata, pc_next) + "\n")
+        else:
+            out.write(Trace.format_inst(cycle, pc, inst) + "\n")
+
+
+if __name__ == '__main__':
+    main()
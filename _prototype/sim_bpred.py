@@ -0,0 +1,211 @@
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Branch predictors for the pipelined machine (--BP-xx)
+#
+#==========================================================================
+
+from array import array
+
+from isa import *
+from sim_consts import *
+from sim_control import *
+from program import *
+
+
+#--------------------------------------------------------------------------
+#   Direction predictors: predict BNE/BEQ/BGZ/BLZ in IF
+#--------------------------------------------------------------------------
+#
+#   predict(pc, dec) returns True when the branch at pc is predicted taken,
+#   and update(pc, dec, taken) trains the predictor with the outcome once
+#   the branch is resolved. Predictors are updated in program order (when
+#   a branch leaves EX), so their state is never speculative.
+
+class NotTaken(object):
+
+    name = 'nt'
+
+    def predict(self, pc, dec):
+        return False
+
+    def update(self, pc, dec, taken):
+        return
+
+    def describe(self):
+        return "static not-taken"
+
+
+class BTFN(NotTaken):
+
+    name = 'btfn'
+
+    def predict(self, pc, dec):
+        # Backward branches (loops) are taken, forward ones are not
+        return bool(dec[DC_IMM_I] & 0x8000)
+
+    def describe(self):
+        return "static backward-taken, forward-not-taken"
+
+
+class BHT(NotTaken):
+    """
+    a table of n-bit saturating counters, indexed by the low bits of the pc
+    """
+
+    name = 'bht'
+
+    def __init__(self, entries = 256, bits = 2):
+        if entries <= 0 or entries & (entries - 1):
+            raise ValueError(f"number of predictor entries must be a power of 2: {entries}")
+        self.entries    = entries
+        self.mask       = entries - 1
+        self.bits       = bits
+        self.max        = (1 << bits) - 1
+        self.threshold  = 1 << (bits - 1)       # taken if counter >= threshold
+        self.table      = array('B', [ self.threshold - 1 ]) * entries   # weakly not-taken
+
+    def index(self, pc):
+        return pc & self.mask
+
+    def predict(self, pc, dec):
+        return self.table[self.index(pc)] >= self.threshold
+
+    def update(self, pc, dec, taken):
+        i = self.index(pc)
+        c = self.table[i]
+        if taken:
+            if c < self.max:
+                self.table[i] = c + 1
+        elif c > 0:
+            self.table[i] = c - 1
+
+    def describe(self):
+        return "%d-bit BHT, %d entries" % (self.bits, self.entries)
+
+
+class Gshare(BHT):
+    """
+    2-bit counters indexed by the pc xor'ed with the global branch history
+    """
+
+    name = 'gshare'
+
+    def __init__(self, entries = 256):
+        BHT.__init__(self, entries, 2)
+        self.history    = 0
+
+    def index(self, pc):
+        return (pc ^ self.history) & self.mask
+
+    def update(self, pc, dec, taken):
+        BHT.update(self, pc, dec, taken)
+        self.history = ((self.history << 1) | taken) & self.mask
+
+    def describe(self):
+        return "gshare, %d entries, %d history bits" % (self.entries, self.mask.bit_length())
+
+
+#--------------------------------------------------------------------------
+#   BTB: predicts the targets of JPR/JRL in IF
+#--------------------------------------------------------------------------
+
+class BTB(object):
+
+    def __init__(self, entries = 16):
+        if entries <= 0 or entries & (entries - 1):
+            raise ValueError(f"number of BTB entries must be a power of 2: {entries}")
+        self.entries    = entries
+        self.mask       = entries - 1
+        self.tags       = array('l', [ -1 ]) * entries
+        self.targets    = array('H', [ 0 ]) * entries
+
+    def lookup(self, pc):
+        """
+        returns the last target of the jump at pc, or None
+        """
+        i = pc & self.mask
+        return self.targets[i] if self.tags[i] == pc else None
+
+    def update(self, pc, target):
+        i = pc & self.mask
+        self.tags[i]    = pc
+        self.targets[i] = target
+
+
+# Predictors for --BP, built from the number of table entries
+PREDICTORS  = {
+    'nt'        : lambda entries: NotTaken(),
+    'btfn'      : lambda entries: BTFN(),
+    '1bit'      : lambda entries: BHT(entries, 1),
+    '2bit'      : lambda entries: BHT(entries, 2),
+    'gshare'    : lambda entries: Gshare(entries),
+}
+
+
+#--------------------------------------------------------------------------
+#   Prediction in the fetch stage, shared by the pipeline and the replay
+#--------------------------------------------------------------------------
+
+def predict_next(predictor, btb, pc, dec):
+    """
+    returns the predicted address of the instruction after the one at pc.
+    dec is None for an instruction that cannot be decoded.
+    """
+    pc_plus1 = (pc + 1) & 0xffff
+    if dec is None or dec[DC_CLASS] != CL_CTRL:
+        return pc_plus1
+    br_type = dec[DC_CS][CS_BR_TYPE]
+    if br_type == BrJ_B:
+        if predictor.predict(pc, dec):
+            return (pc + 1 + dec[DC_IMM_I]) & 0xffff
+    elif br_type == BrJ_I and btb is not None:
+        target = btb.lookup(pc)
+        if target is not None:
+            return target
+    return pc_plus1
+
+
+def resolve(predictor, btb, pc, dec, pc_next):
+    """
+    trains the predictors with the actual next pc of the control transfer
+    at pc
+    """
+    br_type = dec[DC_CS][CS_BR_TYPE]
+    if br_type == BrJ_B:
+        predictor.update(pc, dec, pc_next != ((pc + 1) & 0xffff))
+    elif br_type == BrJ_I and btb is not None:
+        btb.update(pc, pc_next)
+
+
+#--------------------------------------------------------------------------
+#   Replay: evaluates predictors on a recorded instruction trace
+#--------------------------------------------------------------------------
+
+def branch_stream(filename):
+    """
+    returns [ (pc, dec, pc_next), ... ] for the branches and register jumps
+    of a jsonl/bin trace written by run_tsc.py --trace
+    """
+    stream = []
+    for (cycle, pc, inst, rd, wbdata, pc_next) in Trace.load(filename):
+        dec = decode_table[inst]
+        if dec is None or dec[DC_CS] is None or dec[DC_CLASS] != CL_CTRL:
+            continue
+        if dec[DC_CS][CS_BR_TYPE] in (BrJ_B, BrJ_I):
+            stream.append((pc, dec, pc_next))
+    return stream
+
+
+def replay(stream, predictor, btb = None):
+    """
+    runs a branch stream through a predictor, returns (predictions,
+    mispredictions)
+    """
+    mispredicts = 0
+    for (pc, dec, pc_next) in stream:
+        if predict_next(predictor, btb, pc, dec) != pc_next:
+            mispredicts += 1
+        resolve(predictor, btb, pc, dec, pc_next)
+    return len(stream), mispredicts
@@ -58,6 +58,24 @@ IN_TYPE             = 2
 IN_CLASS            = 3
 
 
+#--------------------------------------------------------------------------
+#   Decode table index
+#--------------------------------------------------------------------------
+
+DC_OPCODE           = 0
+DC_CLASS            = 1
+DC_TYPE             = 2
+DC_CS               = 3
+DC_RS               = 4
+DC_RT               = 5
+DC_RD               = 6
+DC_IMM_I            = 7         # sign-extended, as a 16-bit pattern
+DC_IMM_S            = 8         # sign-extended, as a signed integer
+DC_IMM_U            = 9
+DC_IMM_H            = 10
+DC_IMM_J            = 11
+
+
 #--------------------------------------------------------------------------
 #   ISA table[IN_TYPE]: Instruction types for disassembling
 #--------------------------------------------------------------------------
@@ -133,6 +151,7 @@ STATE_M1 = STATE_MM = 4
 STATE_M2            = 5
 STATE_WB            = 6
 STATE_HLT           = 7
+STATE_X             = 0         # don't care (back to STATE_IF)
 
 
 #--------------------------------------------------------------------------
@@ -278,13 +297,26 @@ EXC_IMEM_ERROR      = 1
 EXC_DMEM_ERROR      = 2
 EXC_ILLEGAL_INST    = 4
 EXC_HALT            = 8
+EXC_LIMIT           = 16        # cycle limit (--max-cycles) reached
+EXC_IDLE            = 32        # stationary loop detected (--idle)
+EXC_TIMEOUT         = 64        # wall-clock limit (--max-time) reached
 
 EXC_MSG = {         EXC_IMEM_ERROR:     "imem access error", 
                     EXC_DMEM_ERROR:     "dmem access error",
                     EXC_ILLEGAL_INST:   "illegal instruction",
                     EXC_HALT:           "halt",
+                    EXC_LIMIT:          "cycle limit",
+                    EXC_IDLE:           "idle loop",
+                    EXC_TIMEOUT:        "time limit",
           }
 
+# Handling of stationary loops (--idle)
+IDLE_SKIP           = 'skip'    # skip ahead to the cycle limit, or stop without one
+IDLE_STOP           = 'stop'    # stop with EXC_IDLE
+IDLE_OFF            = 'off'     # keep simulating
+
+IDLE_MODES          = [ IDLE_SKIP, IDLE_STOP, IDLE_OFF ]
+
 # Forwarding source
 FWD_NONE            = 0
 FWD_EX              = 1
@@ -24,42 +24,68 @@ from sim_consts import *
 csignals = {
     #               <-- *----* -- Control Signals -- *----* -->    <-- *----* -- Datapath Signals -- *----* -->
     #                       <-- Br Cond -->  <-- Hazard Cond --> <-- Operands -->         <- EX ->  <--  MM  -->
-    ##      valid, Target,   Mask,    Match,                                                                     HLT
-    BNE     : [ Y, BrJ_B, ZF_MASK, BNE_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_RT, DEST_X,  ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_X, ],
-    BEQ     : [ Y, BrJ_B, ZF_MASK, BEQ_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_RT, DEST_X,  ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_X, ],
-    BGZ     : [ Y, BrJ_B, SZ_MASK, BGZ_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_X, WB_X, ],
-    BLZ     : [ Y, BrJ_B, SZ_MASK, BLZ_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_X, WB_X, ],
+    ##      valid, Target,   Mask,    Match,                                                                     HLT               <-- Next State (TSC-M0) -->
+    ##                                                                                                                             ID,       RR,       EX,       MM
+    BNE     : [ Y, BrJ_B, ZF_MASK, BNE_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_RT, DEST_X,  ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_X,   STATE_EX, STATE_X,  STATE_IF, STATE_X, ],
+    BEQ     : [ Y, BrJ_B, ZF_MASK, BEQ_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_RT, DEST_X,  ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_X,   STATE_EX, STATE_X,  STATE_IF, STATE_X, ],
+    BGZ     : [ Y, BrJ_B, SZ_MASK, BGZ_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_X, WB_X,   STATE_EX, STATE_X,  STATE_IF, STATE_X, ],
+    BLZ     : [ Y, BrJ_B, SZ_MASK, BLZ_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_X, WB_X,   STATE_EX, STATE_X,  STATE_IF, STATE_X, ],
 
-    ADI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IM, DEST_RT, ALU_ADD, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    ORI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IL, DEST_RT, ALU_OR,  MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    LHI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_1, OP1_RS, OP2_IH, DEST_RT, ALU_IDB, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
+    ADI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IM, DEST_RT, ALU_ADD, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    ORI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IL, DEST_RT, ALU_OR,  MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    LHI     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_1, OP1_RS, OP2_IH, DEST_RT, ALU_IDB, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
 
-    LWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IM, DEST_RT, ALU_ADD, MEN_1, M_XRD, N, IO_X, WB_MEM, ],
-    SWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_IM, DEST_X,  ALU_ADD, MEN_1, M_XWR, N, IO_X, WB_X, ],
+    LWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_IM, DEST_RT, ALU_ADD, MEN_1, M_XRD, N, IO_X, WB_MEM, STATE_EX, STATE_X,  STATE_MM, STATE_WB, ],
+    SWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_0, OP1_RS, OP2_IM, DEST_X,  ALU_ADD, MEN_1, M_XWR, N, IO_X, WB_X,   STATE_EX, STATE_X,  STATE_MM, STATE_IF, ],
 
-    JMP     : [ Y, BrJ_J, NC_MASK, ALL_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X, ],
-    JAL     : [ Y, BrJ_J, NC_MASK, ALL_COND, OEN_0, OEN_0, REN_1, OP1_X,  OP2_X,  DEST_R2, ALU_X,   MEN_0, M_NOP, N, IO_X, WB_PC1, ],
+    JMP     : [ Y, BrJ_J, NC_MASK, ALL_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X,   STATE_IF, STATE_X,  STATE_X,  STATE_X, ],
+    JAL     : [ Y, BrJ_J, NC_MASK, ALL_COND, OEN_0, OEN_0, REN_1, OP1_X,  OP2_X,  DEST_R2, ALU_X,   MEN_0, M_NOP, N, IO_X, WB_PC1, STATE_WB, STATE_X,  STATE_X,  STATE_X, ],
     
-    ADD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_ADD, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    SUB     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    AND     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_AND, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    ORR     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_OR,  MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    NOT     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_N1, DEST_RD, ALU_XOR, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    TCP     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_0,  OP2_RS, DEST_RD, ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    SHL     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_P1, DEST_RD, ALU_SLL, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
-    SHR     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_P1, DEST_RD, ALU_SRA, MEN_0, M_NOP, N, IO_X, WB_ALU, ],
+    ADD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_ADD, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    SUB     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    AND     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_AND, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    ORR     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_1, REN_1, OP1_RS, OP2_RT, DEST_RD, ALU_OR,  MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    NOT     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_N1, DEST_RD, ALU_XOR, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    TCP     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_0,  OP2_RS, DEST_RD, ALU_SUB, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    SHL     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_P1, DEST_RD, ALU_SLL, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
+    SHR     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_P1, DEST_RD, ALU_SRA, MEN_0, M_NOP, N, IO_X, WB_ALU, STATE_EX, STATE_X,  STATE_WB, STATE_X, ],
 
-    NOP     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X, ],
+    NOP     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X,   STATE_IF, STATE_X,  STATE_X,  STATE_X, ],
 
-    JPR     : [ Y, BrJ_I, NC_MASK, ALL_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X, ],
-    JRL     : [ Y, BrJ_I, NC_MASK, ALL_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_X,  DEST_R2, ALU_X,   MEN_0, M_NOP, N, IO_X, WB_PC1, ],
+    JPR     : [ Y, BrJ_I, NC_MASK, ALL_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, N, IO_X, WB_X,   STATE_IF, STATE_X,  STATE_X,  STATE_X, ],
+    JRL     : [ Y, BrJ_I, NC_MASK, ALL_COND, OEN_1, OEN_0, REN_1, OP1_RS, OP2_X,  DEST_R2, ALU_X,   MEN_0, M_NOP, N, IO_X, WB_PC1, STATE_WB, STATE_X,  STATE_X,  STATE_X, ],
 
-    RWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_1, OP1_X,  OP2_X,  DEST_RD, ALU_X,   MEN_0, M_NOP, N, IO_R, WB_IOP, ],
-    WWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_W, WB_X, ],
+    RWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_1, OP1_X,  OP2_X,  DEST_RD, ALU_X,   MEN_0, M_NOP, N, IO_R, WB_IOP, STATE_WB, STATE_X,  STATE_X,  STATE_X, ],
+    WWD     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_1, OEN_0, REN_0, OP1_RS, OP2_X,  DEST_X,  ALU_IDA, MEN_0, M_NOP, N, IO_W, WB_X,   STATE_EX, STATE_X,  STATE_IF, STATE_X, ],
 
-    HLT     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, Y, IO_X, WB_X, ],
+    HLT     : [ Y, BrJ_N, NC_MASK, NOT_COND, OEN_0, OEN_0, REN_0, OP1_X,  OP2_X,  DEST_X,  ALU_X,   MEN_0, M_NOP, Y, IO_X, WB_X,   STATE_HLT,STATE_X,  STATE_X,  STATE_X, ],
 
     # Custom extensions
     # TODO
 }
 
+
+#--------------------------------------------------------------------------
+#   Decode table: fully decoded fields of every 16-bit instruction word
+#--------------------------------------------------------------------------
+
+def decode(inst):
+    """
+    decode a single instruction word into a decode table entry
+    """
+    opcode  = opcode_table[inst]
+    if opcode == ILLEGAL:
+        return None
+    info    = isa[opcode]
+    imm_i   = TSC.sign_extend(inst & 0xff, 8)
+    return ( opcode, info[IN_CLASS], info[IN_TYPE], csignals.get(opcode),
+             (inst >> RS_SHIFT) & 0x3,
+             (inst >> RT_SHIFT) & 0x3,
+             (inst >> RD_SHIFT) & 0x3,
+             imm_i,
+             imm_i - 0x10000 if imm_i & 0x8000 else imm_i,
+             inst & 0xff,
+             (inst & 0xff) << 8,
+             inst & 0xfff, )
+
+decode_table = [ decode(inst) for inst in range(1 << BITWIDTH) ]
@@ -0,0 +1,622 @@
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Dynamic translation of TSC basic blocks into Python functions
+#
+# + based on: -------------------------------------------------------------
+#   The PyRISC Project
+#       by Jin-Soo Kim
+#   https://github.com/snu-csl/pyrisc
+#
+#==========================================================================
+
+import math
+import sys
+import time
+
+from isa import *
+from sim_consts import *
+from sim_control import *
+from sim_modules import *
+from program import *
+from sim_machines import *
+
+
+#--------------------------------------------------------------------------
+#   Constants
+#--------------------------------------------------------------------------
+
+# Python expressions for each ALU function on plain ints ({a}: alu1, {b}: alu2)
+ALU_EXPR = {
+    ALU_ADD     : "({a} + {b}) & 0xffff",
+    ALU_SUB     : "({a} - {b}) & 0xffff",
+    ALU_AND     : "{a} & {b}",
+    ALU_OR      : "{a} | {b}",
+    ALU_XOR     : "{a} ^ {b}",
+    ALU_SLT     : "(1 if ({a} ^ 0x8000) < ({b} ^ 0x8000) else 0)",
+    ALU_SLTU    : "(1 if {a} < {b} else 0)",
+    ALU_SLL     : "({a} << ({b} & 0x1f)) & 0xffff",
+    ALU_SRA     : "((({a} ^ 0x8000) - 0x8000) >> ({b} & 0x1f)) & 0xffff",
+    ALU_SRL     : "{a} >> ({b} & 0x1f)",
+    ALU_COPY1   : "{a}",
+    ALU_COPY2   : "{b}",
+    ALU_X       : "0",
+}
+
+
+#--------------------------------------------------------------------------
+#   CountedLoop: closed-form iteration of a block which loops on itself
+#--------------------------------------------------------------------------
+#
+#   The registers are handled as the vector x = (1, r0, r1, r2, r3), and a
+#   value affine in them (mod 2^16) as its row of coefficients. If every
+#   ALU instruction of the block is affine, one iteration maps x to M x,
+#   and n iterations to M^n x. If the value tested by the closing branch
+#   also moves by a fixed step per iteration, the number of iterations
+#   left follows from that value alone.
+
+# Value classes of the branch flags, as (first value, number of values, flags)
+FLAG_CLASSES = [ (0x0000, 0x0001, 0b01),        # zero
+                 (0x0001, 0x7fff, 0b00),        # positive
+                 (0x8000, 0x8000, 0b10) ]       # negative
+
+def _const(value):
+    return (value & 0xffff, 0, 0, 0, 0)
+
+def _combine(a, b, k):
+    return tuple((x + k * y) & 0xffff for (x, y) in zip(a, b))
+
+def _is_const(a):
+    return not any(a[1:])
+
+def _affine(alufun, a, b):
+    """
+    returns the ALU output for the affine operands a and b, or None if it
+    is not affine
+    """
+    if _is_const(a) and _is_const(b):
+        return _const(eval(ALU_EXPR[alufun].format(a = a[0], b = b[0])))
+    if alufun == ALU_ADD:
+        return _combine(a, b, 1)
+    if alufun == ALU_SUB:
+        return _combine(a, b, -1)
+    if alufun == ALU_COPY1:
+        return a
+    if alufun == ALU_COPY2:
+        return b
+    if alufun == ALU_X:
+        return _const(0)
+    if _is_const(b):
+        k = b[0]
+        if alufun == ALU_SLL:
+            return _combine(_const(0), a, 1 << (k & 0x1f))
+        if alufun == ALU_XOR and k == 0xffff:
+            return _combine(_const(0xffff), a, -1)
+        if (alufun in (ALU_OR, ALU_XOR) and k == 0) or (alufun == ALU_AND and k == 0xffff):
+            return a
+        if alufun == ALU_AND and k == 0:
+            return _const(0)
+    return None
+
+def counted_loop(entry, insts):
+    """
+    returns a CountedLoop for the block at entry made of insts, or None if
+    it is not a loop which can be iterated in closed form
+    """
+    if not insts:
+        return None
+    (pc, inst, dec) = insts[-1]
+    cs = dec[DC_CS]
+    if cs[CS_BR_TYPE] != BrJ_B or (pc + 1 + dec[DC_IMM_I]) & 0xffff != entry:
+        return None
+
+    # Run the body symbolically. Loads and stores fall back to stepping.
+    regs = [ tuple(int(i == r + 1) for i in range(5)) for r in range(NUM_REGS) ]
+    for (pc, inst, dec) in insts[:-1]:
+        if dec[DC_CLASS] != CL_ALU:
+            return None
+        cs      = dec[DC_CS]
+        rs      = regs[dec[DC_RS]]
+        op1     = cs[CS_OP1_SEL]
+        op2     = cs[CS_OP2_SEL]
+        alu1    = rs                        if op1 == OP1_RS     else \
+                  _const(pc)                if op1 == OP1_PC     else \
+                  _const(0)
+        alu2    = regs[dec[DC_RT]]          if op2 == OP2_RT     else \
+                  rs                        if op2 == OP2_RS     else \
+                  _const(dec[DC_IMM_I])     if op2 == OP2_IM     else \
+                  _const(dec[DC_IMM_U])     if op2 == OP2_IL     else \
+                  _const(dec[DC_IMM_H])     if op2 == OP2_IH     else \
+                  _const(0xffff)            if op2 == OP2_N1     else \
+                  _const(1)                 if op2 == OP2_P1     else \
+                  _const(0)
+        dest    = cs[CS_DEST_SEL]
+        rdest   = dec[DC_RD]                if dest == DEST_RD   else \
+                  dec[DC_RT]                if dest == DEST_RT   else \
+                  2                         if dest == DEST_R2   else \
+                  0
+        value   = _affine(cs[CS_ALU_FUN], alu1, alu2)
+        if value is None:
+            return None
+        regs[rdest] = value
+
+    # The branch value must move by a fixed step: test(M x) = test(x) + step
+    cs      = insts[-1][2][DC_CS]
+    test    = _affine(cs[CS_ALU_FUN], regs[insts[-1][2][DC_RS]], regs[insts[-1][2][DC_RT]])
+    if test is None:
+        return None
+    matrix  = [ _const(1) ] + regs
+    moved   = tuple(sum(test[k] * matrix[k][j] for k in range(5)) & 0xffff for j in range(5))
+    step    = _combine(moved, test, -1)
+    if not _is_const(step):
+        return None
+
+    # The values for which the branch is taken form one arc of the circle
+    # of 16-bit values, which starts at the first class taken after one
+    # that is not
+    taken   = [ (flags & cs[CS_BR_MASK]) == cs[CS_BR_COND] for (_, _, flags) in FLAG_CLASSES ]
+    if not any(taken):
+        return None
+    if all(taken):
+        first, size = 0, 0x10000
+    else:
+        k = next(k for k in range(3) if taken[k] and not taken[k - 1])
+        first, size = FLAG_CLASSES[k][0], 0
+        while taken[k % 3]:
+            size += FLAG_CLASSES[k % 3][1]
+            k += 1
+
+    alu = sum(dec[DC_CLASS] == CL_ALU for (_, _, dec) in insts)
+    return CountedLoop(matrix, test, step[0], first, size, len(insts), alu)
+
+
+class CountedLoop(object):
+
+    def __init__(self, matrix, test, step, first, size, length, alu):
+        self.powers = [ matrix ]    # M^(2^i)
+        self.test   = test          # the branch value, affine in x
+        self.step   = step          # its change per iteration
+        self.first  = first         # the branch is taken for the values
+        self.size   = size          #   first .. first + size - 1 (mod 2^16)
+        self.length = length        # instructions per iteration
+        self.alu    = alu           # ALU instructions per iteration
+
+    def trips(self, value):
+        """
+        returns the number of iterations before the first one whose branch
+        falls through, given the branch value of the next one: sys.maxsize
+        if there is none, or None if it cannot be told without stepping
+        """
+        size    = self.size
+        offset  = (value - self.first) & 0xffff
+        if offset >= size:
+            return 0
+        step    = self.step
+        if size == 0x10000 or step == 0:
+            return sys.maxsize
+
+        # Walk up the arc (mirrored for negative steps), until the value
+        # lands in the gap of 0x10000 - size values after it
+        gap     = 0x10000 - size
+        if step & 0x8000:
+            offset, step = size - 1 - offset, 0x10000 - step
+        if step <= gap:
+            return (size - offset + step - 1) // step
+
+        # Larger steps may jump over the gap. A gap of one value (BNE) is
+        # hit when offset + n * step = size (mod 2^16).
+        if gap == 1:
+            g       = math.gcd(step, 0x10000)
+            need    = size - offset
+            if need % g:
+                return sys.maxsize
+            m       = 0x10000 // g
+            return need // g * pow(step // g, -1, m) % m
+        return None
+
+    def skip(self, reg, budget):
+        """
+        runs up to budget (None: no limit) iterations of the loop on the
+        registers reg, all of which branch back. Returns their number.
+        """
+        x       = [ 1 ] + reg
+        n       = self.trips(sum(t * v for (t, v) in zip(self.test, x)) & 0xffff)
+        if n is None or (n == sys.maxsize and budget is None):
+            return 0
+        if budget is not None:
+            n = min(n, budget)
+
+        bit     = 0
+        while n >> bit:
+            if bit == len(self.powers):
+                p = self.powers[-1]
+                self.powers.append([ tuple(sum(p[i][k] * p[k][j] for k in range(5)) & 0xffff
+                                           for j in range(5)) for i in range(5) ])
+            if (n >> bit) & 1:
+                p = self.powers[bit]
+                x = [ sum(p[i][k] * x[k] for k in range(5)) & 0xffff for i in range(5) ]
+            bit += 1
+        reg[:] = x[1:]
+        return n
+
+
+#--------------------------------------------------------------------------
+#   DBT: runs the single-cycle CPU by translating basic blocks
+#--------------------------------------------------------------------------
+
+class DBT(Fast):
+
+    MAX_BLOCK_SIZE  = 64        # max. number of instructions in a block
+
+    stop_pc         = None      # blocks end right before this pc
+
+    def run(self, entry_point):
+
+        cpu         = self.cpu
+        stat        = self.stat
+
+        # Translated blocks retire many instructions at once, so there is
+        # nothing to trace or profile per instruction, and no cache to look
+        # up per access: leave such runs to Fast.
+        if cpu.log.level >= 3 or cpu.icache is not None or cpu.dcache is not None \
+                or cpu.profile is not None:
+            return Fast.run(self, entry_point)
+
+        # Memory may have changed since the last run: start from scratch
+        self.reset()
+        reg         = [ int(v) for v in cpu.rf.reg ]
+        pages       = cpu.dmem.pages
+        blocks      = self.blocks
+        pc          = int(entry_point) & 0xffff
+
+        # Blocks run whole: stop translating once the next block could
+        # cross cpu.max_cycles, and step the rest of the way with Fast.
+        horizon     = sys.maxsize if cpu.max_cycles is None else \
+                      cpu.max_cycles - stat.cycle - DBT.MAX_BLOCK_SIZE
+        deadline    = self.time_limit()
+        until       = horizon if deadline is None else min(horizon, Simple.TIME_SLICE)
+        idle        = self.detect_idle()
+        seen        = None
+        stores      = 0
+        loops       = cpu.skip_loops
+        last        = None
+
+        icount      = 0
+        inst_alu    = 0
+        inst_mem    = 0
+        inst_ctrl   = 0
+
+        status      = EXC_NONE
+        while True:
+            if icount > until:
+                if icount > horizon:
+                    break
+                if time.perf_counter() >= deadline:
+                    status = EXC_TIMEOUT
+                    break
+                until = min(horizon, icount + Simple.TIME_SLICE)
+
+            blk = blocks.get(pc)
+            if blk is None:
+                blk = self.translate(pc)
+
+            status, pc_next, n, smc_addr = blk[0](reg, pages)
+
+            icount      += n
+            inst_alu    += blk[1][n]
+            inst_mem    += blk[2][n]
+            inst_ctrl   += blk[3][n]
+            stores      += blk[6][n]
+
+            if smc_addr is not None:
+                self.invalidate(smc_addr)
+
+            if not status == EXC_NONE:
+                pc = pc_next
+                break
+
+            # A block which jumps back to its entry or before it may close
+            # a stationary loop (see Simple.loop_idle)
+            if idle and pc_next <= pc:
+                key = (pc_next, stores, *reg)
+                if key != seen:
+                    seen    = key
+                    since   = (icount, inst_alu, inst_mem, inst_ctrl)
+                else:
+                    times   = self.idle_loop(pc_next, icount - since[0], stat.cycle + icount, 1)
+                    if times is None:
+                        status  = EXC_IDLE
+                        pc      = pc_next
+                        break
+                    icount     += (icount - since[0]) * times
+                    inst_alu   += (inst_alu - since[1]) * times
+                    inst_mem   += (inst_mem - since[2]) * times
+                    inst_ctrl  += (inst_ctrl - since[3]) * times
+
+            # On entering a counted loop, run the iterations which branch
+            # back at once
+            loop = blk[7]
+            if loops and loop is not None and pc_next == pc and last != pc:
+                n = loop.skip(reg, None if cpu.max_cycles is None else
+                                   max(0, horizon - icount) // loop.length)
+                icount      += n * loop.length
+                inst_alu    += n * loop.alu
+                inst_ctrl   += n
+            last = pc
+            pc = pc_next
+
+        # Update stats
+        stat.cycle      += icount
+        stat.icount     += icount
+        stat.inst_alu   += inst_alu
+        stat.inst_mem   += inst_mem
+        stat.inst_ctrl  += inst_ctrl
+
+        self.sync(reg, pc)
+        if status == EXC_NONE:
+            return Fast.run(self, pc)
+        self.finish(status)
+        return status
+
+    def __init__(self, cpu):
+        Fast.__init__(self, cpu)
+        self.reset()
+
+    def reset(self):
+        """
+        drops all translated blocks
+        """
+        cpu             = self.cpu
+        self.dmem       = cpu.dmem
+        self.mem_start  = int(cpu.dmem.mem_start)
+        self.mem_end    = int(cpu.dmem.mem_end)
+        self.blocks     = {}    # entry pc -> (func, alu, mem, ctrl, first, last, stores, loop)
+        self.owners     = [ None ] * (self.mem_end - self.mem_start)
+        self.env        = { 'owners': self.owners, 'page': cpu.dmem.page,
+                            'zero_page': Memory.ZERO_PAGE }
+
+    def fetch(self, pc):
+        """
+        returns the instruction word at pc, or None if pc is out of range
+        """
+        if pc < self.mem_start or pc >= self.mem_end:
+            return None
+        offset = pc - self.mem_start
+        return self.dmem.pages[offset >> Memory.PAGE_SHIFT][offset & Memory.PAGE_MASK]
+
+    def translate(self, entry):
+        """
+        translates the basic block starting at entry and caches it
+        """
+        blk     = self.compile(entry, DBT.MAX_BLOCK_SIZE)
+        first   = blk[4]
+        last    = blk[5]
+
+        # Track which words belong to translated code, for SWD invalidation
+        if 0 <= first < len(self.owners):
+            for offset in range(first, last + 1):
+                if self.owners[offset] is None:
+                    self.owners[offset] = set()
+                self.owners[offset].add(entry)
+
+        self.blocks[entry] = blk
+        return blk
+
+    def compile(self, entry, max_size):
+        """
+        translates the basic block of at most max_size instructions starting
+        at entry, returns (func, alu, mem, ctrl, first, last, stores, loop)
+        """
+        start   = self.mem_start
+        end     = self.mem_end
+        insts   = []
+        pc      = entry
+
+        # Find the block: it ends after a control transfer instruction, or
+        # right before an instruction that cannot be fetched or decoded.
+        # It also ends at 0xffff, so that its words are contiguous in
+        # owners (translate, invalidate).
+        while len(insts) < max_size:
+            if insts and (pc == self.stop_pc or pc == 0):
+                break
+            inst = self.fetch(pc)
+            dec = None if inst is None else decode_table[inst]
+            if dec is None or dec[DC_CS] is None:
+                break
+            insts.append((pc, inst, dec))
+            pc = (pc + 1) & 0xffff
+            if dec[DC_CLASS] == CL_CTRL:
+                break
+
+        code    = [ "def block(r, m):",
+                    "    r0, r1, r2, r3 = r" ]
+
+        def leave(status, pc_next, n, smc = "None", indent = "    "):
+            code.append(indent + "r[:] = r0, r1, r2, r3")
+            code.append(indent + "return (%d, %s, %d, %s)" % (status, pc_next, n, smc))
+
+        for k, (pc, inst, dec) in enumerate(insts):
+            cs          = dec[DC_CS]
+            rs          = "r%d" % dec[DC_RS]
+            rt          = "r%d" % dec[DC_RT]
+            pc_plus1    = (pc + 1) & 0xffff
+            n           = k + 1
+
+            code.append("    # 0x%04x: %s" % (pc, Program.disasm(pc, inst)))
+
+            if dec[DC_CLASS] == CL_ALU:
+                op1     = cs[CS_OP1_SEL]
+                op2     = cs[CS_OP2_SEL]
+                alu1    = rs                        if op1 == OP1_RS     else \
+                          str(pc)                   if op1 == OP1_PC     else \
+                          "0"
+                alu2    = rt                        if op2 == OP2_RT     else \
+                          rs                        if op2 == OP2_RS     else \
+                          str(dec[DC_IMM_I])        if op2 == OP2_IM     else \
+                          str(dec[DC_IMM_U])        if op2 == OP2_IL     else \
+                          str(dec[DC_IMM_H])        if op2 == OP2_IH     else \
+                          "0xffff"                  if op2 == OP2_N1     else \
+                          "1"                       if op2 == OP2_P1     else \
+                          "0"
+                dest    = cs[CS_DEST_SEL]
+                rdest   = dec[DC_RD]                if dest == DEST_RD   else \
+                          dec[DC_RT]                if dest == DEST_RT   else \
+                          2                         if dest == DEST_R2   else \
+                          0
+                code.append("    r%d = %s" % (rdest,
+                            ALU_EXPR[cs[CS_ALU_FUN]].format(a = alu1, b = alu2)))
+
+            elif dec[DC_CLASS] == CL_MEM:
+                code.append("    a = %s + %d" % (rs, dec[DC_IMM_S]))
+                code.append("    if a < %d or a >= %d:" % (start, end))
+                leave(EXC_DMEM_ERROR, pc, n, indent = "        ")
+                code.append("    o = a - %d" % start)
+                if cs[CS_MEM_FCN] == M_XRD:
+                    code.append("    %s = m[o >> %d][o & %d]" % (rt, Memory.PAGE_SHIFT, Memory.PAGE_MASK))
+                else:
+                    code.append("    p = m[o >> %d]" % Memory.PAGE_SHIFT)
+                    code.append("    if p is zero_page:")
+                    code.append("        p = page(o >> %d)" % Memory.PAGE_SHIFT)
+                    code.append("    p[o & %d] = %s" % (Memory.PAGE_MASK, rt))
+                    code.append("    if owners[o]:")
+                    leave(EXC_NONE, pc_plus1, n, "a", indent = "        ")
+
+            else:
+                if cs[CS_HALT]:
+                    leave(EXC_HALT, pc, n)
+                    break
+
+                br_type = cs[CS_BR_TYPE]
+                if br_type == BrJ_I:
+                    code.append("    t = %s" % rs)
+                if cs[CS_RF_WEN]:
+                    dest    = cs[CS_DEST_SEL]
+                    rdest   = dec[DC_RD]            if dest == DEST_RD   else \
+                              dec[DC_RT]            if dest == DEST_RT   else \
+                              2                     if dest == DEST_R2   else \
+                              0
+                    code.append("    r%d = %d" % (rdest,
+                                pc_plus1 if cs[CS_WB_SEL] == WB_PC1 else 0))
+
+                if br_type == BrJ_B:
+                    code.append("    v = %s" % ALU_EXPR[cs[CS_ALU_FUN]].format(a = rs, b = rt))
+                    code.append("    f = (1 if v == 0 else 0) | (2 if v & 0x8000 else 0)")
+                    pc_next = "(%d if (f & %d) == %d else %d)" % (
+                              (pc + 1 + dec[DC_IMM_I]) & 0xffff,
+                              cs[CS_BR_MASK], cs[CS_BR_COND], pc_plus1)
+                elif br_type == BrJ_J:
+                    pc_next = "%d" % ((pc & 0xf000) | dec[DC_IMM_J])
+                elif br_type == BrJ_I:
+                    pc_next = "t"
+                else:
+                    pc_next = "%d" % pc_plus1
+                leave(EXC_NONE, pc_next, n)
+                break
+        else:
+            # Fell off the end of the block without a control transfer
+            if insts:
+                leave(EXC_NONE, "%d" % ((insts[-1][0] + 1) & 0xffff), len(insts))
+
+        if not insts:
+            # The entry itself cannot be executed: retire it as a fault
+            status = EXC_IMEM_ERROR if self.fetch(entry) is None else EXC_ILLEGAL_INST
+            leave(status, entry, 1)
+
+        source = "\n".join(code) + "\n"
+
+        env = dict(self.env)
+        exec(source, env)
+
+        # Instruction class and store counts of the first n instructions
+        # of the block
+        count = [ [ 0 ], [ 0 ], [ 0 ] ]
+        stores = [ 0 ]
+        for (_, _, dec) in insts:
+            for cl in (CL_ALU, CL_MEM, CL_CTRL):
+                count[cl].append(count[cl][-1] + (dec[DC_CLASS] == cl))
+            stores.append(stores[-1] + (dec[DC_CS][CS_MEM_FCN] == M_XWR))
+        if not insts:
+            for cl in (CL_ALU, CL_MEM, CL_CTRL):
+                count[cl].append(0)
+            stores.append(0)
+
+        first   = entry - start
+        last    = first + max(len(insts), 1) - 1
+        return ( env['block'], count[CL_ALU], count[CL_MEM], count[CL_CTRL], first, last, stores,
+                 counted_loop(entry, insts) )
+
+    def invalidate(self, addr):
+        """
+        drops every translated block which contains the word at addr
+        """
+        for entry in list(self.owners[addr - self.mem_start]):
+            blk = self.blocks.pop(entry)
+            for offset in range(blk[4], blk[5] + 1):
+                self.owners[offset].discard(entry)
+
+
+#--------------------------------------------------------------------------
+#   FastForward: runs the program functionally up to a point of interest
+#--------------------------------------------------------------------------
+#
+#   Runs translated blocks with no logs, stats, caches or timing, then
+#   leaves the registers, pc and memory in the machine so that its own
+#   engine can continue in detail from there (--fast-forward, --ff-pc).
+
+class FastForward(DBT):
+
+    def __init__(self, cpu, stop_pc = None):
+        DBT.__init__(self, cpu)
+        self.stop_pc    = None if stop_pc is None else stop_pc & 0xffff
+
+    def run(self, entry_point, count = None):
+        """
+        runs from entry_point until count instructions have been executed
+        or the pc reaches stop_pc, returns the number of instructions run.
+        An instruction which stops the program (HLT or an exception) is
+        not run, so that the detailed engine runs it and reports it.
+        """
+        self.reset()
+        return self.advance(entry_point, count)
+
+    def advance(self, entry_point, count = None, bbv = None):
+        """
+        same as run, but keeps the blocks translated so far. This is right as long
+        as nothing else wrote the memory since the last call. The number of
+        instructions run in each block is added to bbv[entry pc], if given.
+        """
+        reg         = [ int(v) for v in self.cpu.rf.reg ]
+        pages       = self.cpu.dmem.pages
+        blocks      = self.blocks
+        stop_pc     = self.stop_pc
+        pc          = int(entry_point) & 0xffff
+        count       = sys.maxsize if count is None else count
+
+        # Whole blocks while they cannot overshoot count, then one
+        # instruction at a time
+        horizon     = count - DBT.MAX_BLOCK_SIZE
+        icount      = 0
+        while icount < count and pc != stop_pc:
+            if icount <= horizon:
+                blk = blocks.get(pc)
+                if blk is None:
+                    blk = self.translate(pc)
+            else:
+                blk = self.compile(pc, 1)
+
+            status, pc_next, n, smc_addr = blk[0](reg, pages)
+            if smc_addr is not None:
+                self.invalidate(smc_addr)
+            if not status == EXC_NONE:
+                # Blocks stop at the pc of the faulting instruction
+                n -= 1
+            if bbv is not None and n:
+                bbv[pc] = bbv.get(pc, 0) + n
+            icount += n
+            pc = pc_next
+            if not status == EXC_NONE:
+                break
+
+        self.sync(reg, pc)
+        return icount
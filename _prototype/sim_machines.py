@@ -12,12 +12,157 @@
 #==========================================================================
 
 import sys
+import time
 
 from isa import *
 from sim_consts import *
 from sim_control import *
 from sim_modules import *
 from program import *
+from sim_bpred import *
+
+
+#--------------------------------------------------------------------------
+#   Handlers: the execution of each opcode, generated from csignals
+#--------------------------------------------------------------------------
+#
+#   handler_source() resolves the operand muxes, the ALU function, the
+#   destination register and the writeback of an opcode from its control
+#   signals, and returns the source of a handler which does only what the
+#   opcode needs. The handlers are compiled once, when this module is
+#   loaded, and bound to the datapath of each Simple by make(self, cpu).
+#   HANDLER_SOURCE holds the generated code for reading. QUIET_HANDLERS
+#   do not call self.log at all, for the runs which log no instruction.
+
+# Operand muxes as expressions over the decoded fields
+OP1_EXPR    = {
+    OP1_RS      : "rf.read(dec[DC_RS])",
+    OP1_PC      : "pc",
+}
+OP2_EXPR    = {
+    OP2_RT      : "rf.read(dec[DC_RT])",
+    OP2_RS      : "rf.read(dec[DC_RS])",
+    OP2_IM      : "dec[DC_IMM_I]",
+    OP2_IL      : "dec[DC_IMM_U]",
+    OP2_IH      : "dec[DC_IMM_H]",
+    OP2_N1      : "N1",
+    OP2_P1      : "ONE",
+}
+DEST_EXPR   = {
+    DEST_RD     : "dec[DC_RD]",
+    DEST_RT     : "dec[DC_RT]",
+    DEST_R2     : "TWO",
+}
+
+def handler_source(opcode, logged = True):
+    """
+    returns the source of make(self, cpu), which returns the handler of
+    opcode: handler(pc, inst, dec) executes the instruction and returns
+    its status, and passes it to self.log if logged
+    """
+    cs      = csignals[opcode]
+    cl      = isa[opcode][IN_CLASS]
+    fun     = cs[CS_ALU_FUN]
+    dest    = DEST_EXPR.get(cs[CS_DEST_SEL], "ZERO")
+    code    = []
+
+    if cl == CL_ALU:
+        # ALU instructions always write their result, even to $0 (NOP)
+        code.append("stat.inst_alu += 1")
+        if fun in (ALU_X, ALU_COPY2):
+            op1 = None
+        else:
+            op1 = OP1_EXPR.get(cs[CS_OP1_SEL], "ZERO")
+            code.append("alu1 = %s" % op1)
+        if fun not in (ALU_X, ALU_COPY1):
+            op2 = OP2_EXPR.get(cs[CS_OP2_SEL], "ZERO")
+            code.append("alu2 = %s" % ("alu1" if op2 == op1 == OP1_EXPR[OP1_RS] else op2))
+        code.append("alu_out = %s" % ("ZERO"                 if fun == ALU_X     else
+                                      "alu1"                 if fun == ALU_COPY1 else
+                                      "alu2"                 if fun == ALU_COPY2 else
+                                      "alu_fun(alu1, alu2)"))
+        code.append("rdest = %s" % dest)
+        code.append("rf.write(rdest, alu_out)")
+        code.append("pc_next = pc + 1")
+        code.append("cpu.pc.write(pc_next)")
+        code.append("self.log(pc, inst, rdest, alu_out, pc_next)")
+
+    elif cl == CL_MEM:
+        code.append("stat.inst_mem += 1")
+        code.append("rt = dec[DC_RT]")
+        code.append("mem_addr = rf.read(dec[DC_RS]) + SWORD(dec[DC_IMM_S])")
+        if cs[CS_MEM_FCN] == M_XRD:
+            code.append("mem_data, dmem_ok = dmem.access(True, mem_addr, 0, M_XRD)")
+            code.append("if not dmem_ok:")
+            code.append("    return EXC_DMEM_ERROR")
+            code.append("rf.write(rt, mem_data)")
+        else:
+            code.append("mem_data, dmem_ok = dmem.access(True, mem_addr, rf.read(rt), M_XWR)")
+            code.append("if not dmem_ok:")
+            code.append("    return EXC_DMEM_ERROR")
+        code.append("if self.dcache is not None:")
+        code.append("    stat.cycle += self.dcache.access(int(mem_addr), %s)" % (cs[CS_MEM_FCN] == M_XWR))
+        code.append("pc_next = pc + 1")
+        code.append("cpu.pc.write(pc_next)")
+        code.append("self.log(pc, inst, rt, mem_data, pc_next)")
+
+    elif cs[CS_HALT]:
+        # HLT leaves the pc at the HLT instruction
+        code.append("stat.inst_ctrl += 1")
+        code.append("self.log(pc, inst, 0, 0, 0)")
+        code.append("return EXC_HALT")
+
+    else:
+        code.append("stat.inst_ctrl += 1")
+        code.append("pc_plus1 = pc + 1")
+        br_type = cs[CS_BR_TYPE]
+        if br_type in (BrJ_B, BrJ_I):
+            code.append("rs1_data = rf.read(dec[DC_RS])")
+        if br_type == BrJ_B:
+            code.append("alu_out = %s" % ("rs1_data" if fun == ALU_COPY1 else
+                                          "alu_fun(rs1_data, rf.read(dec[DC_RT]))"))
+            flags = []
+            if cs[CS_BR_MASK] & 0b01:
+                flags.append("(0b01 if alu_out == 0 else 0b00)")
+            if cs[CS_BR_MASK] & 0b10:
+                flags.append("(0b10 if alu_out & 0x8000 else 0b00)")
+            code.append("br_cond = (%s) & %d == %d" % (" | ".join(flags), cs[CS_BR_MASK], cs[CS_BR_COND]))
+            code.append("pc_next = (pc + 1 + dec[DC_IMM_I]) & 0xffff if br_cond else pc_plus1")
+        elif br_type == BrJ_J:
+            code.append("pc_next = (pc & 0xf000) | dec[DC_IMM_J]")
+        elif br_type == BrJ_I:
+            code.append("pc_next = rs1_data")
+        else:
+            code.append("pc_next = pc_plus1")
+        code.append("rdest = %s" % dest)
+        if cs[CS_RF_WEN]:
+            code.append("rf.write(rdest, %s)" % ("pc_plus1" if cs[CS_WB_SEL] == WB_PC1 else "ZERO"))
+        code.append("cpu.pc.write(pc_next)")
+        code.append("self.log(pc, inst, rdest, pc_plus1, pc_next)")
+
+    if code[-1].startswith("self.log"):
+        code.append("return EXC_NONE")
+    if not logged:
+        code = [ line for line in code if not line.startswith("self.log") ]
+
+    return "\n".join([ "def make(self, cpu):",
+                        "    stat = cpu.stat",
+                        "    rf = cpu.rf",
+                        "    dmem = cpu.dmem",
+                        "    alu_fun = cpu.alu.fun(%d)" % fun,
+                        "    def run_%s(pc, inst, dec):" % isa[opcode][IN_NAME] ] +
+                      [ "        " + line for line in code ] +
+                      [ "    return run_%s" % isa[opcode][IN_NAME] ]) + "\n"
+
+HANDLER_ENV     = { 'ZERO': WORD(0), 'ONE': WORD(1), 'TWO': WORD(2), 'N1': WORD(SWORD(-1)) }
+HANDLER_SOURCE  = { opcode: handler_source(opcode) for opcode in csignals }
+HANDLERS        = {}
+QUIET_HANDLERS  = {}
+for opcode in csignals:
+    for (handlers, logged) in ((HANDLERS, True), (QUIET_HANDLERS, False)):
+        env = dict(globals(), **HANDLER_ENV)
+        exec(handler_source(opcode, logged), env)
+        handlers[opcode] = env['make']
 
 
 #--------------------------------------------------------------------------
@@ -26,202 +171,1092 @@ from program import *
 
 class Simple(object):
 
-    @staticmethod
-    def run(cpu, entry_point):
+    TIME_SLICE  = 1 << 14       # cycles between checks of cpu.max_time
 
-        Simple.cpu = cpu
+    def __init__(self, cpu):
+        self.cpu    = cpu
+        self.stat   = cpu.stat
+        self.trace  = cpu.trace
+        self.log    = self.log_off
+        self.logged = { opcode: make(self, cpu) for (opcode, make) in HANDLERS.items() }
+        self.quiet  = { opcode: make(self, cpu) for (opcode, make) in QUIET_HANDLERS.items() }
+        self.execute = self.logged
+        self.icache = None
+        self.dcache = None
+        self.profile = None
+        self.host   = None
+        self.dec    = None          # decoded fields of the last instruction
+        self.cycles = 1             # cycles taken by the last instruction
+        self.deadline = None        # time.perf_counter() at cpu.max_time
+        self.step   = self.single_step
+        self.dump   = self.dump_regs    # per-cycle dump of loop_dump
+
+    def run(self, entry_point):
+
+        cpu = self.cpu
         cpu.pc.write(entry_point)
 
-        while True:
+        # The datapath wraps around in 16-bit NumPy words
+        np.seterr(all='ignore')
+
+        # Bind the loop and the logger for the chosen log level up front,
+        # so that no log level is checked while running. Instructions are
+        # not traced at all until cpu.log.start_cycle is reached.
+        level       = cpu.log.level
+        start_cycle = cpu.log.start_cycle
+        loop        = self.loop_dump if level >= 6         else \
+                      self.loop_idle if self.detect_idle() else \
+                      self.loop
+        self.dump   = self.dump_all  if level >= 7         else \
+                      self.dump_regs
+        self.execute = self.logged   if level >= 3         else \
+                       self.quiet
+        self.log    = self.log_off
+
+        # A run stops early at cpu.max_cycles (None: no limit), or after
+        # cpu.max_time seconds
+        limit       = cpu.max_cycles
+        self.deadline = self.time_limit()
+
+        # Cache misses add their stall cycles to stat.cycle
+        self.icache = cpu.icache
+        self.dcache = cpu.dcache
+
+        # Profiled runs count each instruction before executing it, and
+        # runs with host phases time each part of it
+        self.profile = cpu.profile
+        self.host   = cpu.host
+        timed       = self.host is not None and self.host.phases is not None
+        self.step   = self.profile_step     if self.profile is not None  else \
+                      self.phase_step       if timed                     else \
+                      self.single_step
+        if self.profile is not None:
+            self.profile.start(entry_point)
+
+        status = EXC_NONE
+        if level >= 3:
+            status      = self.sliced(loop, start_cycle if limit is None else min(start_cycle, limit))
+            self.log    = self.timed_log(self.logger()) if timed else self.logger()
+        if status == EXC_NONE:
+            status      = self.sliced(loop, limit)
+        if status == EXC_NONE:
+            status      = EXC_LIMIT
+        if self.profile is not None:
+            self.profile.stop(self.stat.cycle)
+
+        self.finish(status)
+        return status
+
+    def loop(self, until):
+
+        stat        = self.stat
+        single_step = self.step
+        while until is None or stat.cycle < until:
+            # Execute a single instruction
+            status = single_step()
+
+            # Update stats
+            stat.cycle      += 1
+            stat.icount     += 1
+
+            if not status == EXC_NONE:
+                return status
+        return EXC_NONE
+
+    def loop_dump(self, until):
+
+        stat        = self.stat
+        single_step = self.step
+        dump        = self.dump
+        while until is None or stat.cycle < until:
             # Execute a single instruction
-            status = Simple.single_step()
+            status = single_step()
 
             # Update stats
-            Stat.cycle      += 1
-            Stat.icount     += 1
+            stat.cycle      += 1
+            stat.icount     += 1
 
             # Show logs after executing a single instruction
-            if Log.level >= 6:
-                Simple.cpu.rf.dump()
-            if Log.level >= 7:
-                Simple.cpu.dmem.dump(skipzero = True)
+            dump()
 
             if not status == EXC_NONE:
-                break
-        
+                return status
+        return EXC_NONE
+
+    def loop_idle(self, until):
+        """
+        loop, looking for stationary loops: when a backward transfer to a
+        pc finds the registers as the last one to that pc left them, with
+        no store in between, the program repeats that iteration forever
+        """
+        cpu         = self.cpu
+        stat        = self.stat
+        single_step = self.step
+        seen        = None
+        stores      = 0
+        while until is None or stat.cycle < until:
+            pc      = int(cpu.pc.read())
+
+            # Execute a single instruction
+            status  = single_step()
+
+            # Update stats
+            stat.cycle      += self.cycles
+            stat.icount     += 1
+
+            if not status == EXC_NONE:
+                return status
+
+            if self.dec[DC_CS][CS_MEM_FCN] == M_XWR:
+                stores += 1
+            pc_next = int(cpu.pc.read())
+            if pc_next <= pc:
+                key = (pc_next, stores, *[ int(v) for v in cpu.rf.reg ])
+                if key != seen:
+                    seen    = key
+                    since   = stat.counters()
+                    continue
+                times = self.idle_loop(pc_next, stat.cycle - since[0], stat.cycle, self.cycles)
+                if times is None:
+                    return EXC_IDLE
+                stat.repeat(since, times)
+        return EXC_NONE
+
+    def sliced(self, loop, until):
+        """
+        runs loop(until), stopping with EXC_TIMEOUT past self.deadline. The
+        time is checked every TIME_SLICE cycles.
+        """
+        if self.deadline is None:
+            return loop(until)
+        stat = self.stat
+        while True:
+            end     = stat.cycle + Simple.TIME_SLICE
+            status  = loop(end if until is None else min(end, until))
+            if not status == EXC_NONE or (until is not None and stat.cycle >= until):
+                return status
+            if time.perf_counter() >= self.deadline:
+                return EXC_TIMEOUT
+
+    def time_limit(self):
+        """
+        returns the time.perf_counter() at which the run must stop
+        (cpu.max_time), or None
+        """
+        max_time = self.cpu.max_time
+        return None if max_time is None else time.perf_counter() + max_time
+
+    def detect_idle(self):
+        """
+        whether to look for stationary loops. The whole machine state must
+        be in the registers, pc and memory (no caches, and no memory file
+        which other processes may write), and skipped iterations must not
+        be traced or profiled.
+        """
+        cpu = self.cpu
+        return cpu.idle != IDLE_OFF and cpu.log.level < 3 and cpu.profile is None and \
+               cpu.icache is None and cpu.dcache is None and cpu.dmem.mmap is None
+
+    def idle_loop(self, pc, period, cycle, last):
+        """
+        handles a stationary loop at pc, found at the given cycle, when an
+        iteration of period cycles ended with an instruction of last cycles.
+        Returns the number of iterations to skip, or None to stop with
+        EXC_IDLE.
+        """
+        limit = self.cpu.max_cycles
+        if self.cpu.idle == IDLE_STOP or limit is None:
+            return None
+
+        # Skip the iterations whose last instruction starts before the limit
+        times = (limit - cycle + last - 1) // period
+        if times > 0:
+            print("Idle loop at 0x%08x: skipped %d cycles" % (pc, times * period))
+        return times
+
+    def finish(self, status):
+
+        cpu = self.cpu
+
         # Handle exceptions, if any
         if (status & EXC_DMEM_ERROR):
-            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_DMEM_ERROR], Simple.cpu.pc.read()))
+            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_DMEM_ERROR], cpu.pc.read()))
         elif (status & EXC_HALT):
             print("Execution completed")
         elif (status & EXC_ILLEGAL_INST):
-            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_ILLEGAL_INST], Simple.cpu.pc.read()))
+            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_ILLEGAL_INST], cpu.pc.read()))
         elif (status & EXC_IMEM_ERROR):
-            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_IMEM_ERROR], Simple.cpu.pc.read()))
+            print("Exception '%s' occurred at 0x%08x -- Program terminated" % (EXC_MSG[EXC_IMEM_ERROR], cpu.pc.read()))
+        elif (status & EXC_LIMIT):
+            print("Cycle limit reached at 0x%08x -- Program stopped" % (cpu.pc.read()))
+        elif (status & EXC_IDLE):
+            print("Idle loop detected at 0x%08x -- Program stopped" % (cpu.pc.read()))
+        elif (status & EXC_TIMEOUT):
+            print("Time limit reached at 0x%08x -- Program stopped" % (cpu.pc.read()))
 
         # Show logs after finishing the program execution
-        if Log.level > 0:
-            if Log.level < 6:
-                Simple.cpu.rf.dump()
-            if Log.level > 1 and Log.level < 7:
-                Simple.cpu.dmem.dump(skipzero = True)
+        level = cpu.log.level
+        if level > 0:
+            if level < 6:
+                cpu.rf.dump()
+            if level > 1 and level < 7:
+                cpu.dmem.dump(skipzero = True)
 
-    @staticmethod
-    def log(pc, inst, rd, wbdata, pc_next):
+    def logger(self):
+        """
+        returns the instruction logger for the log level and trace format
+        """
+        if self.trace.fmt != TRACE_TEXT:
+            return self.log_record
+        return self.log_full if self.cpu.log.level >= 5 else self.log_inst
 
-        if Stat.cycle < Log.start_cycle:
-            return
-        if Log.level >= 5:
-            info = "# R[%d] <- 0x%04x, pc_next=0x%04x" % (rd, wbdata, pc_next) if rd else \
-                   "# pc_next=0x%04x" % pc_next
-        else:
-            info = ''
-        if Log.level >= 3:
-            print("%5d  0x%04x:  %-24s%-s" % (Stat.cycle, pc, Program.disasm(pc, inst), info))
-        else:
-            return
+    def log_off(self, pc, inst, rd, wbdata, pc_next):
+        return
 
-    def run_alu(pc, inst, cs):
-        np.seterr(all='ignore')
+    def dump_regs(self):
+        self.cpu.rf.dump(out = self.trace.text)
+
+    def dump_all(self):
+        self.cpu.rf.dump(out = self.trace.text)
+        self.cpu.dmem.dump(skipzero = True, out = self.trace.text)
 
-        Stat.inst_alu += 1
+    def log_inst(self, pc, inst, rd, wbdata, pc_next):
+        print(Trace.format_inst(self.stat.cycle, pc, inst), file = self.trace.out)
 
-        rs          = TSC.rs(inst)
-        rt          = TSC.rt(inst)
-        rd          = TSC.rd(inst)
+    def log_full(self, pc, inst, rd, wbdata, pc_next):
+        print(Trace.format_full(self.stat.cycle, pc, inst, rd, wbdata, pc_next), file = self.trace.out)
 
-        imm_i       = TSC.imm_i(inst)
-        imm_u       = TSC.imm_u(inst)
-        imm_h       = TSC.imm_h(inst)
+    def log_record(self, pc, inst, rd, wbdata, pc_next):
+        self.trace.record(self.stat.cycle, pc, inst, rd, wbdata, pc_next)
 
-        rs1_data    = Simple.cpu.rf.read(rs)
-        rs2_data    = Simple.cpu.rf.read(rt)
+    def profile_step(self):
+        """
+        single_step, counting the instruction in cpu.profile
+        """
+        cpu         = self.cpu
+        pc          = int(cpu.pc.read())
+        inst, ok    = cpu.dmem.access(True, pc, 0, M_XRD)
+        if ok:
+            self.profile.step(pc, int(inst), self.stat.cycle)
+        status      = self.single_step()
+        if status == EXC_NONE:
+            pc_next = int(cpu.pc.read())
+            if pc_next != (pc + 1) & 0xffff:
+                cs  = decode_table[inst][DC_CS]
+                self.profile.transfer(pc, pc_next, cs[CS_BR_TYPE] == BrJ_I)
+        return status
 
-        alu1        = rs1_data      if cs[CS_OP1_SEL] == OP1_RS     else \
-                      pc            if cs[CS_OP1_SEL] == OP1_PC     else \
-                      WORD(0)       if cs[CS_OP1_SEL] == OP1_0      else \
-                      WORD(0)
+    def single_step(self):
+
+        pc      = self.cpu.pc.read()
+
+        # Instruction fetch
+        inst, imem_status = self.cpu.dmem.access(True, pc, 0, M_XRD)
+        if not imem_status:
+            return EXC_IMEM_ERROR
+        if self.icache is not None:
+            self.stat.cycle += self.icache.access(int(pc), False)
 
-        alu2        = rs2_data      if cs[CS_OP2_SEL] == OP2_RT     else \
-                      rs1_data      if cs[CS_OP2_SEL] == OP2_RS     else \
-                      imm_i         if cs[CS_OP2_SEL] == OP2_IM     else \
-                      imm_u         if cs[CS_OP2_SEL] == OP2_IL     else \
-                      imm_h         if cs[CS_OP2_SEL] == OP2_IH     else \
-                      WORD(
-                        SWORD(-1)   # simple fix for out of range error
-                      )             if cs[CS_OP2_SEL] == OP2_N1     else \
-                      WORD(1)       if cs[CS_OP2_SEL] == OP2_P1     else \
-                      WORD(0)       if cs[CS_OP2_SEL] == OP2_0      else \
-                      WORD(0)
+        # Instruction decode 
+        dec     = decode_table[inst]
+        if dec is None or dec[DC_CS] is None:
+            return EXC_ILLEGAL_INST
+        self.dec = dec
 
-        alu_out     = Simple.cpu.alu.op(cs[CS_ALU_FUN], alu1, alu2)
+        return self.execute[dec[DC_OPCODE]](pc, inst, dec)
 
-        rdest       = rd            if cs[CS_DEST_SEL] == DEST_RD   else \
-                      rt            if cs[CS_DEST_SEL] == DEST_RT   else \
-                      WORD(2)       if cs[CS_DEST_SEL] == DEST_R2   else \
-                      WORD(0)
+    def phase_step(self):
+        """
+        single_step, adding the host time of each phase to cpu.host.phases
+        """
+        clock   = time.perf_counter_ns
+        phases  = self.host.phases
+        t0      = clock()
 
-        pc_next     = pc + 1
+        pc      = self.cpu.pc.read()
 
-        Simple.cpu.rf.write(rdest, alu_out)
-        Simple.cpu.pc.write(pc_next)
-        Simple.log(pc, inst, rdest, alu_out, pc_next)
-        return EXC_NONE
+        # Instruction fetch
+        inst, imem_status = self.cpu.dmem.access(True, pc, 0, M_XRD)
+        if imem_status and self.icache is not None:
+            self.stat.cycle += self.icache.access(int(pc), False)
+        t1      = clock()
+        phases['fetch'] += t1 - t0
+        if not imem_status:
+            return EXC_IMEM_ERROR
+
+        # Instruction decode
+        dec     = decode_table[inst]
+        t2      = clock()
+        phases['decode'] += t2 - t1
+        if dec is None or dec[DC_CS] is None:
+            return EXC_ILLEGAL_INST
+        self.dec = dec
+
+        # Execute (the time spent in self.log is moved to the log phase)
+        status  = self.execute[dec[DC_OPCODE]](pc, inst, dec)
+        phases['execute'] += clock() - t2
+        return status
+
+    def timed_log(self, log):
+        """
+        returns log, moving its host time from the execute phase to the log phase
+        """
+        clock   = time.perf_counter_ns
+        phases  = self.host.phases
 
-    def run_mem(pc, inst, cs):
+        def timed(pc, inst, rd, wbdata, pc_next):
+            t = clock()
+            log(pc, inst, rd, wbdata, pc_next)
+            t = clock() - t
+            phases['execute']   -= t
+            phases['log']       += t
+        return timed
 
-        Stat.inst_mem += 1
 
-        rs          = TSC.rs(inst)
-        rs1_data    = Simple.cpu.rf.read(rs)
 
-        if (cs[CS_MEM_FCN] == M_XRD):
-            rt          = TSC.rt(inst)
-            imm_i       = TSC.imm_i(inst)
-            mem_addr    = rs1_data + SWORD(imm_i)
-            mem_data, dmem_ok = Simple.cpu.dmem.access(True, mem_addr, 0, M_XRD)
-            if dmem_ok:
-                Simple.cpu.rf.write(rt, mem_data)
+#--------------------------------------------------------------------------
+#   Fast: simulates the single-cycle CPU execution with plain ints
+#--------------------------------------------------------------------------
+
+class Fast(Simple):
+
+    @staticmethod
+    def alu(alufun, alu1, alu2):
+        """
+        ALU.op on plain ints, masked to 16 bits
+        """
+        if alufun == ALU_ADD:
+            return (alu1 + alu2) & 0xffff
+        elif alufun == ALU_SUB:
+            return (alu1 - alu2) & 0xffff
+        elif alufun == ALU_AND:
+            return alu1 & alu2
+        elif alufun == ALU_OR:
+            return alu1 | alu2
+        elif alufun == ALU_XOR:
+            return alu1 ^ alu2
+        elif alufun == ALU_SLT:
+            return 1 if (alu1 ^ 0x8000) < (alu2 ^ 0x8000) else 0
+        elif alufun == ALU_SLTU:
+            return 1 if alu1 < alu2 else 0
+        elif alufun == ALU_SLL:
+            return (alu1 << (alu2 & 0x1f)) & 0xffff
+        elif alufun == ALU_SRA:
+            return (((alu1 ^ 0x8000) - 0x8000) >> (alu2 & 0x1f)) & 0xffff
+        elif alufun == ALU_SRL:
+            return alu1 >> (alu2 & 0x1f)
+        elif alufun == ALU_COPY1:
+            return alu1
+        elif alufun == ALU_COPY2:
+            return alu2
         else:
-            rt          = TSC.rt(inst)
-            rs2_data    = Simple.cpu.rf.read(rt)
+            return 0
+
+    def run(self, entry_point):
+
+        cpu         = self.cpu
+        stat        = self.stat
+        alu         = Fast.alu
+        log         = self.logger()
+        start_log   = cpu.log.start_cycle
+        reg         = [ int(v) for v in cpu.rf.reg ]
+        pages       = cpu.dmem.pages
+        page        = cpu.dmem.page
+        zero_page   = Memory.ZERO_PAGE
+        shift       = Memory.PAGE_SHIFT
+        mask        = Memory.PAGE_MASK
+        mem_start   = int(cpu.dmem.mem_start)
+        mem_end     = int(cpu.dmem.mem_end)
+        limit       = sys.maxsize if cpu.max_cycles is None else cpu.max_cycles
+        deadline    = self.time_limit()
+        until       = limit if deadline is None else min(limit, stat.cycle + Simple.TIME_SLICE)
+        idle        = self.detect_idle()
+        seen        = None
+        stores      = 0
+        trace       = cpu.log.level >= 3
+        dump_rf     = cpu.log.level >= 6
+        dump_mem    = cpu.log.level >= 7
+        icache      = cpu.icache
+        dcache      = cpu.dcache
+        profile     = cpu.profile
+        if profile is not None:
+            profile.start(entry_point)
+            p_count     = profile.count
+            p_stalls    = profile.stalls
+            p_opcodes   = profile.opcodes
+            p_opid      = Profile.OPID
+            p_taken     = profile.taken
+            p_indirect  = profile.indirect
+            p_offset    = profile.mem_start - mem_start
+
+        pc          = int(entry_point) & 0xffff
+        start       = stat.cycle
+        cycle       = start
+        stalls      = 0             # cache stall cycles
+        inst_alu    = 0
+        inst_mem    = 0
+        inst_ctrl   = 0
+
+        while True:
+            if cycle >= until:
+                if cycle >= limit:
+                    status  = EXC_LIMIT
+                    break
+                if time.perf_counter() >= deadline:
+                    status  = EXC_TIMEOUT
+                    break
+                until   = min(limit, cycle + Simple.TIME_SLICE)
+            status      = EXC_NONE
+
+            # Instruction fetch
+            if pc < mem_start or pc >= mem_end:
+                status  = EXC_IMEM_ERROR
+                dec     = None
+            else:
+                offset  = pc - mem_start
+                inst    = pages[offset >> shift][offset & mask]
+                if profile is not None:
+                    p_at    = offset - p_offset
+                    p_count[p_at]           += 1
+                    p_opcodes[p_opid[inst]] += 1
+                if icache is not None:
+                    n       = icache.access(pc, False)
+                    cycle  += n
+                    stalls += n
+                    if profile is not None:
+                        p_stalls[p_at] += n
+
+                # Instruction decode
+                dec     = decode_table[inst]
+                if dec is None or dec[DC_CS] is None:
+                    status  = EXC_ILLEGAL_INST
+                    dec     = None
+
+            if dec is not None:
+                cs          = dec[DC_CS]
+                cls         = dec[DC_CLASS]
+                rs1_data    = reg[dec[DC_RS]]
+                pc_plus1    = (pc + 1) & 0xffff
+
+                if cls == CL_ALU:
+                    inst_alu += 1
+
+                    op1     = cs[CS_OP1_SEL]
+                    op2     = cs[CS_OP2_SEL]
+                    alu1    = rs1_data              if op1 == OP1_RS     else \
+                              pc                    if op1 == OP1_PC     else \
+                              0
+                    alu2    = reg[dec[DC_RT]]       if op2 == OP2_RT     else \
+                              rs1_data              if op2 == OP2_RS     else \
+                              dec[DC_IMM_I]         if op2 == OP2_IM     else \
+                              dec[DC_IMM_U]         if op2 == OP2_IL     else \
+                              dec[DC_IMM_H]         if op2 == OP2_IH     else \
+                              0xffff                if op2 == OP2_N1     else \
+                              1                     if op2 == OP2_P1     else \
+                              0
+                    wb_data = alu(cs[CS_ALU_FUN], alu1, alu2)
+
+                    dest    = cs[CS_DEST_SEL]
+                    rdest   = dec[DC_RD]            if dest == DEST_RD   else \
+                              dec[DC_RT]            if dest == DEST_RT   else \
+                              2                     if dest == DEST_R2   else \
+                              0
+
+                    reg[rdest]  = wb_data
+                    pc_next     = pc_plus1
+
+                elif cls == CL_MEM:
+                    inst_mem += 1
 
-            imm_i       = TSC.imm_i(inst)
-            mem_addr    = rs1_data + SWORD(imm_i)
-            mem_data, dmem_ok = Simple.cpu.dmem.access(True, mem_addr, rs2_data, M_XWR)
+                    rdest       = dec[DC_RT]
+                    mem_addr    = rs1_data + dec[DC_IMM_S]
+                    if mem_addr < mem_start or mem_addr >= mem_end:
+                        status  = EXC_DMEM_ERROR
+                    else:
+                        offset  = mem_addr - mem_start
+                        if dcache is not None:
+                            n       = dcache.access(mem_addr, cs[CS_MEM_FCN] == M_XWR)
+                            cycle  += n
+                            stalls += n
+                            if profile is not None:
+                                p_stalls[p_at] += n
+                        if cs[CS_MEM_FCN] == M_XRD:
+                            wb_data         = pages[offset >> shift][offset & mask]
+                            reg[rdest]      = wb_data
+                        else:
+                            target          = pages[offset >> shift]
+                            if target is zero_page:
+                                target      = page(offset >> shift)
+                            target[offset & mask] = reg[rdest]
+                            wb_data         = 0
+                            stores         += 1
+                        pc_next = pc_plus1
 
-        if not dmem_ok:
-            return EXC_DMEM_ERROR
+                else:
+                    inst_ctrl += 1
 
-        pc_next         = pc + 1
-        Simple.cpu.pc.write(pc_next)
-        Simple.log(pc, inst, rt, mem_data, pc_next)
+                    if cs[CS_HALT]:
+                        status  = EXC_HALT
+                        if trace and cycle >= start_log:
+                            stat.cycle = cycle
+                            log(pc, inst, 0, 0, 0)
+                    else:
+                        br_type = cs[CS_BR_TYPE]
+                        if br_type == BrJ_B:
+                            alu_out     = alu(cs[CS_ALU_FUN], rs1_data, reg[dec[DC_RT]])
+                            flags       = (0b01 if alu_out == 0 else 0b00) | \
+                                          (0b10 if alu_out & 0x8000 else 0b00)
+                            br_cond     = (flags & cs[CS_BR_MASK]) == cs[CS_BR_COND]
+                        else:
+                            br_cond     = False
+
+                        pc_next = (pc & 0xf000) | dec[DC_IMM_J]        if br_type == BrJ_J              else \
+                                  (pc + 1 + dec[DC_IMM_I]) & 0xffff   if br_type == BrJ_B and br_cond  else \
+                                  rs1_data                            if br_type == BrJ_I              else \
+                                  pc_plus1
+
+                        dest    = cs[CS_DEST_SEL]
+                        rdest   = dec[DC_RD]            if dest == DEST_RD   else \
+                                  dec[DC_RT]            if dest == DEST_RT   else \
+                                  2                     if dest == DEST_R2   else \
+                                  0
+
+                        if cs[CS_RF_WEN]:
+                            reg[rdest]  = pc_plus1 if cs[CS_WB_SEL] == WB_PC1 else 0
+                        wb_data = pc_plus1
+
+                        # A backward transfer may close a stationary loop
+                        # (see Simple.loop_idle)
+                        if idle and pc_next <= pc:
+                            key = (pc_next, stores, *reg)
+                            if key != seen:
+                                seen    = key
+                                since   = (cycle, inst_alu, inst_mem, inst_ctrl)
+                            else:
+                                times   = self.idle_loop(pc_next, cycle - since[0], cycle + 1, 1)
+                                if times is None:
+                                    status  = EXC_IDLE
+                                    pc      = pc_next
+                                else:
+                                    cycle      += (cycle - since[0]) * times
+                                    inst_alu   += (inst_alu - since[1]) * times
+                                    inst_mem   += (inst_mem - since[2]) * times
+                                    inst_ctrl  += (inst_ctrl - since[3]) * times
+
+                        if profile is not None and pc_next != pc_plus1:
+                            if br_type == BrJ_I:
+                                p_indirect[(pc, pc_next)] = p_indirect.get((pc, pc_next), 0) + 1
+                            else:
+                                p_taken[p_at] += 1
+
+                if status == EXC_NONE:
+                    if trace and cycle >= start_log:
+                        stat.cycle = cycle
+                        log(pc, inst, rdest, wb_data, pc_next)
+                    pc = pc_next
+
+            cycle += 1
+
+            # Show logs after executing a single instruction
+            if dump_rf:
+                self.sync(reg, pc)
+                cpu.rf.dump(out = self.trace.text)
+            if dump_mem:
+                cpu.dmem.dump(skipzero = True, out = self.trace.text)
+
+            if not status == EXC_NONE:
+                break
+
+        # Update stats
+        stat.cycle      = cycle
+        stat.icount     += cycle - start - stalls
+        stat.inst_alu   += inst_alu
+        stat.inst_mem   += inst_mem
+        stat.inst_ctrl  += inst_ctrl
+
+        self.sync(reg, pc)
+        self.finish(status)
+        return status
+
+    def sync(self, reg, pc):
+        """
+        write the int machine state back to the NumPy-typed datapath
+        """
+        for i in range(NUM_REGS):
+            self.cpu.rf.write(i, reg[i])
+        self.cpu.pc.write(pc)
+
+
+#--------------------------------------------------------------------------
+#   Multi: simulates the multi-cycle CPU execution (2-5 cycles per inst.)
+#--------------------------------------------------------------------------
+#
+#   Every instruction goes through IF and ID, and then follows the
+#   CS_NEXT_* states of its csignals entry until it returns to IF:
+#   JMP, JPR, NOP and HLT take 2 cycles, branches, JAL, JRL, RWD and WWD 3,
+#   ALU instructions and SWD 4, and LWD 5. An instruction which raises an
+#   exception stops in the state that raised it.
+
+class Multi(Simple):
+
+    @staticmethod
+    def state_cycles(cs):
+        """
+        number of states an instruction goes through, starting from IF
+        """
+        cycles  = 2                 # IF, ID
+        state   = cs[CS_NEXT_ID]
+        while state not in (STATE_IF, STATE_HLT):
+            cycles += 1
+            state   = cs[CS_NEXT_EX]    if state == STATE_EX     else \
+                      cs[CS_NEXT_MM]    if state == STATE_MM     else \
+                      STATE_IF
+        return cycles
+
+    def __init__(self, cpu):
+        Simple.__init__(self, cpu)
+        self.cycles = 0             # cycles taken by the last instruction
+        self.count  = [ 'cycle_alu', 'cycle_mem', 'cycle_ctrl' ]
+
+    def loop(self, until):
+
+        stat        = self.stat
+        single_step = self.step
+        while until is None or stat.cycle < until:
+            # Execute a single instruction
+            status = single_step()
+
+            # Update stats
+            stat.cycle      += self.cycles
+            stat.icount     += 1
+
+            if not status == EXC_NONE:
+                return status
         return EXC_NONE
 
-    def run_ctrl(pc, inst, cs):
-
-        Stat.inst_ctrl += 1
-
-        if inst in [ HLT ]:
-            Simple.log(pc, inst, 0, 0, 0) 
-            return EXC_HALT
-
-        rs              = TSC.rs(inst)
-        rt              = TSC.rt(inst)
-        rd              = TSC.rd(inst)
-        rs1_data        = Simple.cpu.rf.read(rs)
-        rs2_data        = Simple.cpu.rf.read(rt)
-
-        imm_i           = TSC.imm_i(inst)
-        imm_j           = TSC.imm_j(inst)
-
-        rs1_data        = Simple.cpu.rf.read(rs)
-        rs2_data        = Simple.cpu.rf.read(rt)
-        alu_out         = Simple.cpu.alu.op(cs[CS_ALU_FUN], rs1_data, rs2_data)
-        is_zero         = 0b01  if (alu_out == 0) else          0b00
-        is_signed       = 0b10  if (alu_out & 0x8000) else      0b00
-        br_cond         = ((is_zero | is_signed) & cs[CS_BR_MASK]) == cs[CS_BR_COND]
-        
-        pc_plus1        = pc + 1
-
-        pc_next         = (pc & 0xf000) | imm_j if cs[CS_BR_TYPE] == BrJ_J              else                     \
-                          (pc + 1 + imm_i) & 0xffff if cs[CS_BR_TYPE] == BrJ_B and br_cond  else                 \
-                          rs1_data              if cs[CS_BR_TYPE] == BrJ_I              else                     \
-                          pc_plus1
-        
-        rdest           = rd            if cs[CS_DEST_SEL] == DEST_RD   else \
-                          rt            if cs[CS_DEST_SEL] == DEST_RT   else \
-                          WORD(2)       if cs[CS_DEST_SEL] == DEST_R2   else \
-                          WORD(0)
-        
-        wb_data         = pc_plus1      if cs[CS_WB_SEL] == WB_PC1      else \
-                          WORD(0)
+    def loop_dump(self, until):
 
-        if cs[CS_RF_WEN]:
-            Simple.cpu.rf.write(rdest, wb_data)
-        Simple.cpu.pc.write(pc_next)
-        Simple.log(pc, inst, rdest, pc_plus1, pc_next) 
+        stat        = self.stat
+        single_step = self.step
+        dump        = self.dump
+        while until is None or stat.cycle < until:
+            # Execute a single instruction
+            status = single_step()
+
+            # Update stats
+            stat.cycle      += self.cycles
+            stat.icount     += 1
+
+            # Show logs after executing a single instruction
+            dump()
+
+            if not status == EXC_NONE:
+                return status
         return EXC_NONE
 
+    def single_step(self):
+        return self.account(Simple.single_step(self))
 
-    func = [ run_alu, run_mem, run_ctrl ]
+    def phase_step(self):
+        return self.account(Simple.phase_step(self))
 
-    @staticmethod
-    def single_step():
+    def account(self, status):
+        """
+        counts the cycles of the instruction which just ended with status
+        """
+        if status == EXC_IMEM_ERROR:
+            self.cycles = 1         # IF
+            return status
+        if status == EXC_ILLEGAL_INST:
+            self.cycles = 2         # IF, ID
+            return status
 
-        pc      = Simple.cpu.pc.read()
+        # EX, MM, WB
+        cls     = self.dec[DC_CLASS]
+        cycles  = Multi.CYCLES[self.dec[DC_OPCODE]]
+        if status == EXC_DMEM_ERROR:
+            cycles = 4              # IF, ID, EX, MM
 
-        # Instruction fetch
-        inst, imem_status = Simple.cpu.dmem.access(True, pc, 0, M_XRD)
-        if not imem_status:
-            return EXC_IMEM_ERROR
+        self.cycles = cycles
+        setattr(self.stat, self.count[cls], getattr(self.stat, self.count[cls]) + cycles)
+        return status
 
-        # Instruction decode 
-        opcode  = TSC.opcode(inst)
-        if opcode == ILLEGAL:
-            return EXC_ILLEGAL_INST
+Multi.CYCLES = { opcode: Multi.state_cycles(cs) for (opcode, cs) in csignals.items() }
+
+
+#--------------------------------------------------------------------------
+#   Latch: a pipeline register between two stages
+#--------------------------------------------------------------------------
+
+class Latch(object):
+
+    def __init__(self, pc = 0, inst = BUBBLE, exc = EXC_NONE, valid = True):
+        self.valid      = valid     # False for a bubble
+        self.pc         = pc
+        self.inst       = inst
+        self.exc        = exc       # exception to raise when retired
+        self.dec        = None
+        self.rs1_data   = 0
+        self.rs2_data   = 0
+        self.wen        = False     # writes wbdata to R[rdest] in WB
+        self.rdest      = 0
+        self.wbdata     = 0
+        self.mem_addr   = 0
+        self.pc_next    = 0         # architectural next pc (for logs)
+        self.pred_next  = (pc + 1) & 0xffff     # next pc predicted in IF
+
+BUBBLE_LATCH        = Latch(valid = False)
+
+
+#--------------------------------------------------------------------------
+#   Pipe: simulates the 5-stage pipelined CPU (IF, ID, EX, MM, WB)
+#--------------------------------------------------------------------------
+#
+#   * Register operands are read in ID. With forwarding, they come from
+#     the EX or MM stage outputs (FWD_EX, FWD_MM), and an LWD in EX stalls
+#     its consumer for a cycle. Without forwarding, ID stalls as long as a
+#     producer is in EX or MM. WB writes the register file before ID reads
+#     it, so a producer in WB is never a hazard.
+#   * IF fetches from the next pc predicted by the branch predictor (not
+#     taken by default) for branches, and by the BTB, if any, for JPR/JRL.
+#     JMP/JAL are resolved in ID (1 instruction flushed), branches and
+#     JPR/JRL in EX (2 instructions flushed, when mispredicted).
+#   * Exceptions and HLT take effect when the instruction reaches WB, so
+#     wrong-path instructions never raise them.
+#   * An SWD which writes over an instruction already fetched into IF/ID
+#     or ID/EX flushes both, and IF refetches from the pc after the SWD.
+#
+#   The architectural results (registers, memory, retired instructions)
+#   are the same as Simple, including its quirks.
+
+class Pipe(Simple):
+
+    MISPREDICT_PENALTY  = 2     # cycles lost by resolving a branch in EX
+
+    def __init__(self, cpu, forwarding = True, predictor = None, btb = None):
+        Simple.__init__(self, cpu)
+        self.forwarding = forwarding
+        self.predictor  = NotTaken() if predictor is None else predictor
+        self.btb        = btb
+
+    def run(self, entry_point):
+
+        cpu         = self.cpu
+        stat        = self.stat
+        level       = cpu.log.level
+        limit       = sys.maxsize if cpu.max_cycles is None else cpu.max_cycles
+        deadline    = self.time_limit()
+        until       = limit if deadline is None else min(limit, stat.cycle + Simple.TIME_SLICE)
+
+        self.pc     = int(entry_point) & 0xffff
+        self.if_id  = BUBBLE_LATCH
+        self.id_ex  = BUBBLE_LATCH
+        self.ex_mm  = BUBBLE_LATCH
+        self.mm_wb  = BUBBLE_LATCH
+        self.reg    = [ int(v) for v in cpu.rf.reg ]
+        self.log    = self.log_off
+        self.icache = cpu.icache
+        self.dcache = cpu.dcache
+        self.profile = cpu.profile
+        if self.profile is not None:
+            self.profile.start(entry_point)
+        tracing     = False
+        show_stages = False
+
+        status = EXC_NONE
+        while status == EXC_NONE:
+            if stat.cycle >= until:
+                if stat.cycle >= limit:
+                    status = EXC_LIMIT
+                    break
+                if time.perf_counter() >= deadline:
+                    status = EXC_TIMEOUT
+                    break
+                until = min(limit, stat.cycle + Simple.TIME_SLICE)
+
+            if level >= 3 and not tracing and stat.cycle >= cpu.log.start_cycle:
+                tracing     = True
+                self.log    = self.logger()
+                show_stages = level >= 4 and self.trace.fmt == TRACE_TEXT
+            if show_stages:
+                self.log_stages()
+
+            status = self.clock()
+            stat.cycle += 1
+
+            # Show logs after each cycle
+            if level >= 6:
+                self.sync_reg()
+                cpu.rf.dump(out = self.trace.text)
+            if level >= 7:
+                cpu.dmem.dump(skipzero = True, out = self.trace.text)
+
+        if self.profile is not None:
+            self.profile.stop(stat.cycle)
+
+        # The pc is at the instruction which stopped the machine, or at
+        # the oldest instruction in flight
+        if status in (EXC_LIMIT, EXC_TIMEOUT):
+            for latch in (self.mm_wb, self.ex_mm, self.id_ex, self.if_id):
+                if latch.valid:
+                    cpu.pc.write(latch.pc)
+                    break
+            else:
+                cpu.pc.write(self.pc)
+        self.sync_reg()
+        self.finish(status)
+        return status
+
+    def sync_reg(self):
+        for i in range(NUM_REGS):
+            self.cpu.rf.write(i, self.reg[i])
+
+    def clock(self):
+        """
+        runs every stage for a cycle, from WB back to IF. Returns the
+        status of the instruction retired in this cycle.
+        """
+        cpu         = self.cpu
+        stat        = self.stat
+        reg         = self.reg
+
+        #------------------------------------------------------------------
+        # WB: retire an instruction
+
+        w = self.mm_wb
+        if w.valid:
+            stat.icount += 1
+            if self.profile is not None:
+                self.profile.step(w.pc, w.inst, stat.cycle)
+            if w.exc != EXC_NONE:
+                if w.exc == EXC_DMEM_ERROR:
+                    stat.inst_mem += 1
+                cpu.pc.write(w.pc)
+                return w.exc
+
+            cls = w.dec[DC_CLASS]
+            if cls == CL_ALU:
+                stat.inst_alu += 1
+            elif cls == CL_MEM:
+                stat.inst_mem += 1
+            else:
+                stat.inst_ctrl += 1
+
+            if w.dec[DC_CS][CS_HALT]:
+                self.log(w.pc, w.inst, 0, 0, 0)
+                cpu.pc.write(w.pc)
+                return EXC_HALT
+
+            if w.wen:
+                reg[w.rdest] = w.wbdata
+            if self.profile is not None and w.pc_next != (w.pc + 1) & 0xffff:
+                self.profile.transfer(w.pc, w.pc_next, w.dec[DC_CS][CS_BR_TYPE] == BrJ_I)
+            # Control transfers log pc+1 as their data, as in Simple
+            self.log(w.pc, w.inst, w.rdest, (w.pc + 1) & 0xffff if cls == CL_CTRL else w.wbdata, w.pc_next)
+
+        #------------------------------------------------------------------
+        # MM: access data memory
+
+        m = self.ex_mm
+        smc = None
+
+        # The fetch of an instruction looks up the I-cache once it gets
+        # here and can no longer be flushed, so refetches while IF stalls
+        # and wrong-path fetches do not count. A miss freezes the whole
+        # pipeline, so it costs the same cycles as in IF.
+        if m.valid and m.exc != EXC_IMEM_ERROR and self.icache is not None:
+            stat.cycle += self.icache.access(m.pc, False)
+
+        if m.valid and m.exc == EXC_NONE and m.dec[DC_CLASS] == CL_MEM:
+            cs = m.dec[DC_CS]
+            if cs[CS_MEM_FCN] == M_XRD:
+                data, ok = cpu.dmem.access(True, m.mem_addr, 0, M_XRD)
+                m.wbdata = int(data)
+            else:
+                data, ok = cpu.dmem.access(True, m.mem_addr, m.rs2_data, M_XWR)
+                if ok and ((self.id_ex.valid and self.id_ex.pc == m.mem_addr) or
+                           (self.if_id.valid and self.if_id.pc == m.mem_addr)):
+                    smc = (m.pc + 1) & 0xffff
+            if not ok:
+                m.exc = EXC_DMEM_ERROR
+            elif self.dcache is not None:
+                # A miss freezes the whole pipeline
+                stat.cycle += self.dcache.access(m.mem_addr, cs[CS_MEM_FCN] == M_XWR)
+        mm_out = m
+
+        # Self-modifying code: the younger instructions are stale
+        if smc is not None:
+            stat.flushes += self.id_ex.valid + self.if_id.valid
+            self.id_ex  = BUBBLE_LATCH
+            self.if_id  = BUBBLE_LATCH
+            self.pc     = smc
+
+        #------------------------------------------------------------------
+        # EX: compute, and resolve branches and register jumps
+
+        e = self.id_ex
+        redirect = None
+        if e.valid and e.exc == EXC_NONE:
+            cs = e.dec[DC_CS]
+            cls = e.dec[DC_CLASS]
+            pc_plus1 = (e.pc + 1) & 0xffff
+            if cls == CL_ALU:
+                op1     = cs[CS_OP1_SEL]
+                op2     = cs[CS_OP2_SEL]
+                alu1    = e.rs1_data                if op1 == OP1_RS     else \
+                          e.pc                      if op1 == OP1_PC     else \
+                          0
+                alu2    = e.rs2_data                if op2 == OP2_RT     else \
+                          e.rs1_data                if op2 == OP2_RS     else \
+                          e.dec[DC_IMM_I]           if op2 == OP2_IM     else \
+                          e.dec[DC_IMM_U]           if op2 == OP2_IL     else \
+                          e.dec[DC_IMM_H]           if op2 == OP2_IH     else \
+                          0xffff                    if op2 == OP2_N1     else \
+                          1                         if op2 == OP2_P1     else \
+                          0
+                e.wbdata = Fast.alu(cs[CS_ALU_FUN], alu1, alu2)
+            elif cls == CL_MEM:
+                e.mem_addr = e.rs1_data + e.dec[DC_IMM_S]
+                e.wbdata = 0
+            else:
+                br_type = cs[CS_BR_TYPE]
+                if br_type == BrJ_B:
+                    alu_out = Fast.alu(cs[CS_ALU_FUN], e.rs1_data, e.rs2_data)
+                    flags   = (0b01 if alu_out == 0 else 0b00) | \
+                              (0b10 if alu_out & 0x8000 else 0b00)
+                    if (flags & cs[CS_BR_MASK]) == cs[CS_BR_COND]:
+                        e.pc_next = (e.pc + 1 + e.dec[DC_IMM_I]) & 0xffff
+                elif br_type == BrJ_I:
+                    e.pc_next = e.rs1_data
+                if br_type in (BrJ_B, BrJ_I):
+                    # Train the predictors, and redirect IF if they were wrong
+                    resolve(self.predictor, self.btb, e.pc, e.dec, e.pc_next)
+                    stat.bp_count += 1
+                    if e.pc_next != e.pred_next:
+                        stat.bp_miss += 1
+                        stat.bp_penalty += Pipe.MISPREDICT_PENALTY
+                        redirect = e.pc_next
+                e.wbdata = pc_plus1 if cs[CS_WB_SEL] == WB_PC1 else 0
+        ex_out = e
+
+        #------------------------------------------------------------------
+        # ID: decode, read operands, and resolve jumps
+
+        d = self.if_id
+        stall = False
+        id_redirect = None
+        if d.valid and d.exc == EXC_NONE:
+            dec = decode_table[d.inst]
+            if dec is None or dec[DC_CS] is None:
+                d.exc = EXC_ILLEGAL_INST
+            else:
+                d = self.decode(d, dec)
+                cs = dec[DC_CS]
+                if cs[CS_RS1_OEN]:
+                    d.rs1_data, stall = self.operand(dec[DC_RS], ex_out, mm_out)
+                if cs[CS_RS2_OEN] and not stall:
+                    d.rs2_data, stall = self.operand(dec[DC_RT], ex_out, mm_out)
+                if cs[CS_BR_TYPE] == BrJ_J:
+                    id_redirect = (d.pc & 0xf000) | dec[DC_IMM_J]
+                    d.pc_next = id_redirect
+
+        #------------------------------------------------------------------
+        # IF: fetch the next instruction
+
+        inst, ok = cpu.dmem.access(True, self.pc, 0, M_XRD)
+        f = Latch(self.pc, int(inst)) if ok else Latch(self.pc, 0, EXC_IMEM_ERROR)
+        if ok:
+            dec = decode_table[f.inst]
+            if dec is not None and dec[DC_CS] is not None:
+                f.pred_next = predict_next(self.predictor, self.btb, self.pc, dec)
+
+        #------------------------------------------------------------------
+        # Update the pipeline registers
+
+        self.mm_wb = mm_out
+        self.ex_mm = ex_out
+        if redirect is not None:
+            # Flush the instructions in ID and IF
+            stat.flushes += d.valid + f.valid
+            self.id_ex  = BUBBLE_LATCH
+            self.if_id  = BUBBLE_LATCH
+            self.pc     = redirect
+        elif stall:
+            # Keep the instructions in ID and IF, and insert a bubble
+            stat.stalls += 1
+            self.id_ex  = BUBBLE_LATCH
+        elif id_redirect is not None:
+            # Flush the instruction in IF
+            stat.flushes += f.valid
+            self.id_ex  = d
+            self.if_id  = BUBBLE_LATCH
+            self.pc     = id_redirect
+        else:
+            self.id_ex  = d
+            self.if_id  = f
+            self.pc     = f.pred_next
+        return EXC_NONE
+
+    def decode(self, d, dec):
+        """
+        returns a new latch for the instruction in d with its decoded fields
+        """
+        pred_next = d.pred_next
+        d = Latch(d.pc, d.inst)
+        d.dec = dec
+        d.pred_next = pred_next
+        cs = dec[DC_CS]
+        cls = dec[DC_CLASS]
+        dest = cs[CS_DEST_SEL]
+        rdest = dec[DC_RD]          if dest == DEST_RD   else \
+                dec[DC_RT]          if dest == DEST_RT   else \
+                2                   if dest == DEST_R2   else \
+                0
+
+        # Simple writes the ALU output even for DEST_X (to $0)
+        if cls == CL_ALU:
+            d.wen, d.rdest = True, rdest
+        elif cls == CL_MEM:
+            d.wen, d.rdest = cs[CS_MEM_FCN] == M_XRD, dec[DC_RT]
+        else:
+            d.wen, d.rdest = bool(cs[CS_RF_WEN]), rdest
+        d.pc_next = (d.pc + 1) & 0xffff
+        return d
+
+    def operand(self, r, ex_out, mm_out):
+        """
+        returns (value of R[r], stall) for an instruction in ID, given the
+        instructions leaving EX and MM in this cycle
+        """
+        e = self.id_ex
+        m = self.ex_mm
+        e_writes = e.valid and e.exc == EXC_NONE and e.wen and e.rdest == r
+        m_writes = m.valid and m.exc == EXC_NONE and m.wen and m.rdest == r
+
+        if not self.forwarding:
+            return self.reg[r], (e_writes or m_writes)
 
-        info = isa[opcode]
-        cs = csignals[opcode]
-        return Simple.func[info[IN_CLASS]](pc, inst, cs)
+        if e_writes:
+            if e.dec[DC_CLASS] == CL_MEM:
+                return 0, True          # load-use hazard
+            return ex_out.wbdata, False # FWD_EX
+        if m_writes:
+            return mm_out.wbdata, False # FWD_MM
+        return self.reg[r], False
 
+    def log_stages(self):
+        """
+        shows the instruction in each stage at the start of a cycle
+        """
+        cycle = self.stat.cycle
+        stages = [ ('IF', Latch(self.pc, 0)), ('ID', self.if_id), ('EX', self.id_ex),
+                   ('MM', self.ex_mm), ('WB', self.mm_wb) ]
+        for (name, latch) in stages:
+            if name == 'IF':
+                inst, ok = self.cpu.dmem.access(True, self.pc, 0, M_XRD)
+                text = "0x%04x:  %s" % (self.pc, Program.disasm(self.pc, inst) if ok else "(imem error)")
+            elif not latch.valid:
+                text = "BUBBLE"
+            else:
+                text = "0x%04x:  %s" % (latch.pc, Program.disasm(latch.pc, latch.inst))
+            print("%5d [%s] %s" % (cycle, name, text), file = self.trace.out)
@@ -11,6 +11,12 @@
 #
 #==========================================================================
 
+import mmap
+import os
+import random
+import sys
+from array import array
+
 from sim_consts import *
 from isa import *
 
@@ -52,20 +58,20 @@ class RegisterFile(object):
         else:
             raise ValueError
 
-    def dump(self, columns = 4):
+    def dump(self, columns = 4, out = None):
         """
         dump register file contents
         """
-        print("Registers")
-        print("=" * 9)
+        lines = [ "Registers", "=" * 9 ]
         for c in range (0, NUM_REGS, columns):
             str = ""
             for r in range (c, min(NUM_REGS, c + columns)):
                 val = self.reg[r]
                 str += "%-6s0x%04x    " % ("$%d:" % (r), val)
-            print(str)
+            lines.append(str)
 
-        print("")
+        lines.append("")
+        print("\n".join(lines), file = out)
 
 
 #--------------------------------------------------------------------------
@@ -96,18 +102,68 @@ class Register(object):
 
 class Memory(object):
 
+    # Words are kept in host byte order; images are big-endian
+    SWAP_BYTES  = sys.byteorder == 'little'
+
+    # Memory is allocated lazily, one page at a time
+    PAGE_SHIFT  = 8
+    PAGE_SIZE   = 1 << PAGE_SHIFT       # words per page
+    PAGE_MASK   = PAGE_SIZE - 1
+
+    # Shared by all pages that were never written; it is never modified
+    ZERO_PAGE   = array('H', [ 0 ]) * PAGE_SIZE
+
     def __init__(self, mem_start, mem_size, word_size):
         self.word_size  = word_size
-        self.mem_start  = mem_start
-        self.mem_end    = mem_start + mem_size
-        self.mem        = bytearray(mem_size * word_size)
+        self.mem_start  = int(mem_start)
+        self.mem_end    = self.mem_start + int(mem_size)
+        npages          = (int(mem_size) + Memory.PAGE_MASK) >> Memory.PAGE_SHIFT
+        self.pages      = [ Memory.ZERO_PAGE ] * npages
+        self.mmap       = None
+
+    def map(self, filename):
+        """
+        backs the whole memory with filename, so that every word written
+        lands in the file. Words are stored in host byte order. An existing
+        file provides the initial memory contents.
+        """
+        nbytes = (len(self.pages) << Memory.PAGE_SHIFT) * self.word_size
+        with open(filename, 'r+b' if os.path.exists(filename) else 'w+b') as f:
+            if os.fstat(f.fileno()).st_size < nbytes:
+                f.truncate(nbytes)
+            self.mmap = mmap.mmap(f.fileno(), nbytes)
+
+        view = memoryview(self.mmap).cast('H')
+        for index, page in enumerate(self.pages):
+            mapped = view[index << Memory.PAGE_SHIFT:(index + 1) << Memory.PAGE_SHIFT]
+            if page is not Memory.ZERO_PAGE:
+                mapped[:] = page
+            self.pages[index] = mapped
+
+    def flush(self):
+        if self.mmap is not None:
+            self.mmap.flush()
+
+    def page(self, index):
+        """
+        returns page #index (counted from mem_start), allocating it if needed
+        """
+        page = self.pages[index]
+        if page is Memory.ZERO_PAGE:
+            page = array('H', Memory.ZERO_PAGE)
+            self.pages[index] = page
+        return page
+
+    def allocated(self):
+        """
+        returns the number of allocated pages
+        """
+        return sum(page is not Memory.ZERO_PAGE for page in self.pages)
 
     def access(self, valid, addr, data, fcn):
         """
         access memory
         """
-        offset = addr - self.mem_start
-        span = slice(offset*self.word_size, offset*self.word_size+self.word_size)
         if (not valid):
             # memory exceptions are ignored for bubble
             res = ( WORD(0), True )
@@ -116,11 +172,12 @@ class Memory(object):
             res = ( WORD(0) , False )
         elif fcn == M_XRD:
             # access: read
-            val = int.from_bytes(self.mem[span], 'big')
-            res = ( WORD(val), True )
+            offset = int(addr) - self.mem_start
+            res = ( WORD(self.pages[offset >> Memory.PAGE_SHIFT][offset & Memory.PAGE_MASK]), True )
         elif fcn == M_XWR:
             # access: write
-            self.mem[span] = int(data).to_bytes(self.word_size, 'big')
+            offset = int(addr) - self.mem_start
+            self.page(offset >> Memory.PAGE_SHIFT)[offset & Memory.PAGE_MASK] = int(data)
             res = ( WORD(0), True )
         else:
             # exception: undefined operation
@@ -128,45 +185,231 @@ class Memory(object):
 
         return res
 
+    def chunks(self, offset, nwords):
+        """
+        splits nwords words from offset into (page index, start, end) spans
+        """
+        end = offset + nwords
+        while offset < end:
+            index = offset >> Memory.PAGE_SHIFT
+            start = offset & Memory.PAGE_MASK
+            stop  = min(Memory.PAGE_SIZE, start + end - offset)
+            yield index, start, stop
+            offset += stop - start
+
     def copy_to(self, addr, data):
         if (addr < self.mem_start) or (addr * self.word_size + len(data) > self.mem_end * self.word_size):
             raise Exception(f"Cannot copy data into memory: invalid address {addr:08x} - {addr+(len(data)-1)//(self.word_size)+1:08x}")
 
         offset = addr - self.mem_start
-        span = slice(offset*self.word_size, offset*self.word_size+len(data))
-        self.mem[span] = data
+        nwords = (len(data) + self.word_size - 1) // self.word_size
+        if len(data) % self.word_size:
+            # a trailing odd byte only replaces the high byte of its word
+            data = bytes(data) + self.copy_from(addr + nwords - 1, self.word_size)[len(data) % self.word_size:]
+
+        # Convert one page at a time: data may be a large memoryview/mmap
+        data = memoryview(data).cast('B')
+        pos = 0
+        for index, start, stop in self.chunks(offset, nwords):
+            nbytes = (stop - start) * self.word_size
+            words = array('H')
+            words.frombytes(data[pos:pos+nbytes])
+            if Memory.SWAP_BYTES:
+                words.byteswap()
+            self.page(index)[start:stop] = words
+            pos += nbytes
 
     def copy_from(self, addr, nbytes):
         if (addr < self.mem_start) or (addr * self.word_size + nbytes > self.mem_end * self.word_size):
-            raise Exception(f"Cannot copy data from memory: invalid address {addr:08x} - {addr+(len(data)-1)//(self.word_size)+1:08x}")
+            raise Exception(f"Cannot copy data from memory: invalid address {addr:08x} - {addr+(nbytes-1)//(self.word_size)+1:08x}")
 
-        data = bytearray(nbytes)
         offset = addr - self.mem_start
-        data[0:nbytes] = self.mem[offset:offset+nbytes]
+        nwords = (nbytes + self.word_size - 1) // self.word_size
+        words = array('H')
+        for index, start, stop in self.chunks(offset, nwords):
+            words.frombytes(memoryview(self.pages[index][start:stop]).cast('B'))
+        if Memory.SWAP_BYTES:
+            words.byteswap()
 
-        return data
+        return bytearray(words.tobytes()[:nbytes])
 
-    def dump(self, skipzero = False):
+    def write_to(self, f, addr, nbytes):
+        """
+        writes nbytes from addr to the file f, one page at a time. Pages are
+        written straight from memory unless their bytes need swapping.
+        """
+        if (addr < self.mem_start) or (addr * self.word_size + nbytes > self.mem_end * self.word_size):
+            raise Exception(f"Cannot copy data from memory: invalid address {addr:08x} - {addr+(nbytes-1)//(self.word_size)+1:08x}")
 
-        print("Memory 0x%08x - 0x%08x" % (self.mem_start, self.mem_end - 1))
-        print("=" * 30)
+        offset = addr - self.mem_start
+        nwords = (nbytes + self.word_size - 1) // self.word_size
+        for index, start, stop in self.chunks(offset, nwords):
+            # Slicing the page itself would copy it: slice a view of it
+            data = memoryview(self.pages[index])[start:stop].cast('B')
+            if Memory.SWAP_BYTES:
+                words = array('H')
+                words.frombytes(data)
+                words.byteswap()
+                data = memoryview(words).cast('B')
+            data = data[:nbytes]
+            f.write(data)
+            nbytes -= len(data)
+
+    def dump(self, skipzero = False, out = None):
+
+        lines = [ "Memory 0x%08x - 0x%08x" % (self.mem_start, self.mem_end - 1), "=" * 30 ]
         skipz = False
         printsz = True
 
-        adr_range=range(self.mem_start, self.mem_end)
-        for a in adr_range:
-            val, status = self.access(True, a, 0, M_XRD)
-            if not status:
-                continue
-            if (not skipzero) or (not skipz) or (val != 0) or (a == adr_range[-1]):
-                skipz = val == 0
-                printsz = True
-                print("0x%04x: " % a, ' '.join("%02x" % ((val >> i) & 0xff) for i in [8, 0]), " (0x%04x)" % val)
-            elif printsz:
-                printsz = False
-                print("             ...")
+        last = self.mem_end - 1
+        for index, page in enumerate(self.pages):
+            base = self.mem_start + (index << Memory.PAGE_SHIFT)
+            size = min(Memory.PAGE_SIZE, self.mem_end - base)
+            if skipzero and page is Memory.ZERO_PAGE:
+                # A page of zeros shows at most its first word, "...", and
+                # the last word of the memory: visit only those words.
+                addrs = [ base ]
+                if size > 1:
+                    addrs.append(base + 1)
+                if base + size - 1 == last and last not in addrs:
+                    addrs.append(last)
+            else:
+                addrs = range(base, base + size)
+
+            for a in addrs:
+                val = page[a - base]
+                if (not skipzero) or (not skipz) or (val != 0) or (a == last):
+                    skipz = val == 0
+                    printsz = True
+                    lines.append("0x%04x:  %02x %02x  (0x%04x)" % (a, val >> 8, val & 0xff, val))
+                elif printsz:
+                    printsz = False
+                    lines.append("             ...")
+
+        lines.append("")
+        print("\n".join(lines), file = out)
+
+
+#--------------------------------------------------------------------------
+#   Cache: models the timing of a set-associative cache
+#--------------------------------------------------------------------------
+#
+#   A cache only keeps the tags of the blocks it holds: data always stays
+#   in Memory, so a cache never changes the results of a program, only its
+#   cycle count. access() returns the stall cycles of an access:
+#   * a miss costs miss_latency cycles to fill the block, plus another
+#     miss_latency cycles to write back a dirty victim (write-back).
+#   * with write-through, writes go to memory through a write buffer and
+#     never stall, and a write miss does not allocate the block.
+#
+#   Tags, dirty bits and replacement stamps are kept in flat arrays of
+#   sets * ways entries; line k of set s is entry s * ways + k.
+
+class Cache(object):
+
+    POLICIES    = [ 'lru', 'fifo', 'random' ]
+    INVALID     = -1
+
+    def __init__(self, name, size, block_size = 1, ways = 1, policy = 'lru',
+                 write_back = True, miss_latency = 10):
+        for (what, value) in (('size', size), ('block size', block_size), ('ways', ways)):
+            if value <= 0 or value & (value - 1):
+                raise ValueError(f"cache {what} must be a power of 2: {value}")
+        if block_size * ways > size:
+            raise ValueError(f"cache of {size} words cannot hold {ways} blocks of {block_size} words")
+        if policy not in Cache.POLICIES:
+            raise ValueError(f"unknown replacement policy: {policy}")
+
+        self.name           = name
+        self.size           = size
+        self.block_size     = block_size
+        self.ways           = ways
+        self.sets           = size // (block_size * ways)
+        self.policy         = policy
+        self.write_back     = write_back
+        self.miss_latency   = miss_latency
+
+        self.block_shift    = block_size.bit_length() - 1
+        self.set_mask       = self.sets - 1
+        self.lru            = policy == 'lru'
+        self.rng            = random.Random(0)     # repeatable 'random' runs
+
+        lines               = self.sets * ways
+        self.tags           = array('l', [ Cache.INVALID ]) * lines  # block number
+        self.dirty          = array('B', bytes(lines))
+        self.stamp          = array('Q', bytes(8 * lines))       # last use or fill
+
+        self.clock          = 0     # number of accesses, for the stamps
+        self.hits           = 0
+        self.misses         = 0
+        self.evictions      = 0
+        self.writebacks     = 0
+        self.stall_cycles   = 0
+
+    def access(self, addr, write):
+        """
+        looks up the block of addr, returns the number of stall cycles
+        """
+        block       = addr >> self.block_shift
+        base        = (block & self.set_mask) * self.ways
+        self.clock += 1
+        try:
+            line    = self.tags.index(block, base, base + self.ways)
+        except ValueError:
+            return self.miss(block, base, write)
+
+        self.hits  += 1
+        if self.lru:
+            self.stamp[line] = self.clock
+        if write and self.write_back:
+            self.dirty[line] = 1
+        return 0
+
+    def miss(self, block, base, write):
+        """
+        fills block into its set, returns the number of stall cycles
+        """
+        self.misses += 1
+        if write and not self.write_back:
+            return 0
+
+        tags        = self.tags
+        try:
+            line    = tags.index(Cache.INVALID, base, base + self.ways)
+        except ValueError:
+            if self.policy == 'random':
+                line = base + self.rng.randrange(self.ways)
+            else:
+                line = min(range(base, base + self.ways), key = self.stamp.__getitem__)
+            self.evictions += 1
+
+        cycles      = self.miss_latency
+        if self.dirty[line]:
+            self.writebacks += 1
+            cycles += self.miss_latency
+
+        tags[line]          = block
+        self.dirty[line]    = write and self.write_back
+        self.stamp[line]    = self.clock
+        self.stall_cycles  += cycles
+        return cycles
+
+    def config(self):
+        """
+        returns the configuration as in the machine names, e.g. U16-4-1
+        """
+        return "%s%d-%d-%d" % (self.name, self.size, self.block_size, self.ways)
 
-        print("")
+    def show(self):
+        accesses = self.hits + self.misses
+        title = { 'U': "Unified cache", 'I': "I-cache", 'D': "D-cache" }.get(self.name, self.name)
+        print("%s (%s, %s, %s):" % (title, self.config(), self.policy,
+                                    "write-back" if self.write_back else "write-through"))
+        print("  Hits:       %d (%.2f%%)" % (self.hits, 0.0 if accesses == 0 else self.hits * 100.0 / accesses))
+        print("  Misses:     %d (%.2f%%)" % (self.misses, 0.0 if accesses == 0 else self.misses * 100.0 / accesses))
+        print("  Evictions:  %d" % self.evictions)
+        print("  Writebacks: %d" % self.writebacks)
+        print("  Stalls:     %d cycles" % self.stall_cycles)
 
 
 #--------------------------------------------------------------------------
@@ -175,41 +418,41 @@ class Memory(object):
 
 class ALU(object):
 
+    # Output of each ALU function (others, e.g. ALU_X: 0)
+    FUNCS = {
+        ALU_ADD     : lambda alu1, alu2: WORD(alu1 + alu2),
+        ALU_SUB     : lambda alu1, alu2: WORD(alu1 - alu2),
+        ALU_AND     : lambda alu1, alu2: WORD(alu1 & alu2),
+        ALU_OR      : lambda alu1, alu2: WORD(alu1 | alu2),
+        ALU_XOR     : lambda alu1, alu2: WORD(alu1 ^ alu2),
+        ALU_SLT     : lambda alu1, alu2: WORD(1) if SWORD(alu1) < SWORD(alu2) else WORD(0),
+        ALU_SLTU    : lambda alu1, alu2: WORD(1) if alu1 < alu2 else WORD(0),
+        ALU_SLL     : lambda alu1, alu2: WORD(alu1 << (alu2 & 0x1f)),
+        ALU_SRA     : lambda alu1, alu2: WORD(SWORD(alu1) >> (alu2 & 0x1f)),
+        ALU_SRL     : lambda alu1, alu2: alu1 >> (alu2 & 0x1f),
+        ALU_COPY1   : lambda alu1, alu2: alu1,
+        ALU_COPY2   : lambda alu1, alu2: alu2,
+    }
+
     def __init__(self):
         pass
 
     def op(self, alufun, alu1, alu2):
 
         np.seterr(all='ignore')
-        if alufun == ALU_ADD:
-            output = WORD(alu1 + alu2)
-        elif alufun == ALU_SUB:
-            output = WORD(alu1 - alu2)
-        elif alufun == ALU_AND:
-            output = WORD(alu1 & alu2)
-        elif alufun == ALU_OR:
-            output = WORD(alu1 | alu2)
-        elif alufun == ALU_XOR:
-            output = WORD(alu1 ^ alu2)
-        elif alufun == ALU_SLT:
-            output = WORD(1) if SWORD(alu1) < SWORD(alu2) else WORD(0)
-        elif alufun == ALU_SLTU:
-            output = WORD(1) if alu1 < alu2 else WORD(0)
-        elif alufun == ALU_SLL:
-            output = WORD(alu1 << (alu2 & 0x1f))
-        elif alufun == ALU_SRA:
-            output = WORD(SWORD(alu1) >> (alu2 & 0x1f))
-        elif alufun == ALU_SRL:
-            output = alu1 >> (alu2 & 0x1f)
-        elif alufun == ALU_COPY1:
-            output = alu1
-        elif alufun == ALU_COPY2:
-            output = alu2
+        return self.fun(alufun)(alu1, alu2)
 
-        else:
-            output = WORD(0)
+    @staticmethod
+    def fun(alufun):
+        """
+        returns the function computing alufun, for datapaths which select
+        it before the operands arrive
+        """
+        return ALU.FUNCS.get(alufun, ALU.zero)
 
-        return output
+    @staticmethod
+    def zero(alu1, alu2):
+        return WORD(0)
 
 
 #--------------------------------------------------------------------------
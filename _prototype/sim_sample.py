@@ -0,0 +1,365 @@
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Sampled simulation with basic block vectors, in the style of SimPoint
+#
+#==========================================================================
+
+import contextlib
+import io
+import math
+import sys
+import time
+
+import numpy as np
+
+from sim_consts import *
+from program import *
+from sim_dbt import *
+
+
+#--------------------------------------------------------------------------
+#   Metrics: per-instruction rates measured on the detailed machine
+#--------------------------------------------------------------------------
+#
+#   Each metric is the ratio of two counters over a sample, and is only
+#   reported when the machine has the hardware that counts it.
+
+METRICS = [ ('CPI',                 'cycle',        'icount'),
+            ('I-cache miss rate',   'imiss',        'iaccess'),
+            ('D-cache miss rate',   'dmiss',        'daccess'),
+            ('cache miss rate',     'umiss',        'uaccess'),
+            ('BP miss rate',        'bp_miss',      'bp_count') ]
+
+def counters(cpu):
+    """
+    returns the counters of the metrics in cpu
+    """
+    c = { 'cycle': cpu.stat.cycle, 'icount': cpu.stat.icount,
+          'bp_miss': cpu.stat.bp_miss, 'bp_count': cpu.stat.bp_count }
+    if cpu.icache is not None:
+        caches = [ ('u', cpu.icache) ] if cpu.icache is cpu.dcache else \
+                 [ ('i', cpu.icache), ('d', cpu.dcache) ]
+        for (name, cache) in caches:
+            c[name + 'miss']    = cache.misses
+            c[name + 'access']  = cache.hits + cache.misses
+    return c
+
+
+def metrics(cpu):
+    """
+    returns the names of the metrics which cpu counts
+    """
+    c = counters(cpu)
+    return [ name for (name, num, den) in METRICS if den in c and
+             (num != 'bp_miss' or cpu.stat.pipelined) ]
+
+
+def rates(before, after):
+    """
+    returns each metric over the run between two counters() results
+    """
+    d = { key: after[key] - before[key] for key in after }
+    return { name: 0.0 if d[den] == 0 else d[num] / d[den]
+             for (name, num, den) in METRICS if den in d }
+
+
+def run_for(cpu, pc, count):
+    """
+    runs cpu from pc until it has executed count more instructions or it
+    stops, returns (status, pc). A detailed machine stops only at a cycle
+    limit, so it runs for the instructions left times the CPI so far (at
+    first 1, the lowest possible), until it gets there. The last run may
+    overshoot by a few instructions. A pipeline restarts empty, and loses
+    a few cycles each time, which keeps the number of runs low. It retires
+    nothing for a few cycles, so the limit grows while nothing retires.
+    """
+    (start, cycle) = (cpu.stat.icount, cpu.stat.cycle)
+    target  = start + count
+    status  = EXC_NONE
+    slack   = 1
+    with contextlib.redirect_stdout(io.StringIO()):
+        while cpu.stat.icount < target:
+            icount = cpu.stat.icount
+            cpi    = 1.0 if icount == start else (cpu.stat.cycle - cycle) / (icount - start)
+            cpu.max_cycles = cpu.stat.cycle + max(int((target - icount) * cpi), slack)
+            status = cpu.run(pc)
+            pc = int(cpu.pc.read())
+            if not status == EXC_LIMIT:
+                break
+            if cpu.stat.icount == icount:
+                slack *= 2
+    return (status, pc)
+
+
+#--------------------------------------------------------------------------
+#   Clustering: k-means on basic block vectors, k chosen by the BIC
+#--------------------------------------------------------------------------
+
+PROJECTED_DIMS  = 15        # dimensions of the random projection (as in SimPoint)
+KMEANS_SEEDS    = 5         # k-means runs per k, the best one is kept
+BIC_THRESHOLD   = 0.9       # smallest k whose BIC is within 90% of the best
+
+def kmeans(points, k, rng, iterations = 100):
+    """
+    clusters points (one row each) into at most k clusters, seeded with
+    k-means++. Returns (labels, centers, sum of squared distances).
+    """
+    n       = len(points)
+    centers = [ points[rng.integers(n)] ]
+    for _ in range(1, k):
+        d2 = ((points[:, None, :] - np.array(centers)[None, :, :]) ** 2).sum(axis=2).min(axis=1)
+        if d2.sum() == 0:
+            break
+        centers.append(points[rng.choice(n, p=d2 / d2.sum())])
+    centers = np.array(centers)
+
+    labels  = None
+    for _ in range(iterations):
+        d2      = ((points[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        new     = d2.argmin(axis=1)
+        if labels is not None and (new == labels).all():
+            break
+        labels  = new
+        for j in range(len(centers)):
+            if (labels == j).any():
+                centers[j] = points[labels == j].mean(axis=0)
+    sse = float(((points - centers[labels]) ** 2).sum())
+    return (labels, centers, sse)
+
+
+def bic(points, labels, centers, sse):
+    """
+    Bayesian information criterion of a clustering, as in X-means
+    """
+    (r, m)  = points.shape
+    k       = len(centers)
+    if r <= k:
+        return -math.inf
+    var     = max(sse / (r - k), 1e-12)
+    ll      = 0.0
+    for j in range(k):
+        rn = int((labels == j).sum())
+        if rn == 0:
+            continue
+        ll += rn * math.log(rn) - rn * math.log(r) - rn / 2 * math.log(2 * math.pi) \
+              - rn * m / 2 * math.log(var) - (rn - k) / 2
+    return ll - ((k - 1) + m * k + 1) / 2 * math.log(r)
+
+
+def cluster(vectors, lengths, max_k, rng):
+    """
+    returns (labels, distances to the centers) for the basic block vectors
+    of the intervals
+    """
+    blocks  = sorted({ pc for vec in vectors for pc in vec })
+    column  = { pc: j for (j, pc) in enumerate(blocks) }
+    points  = np.zeros((len(vectors), len(blocks)))
+    for (i, vec) in enumerate(vectors):
+        for (pc, count) in vec.items():
+            points[i, column[pc]] = count / lengths[i]
+    if len(blocks) > PROJECTED_DIMS:
+        points = points @ rng.uniform(-1.0, 1.0, (len(blocks), PROJECTED_DIMS))
+
+    runs = []
+    for k in range(1, min(max_k, len(vectors)) + 1):
+        best = min((kmeans(points, k, rng) for _ in range(KMEANS_SEEDS)), key=lambda run: run[2])
+        runs.append((bic(points, *best), best))
+    scores  = [ score for (score, _) in runs if score > -math.inf ] or [ 0.0 ]
+    (low, high) = (min(scores), max(scores))
+    (_, (labels, centers, _)) = next((run for run in runs
+                                      if run[0] >= low + BIC_THRESHOLD * (high - low)), runs[0])
+
+    # Renumber the clusters in order of their first interval
+    order   = { j: n for (n, j) in enumerate(dict.fromkeys(labels.tolist())) }
+    dist    = ((points - centers[labels]) ** 2).sum(axis=1)
+    return ([ order[j] for j in labels.tolist() ], dist)
+
+
+#--------------------------------------------------------------------------
+#   Sampler: profiles, clusters, and simulates the chosen intervals
+#--------------------------------------------------------------------------
+#
+#   1. The whole program runs functionally (FastForward), and the basic
+#      block vector of each interval of N instructions is collected.
+#   2. The intervals are clustered. The interval closest to the center of
+#      each cluster, and a few more at random, are the samples.
+#   3. The program runs functionally again, and a checkpoint (Snapshot) is
+#      taken a warm-up before each sample. A new detailed machine starts
+#      from each checkpoint, warms up its caches and predictor, and then
+#      measures the sample.
+#   4. Each metric is extrapolated by weighting the mean of the samples in
+#      each cluster by its share of the instructions. The clusters are the
+#      strata of a stratified sample, which gives the error estimate.
+
+class Sampler(object):
+
+    def __init__(self, new_machine, interval, max_k = 10, per_cluster = 2, warmup = 2000, seed = 0):
+        """
+        new_machine() returns a new detailed machine. Samples are interval
+        instructions long, each one from one of at most max_k clusters.
+        """
+        self.new_machine    = new_machine
+        self.interval       = interval
+        self.max_k          = max_k
+        self.per_cluster    = per_cluster
+        self.warmup         = warmup
+        self.rng            = np.random.default_rng(seed)
+        self.times          = {}
+
+    def run(self, cpu, entry_point, limit = None, validate = False, f = sys.stdout):
+        """
+        samples the program in cpu from entry_point, up to limit instructions,
+        and writes the report to f. With validate, the whole program is also
+        simulated in detail for comparison.
+        """
+        cpu.pc.write(entry_point)
+        self.start      = Snapshot.dumps(cpu)
+        self.names      = metrics(cpu)
+
+        self.profile(limit)
+        self.choose()
+        self.simulate()
+        self.estimate()
+        self.report(f)
+        if validate:
+            self.validate(f)
+
+    def profile(self, limit):
+        """
+        runs the program functionally and collects the basic block vectors
+        """
+        start   = time.perf_counter()
+        cpu     = self.new_machine()
+        (pc, _) = Snapshot.loads(cpu, self.start)
+        ff      = FastForward(cpu)
+        limit   = sys.maxsize if limit is None else limit
+
+        self.vectors    = []
+        self.lengths    = []
+        total           = 0
+        while total < limit:
+            bbv = {}
+            n   = ff.advance(pc, min(self.interval, limit - total), bbv)
+            pc  = int(cpu.pc.read())
+            if n == 0:
+                break
+            self.vectors.append(bbv)
+            self.lengths.append(n)
+            total += n
+            if n < self.interval:
+                break
+        self.total = total
+        self.times['profile'] = time.perf_counter() - start
+
+    def choose(self):
+        """
+        clusters the intervals and picks the samples of each cluster
+        """
+        start   = time.perf_counter()
+        if not self.vectors:
+            raise Exception("the program did not run any instruction")
+        (self.labels, dist) = cluster(self.vectors, self.lengths, self.max_k, self.rng)
+        self.k  = max(self.labels) + 1
+
+        self.members = [ [ i for (i, j) in enumerate(self.labels) if j == h ] for h in range(self.k) ]
+        self.samples = []
+        for members in self.members:
+            first   = min(members, key=lambda i: dist[i])
+            others  = [ i for i in members if i != first ]
+            extra   = min(self.per_cluster - 1, len(others))
+            self.samples.append([ first ] + sorted(self.rng.choice(others, extra, replace=False).tolist()))
+        self.times['cluster'] = time.perf_counter() - start
+
+    def simulate(self):
+        """
+        simulates each sample from a checkpoint taken a warm-up before it
+        """
+        start   = time.perf_counter()
+        cpu     = self.new_machine()
+        (pc, _) = Snapshot.loads(cpu, self.start)
+        ff      = FastForward(cpu)
+        done    = 0
+
+        self.results    = {}
+        self.detailed   = 0
+        for i in sorted(i for samples in self.samples for i in samples):
+            begin   = i * self.interval
+            warm    = min(self.warmup, begin)
+            done   += ff.advance(pc, begin - warm - done)
+            pc      = int(cpu.pc.read())
+            checkpoint = Snapshot.dumps(cpu)
+
+            detailed = self.new_machine()
+            detailed.log.level = 0
+            (at, _) = Snapshot.loads(detailed, checkpoint)
+            (status, at) = run_for(detailed, at, warm)
+            before  = counters(detailed)
+            (status, at) = run_for(detailed, at, self.lengths[i])
+            self.results[i] = rates(before, counters(detailed))
+            self.detailed  += detailed.stat.icount
+        self.times['simulate'] = time.perf_counter() - start
+
+    def estimate(self):
+        """
+        extrapolates each metric, with the standard error of the estimate
+        """
+        self.estimates = {}
+        for name in self.names:
+            value   = 0.0
+            var     = 0.0
+            for (members, samples) in zip(self.members, self.samples):
+                w   = sum(self.lengths[i] for i in members) / self.total
+                x   = [ self.results[i][name] for i in samples ]
+                n   = len(x)
+                value += w * sum(x) / n
+                if n > 1:
+                    s2  = sum((v - sum(x) / n) ** 2 for v in x) / (n - 1)
+                    var += w * w * (1 - n / len(members)) * s2 / n
+            self.estimates[name] = (value, math.sqrt(var))
+
+    def report(self, f):
+        print(f"Sampling: {len(self.vectors)} intervals of {self.interval} instructions "
+              f"({self.total} instructions) profiled in {self.times['profile']:.3f} s", file=f)
+        print(f"Clusters: {self.k} (BIC, at most {self.max_k}), chosen in {self.times['cluster']:.3f} s", file=f)
+        print("", file=f)
+
+        print("%7s %9s %7s  %-16s" % ("cluster", "intervals", "weight", "samples")
+              + "".join(" %18s" % name for name in self.names), file=f)
+        for h in range(self.k):
+            w = sum(self.lengths[i] for i in self.members[h]) * 100.0 / self.total
+            print("%7d %9d %6.2f%%  %-16s" % (h, len(self.members[h]), w,
+                  ",".join(str(i) for i in self.samples[h]))
+                  + "".join(" %18.4f" % (sum(self.results[i][name] for i in self.samples[h])
+                                         / len(self.samples[h])) for name in self.names), file=f)
+        print("", file=f)
+
+        nsamples = sum(len(samples) for samples in self.samples)
+        print(f"{nsamples} samples with a {self.warmup}-instruction warm-up: {self.detailed} instructions "
+              f"({self.detailed * 100.0 / self.total:.2f}%) simulated in detail "
+              f"in {self.times['simulate']:.3f} s", file=f)
+        for name in self.names:
+            (value, se) = self.estimates[name]
+            print("Estimated %-18s %10.4f +/- %.4f (95%%)" % (name + ":", value, 1.96 * se), file=f)
+        if any(len(samples) == 1 < len(members) for (members, samples) in zip(self.members, self.samples)):
+            print("(clusters with a single sample add nothing to the error estimate)", file=f)
+
+    def validate(self, f):
+        """
+        simulates the whole program in detail, and compares it with the estimates
+        """
+        start   = time.perf_counter()
+        cpu     = self.new_machine()
+        cpu.log.level = 0
+        (pc, _) = Snapshot.loads(cpu, self.start)
+        before  = counters(cpu)
+        run_for(cpu, pc, self.total)
+        actual  = rates(before, counters(cpu))
+        print("", file=f)
+        print(f"Full simulation: {cpu.stat.icount - before['icount']} instructions "
+              f"in {time.perf_counter() - start:.3f} s", file=f)
+        for name in self.names:
+            (value, se) = self.estimates[name]
+            print("Actual    %-18s %10.4f (error %+.4f, %.2f standard errors)" % (name + ":", actual[name],
+                  value - actual[name], 0.0 if se == 0 else abs(value - actual[name]) / se), file=f)
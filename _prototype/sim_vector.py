@@ -0,0 +1,326 @@
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Lockstep simulation of many single-cycle machines with NumPy
+#
+#==========================================================================
+
+import sys
+import time
+from array import array
+
+import numpy as np
+
+from isa import *
+from sim_consts import *
+from sim_control import *
+from sim_modules import *
+from program import *
+
+
+#--------------------------------------------------------------------------
+#   Decode arrays: decode_table as NumPy arrays indexed by instruction word
+#--------------------------------------------------------------------------
+
+# Distinct opcodes which can be executed, and their control signals
+VEC_OPCODES     = sorted({ dec[DC_OPCODE] for dec in decode_table
+                           if dec is not None and dec[DC_CS] is not None })
+VEC_CS          = [ csignals[opcode] for opcode in VEC_OPCODES ]
+
+def _field(f, default = 0):
+    return np.array([ default if dec is None else int(f(dec)) for dec in decode_table ], dtype=np.int64)
+
+_opid           = { opcode: k for (k, opcode) in enumerate(VEC_OPCODES) }
+
+VEC_OPID        = _field(lambda dec: _opid.get(dec[DC_OPCODE], -1) if dec[DC_CS] is not None else -1, -1)
+VEC_CLASS       = _field(lambda dec: dec[DC_CLASS])
+VEC_RS          = _field(lambda dec: dec[DC_RS])
+VEC_RT          = _field(lambda dec: dec[DC_RT])
+VEC_RD          = _field(lambda dec: dec[DC_RD])
+VEC_IMM_I       = _field(lambda dec: dec[DC_IMM_I])
+VEC_IMM_S       = _field(lambda dec: dec[DC_IMM_S])
+VEC_IMM_U       = _field(lambda dec: dec[DC_IMM_U])
+VEC_IMM_H       = _field(lambda dec: dec[DC_IMM_H])
+VEC_IMM_J       = _field(lambda dec: dec[DC_IMM_J])
+
+# ALU functions on int64 arrays of 16-bit values
+VEC_ALU = {
+    ALU_ADD     : lambda a, b: (a + b) & 0xffff,
+    ALU_SUB     : lambda a, b: (a - b) & 0xffff,
+    ALU_AND     : lambda a, b: a & b,
+    ALU_OR      : lambda a, b: a | b,
+    ALU_XOR     : lambda a, b: a ^ b,
+    ALU_SLT     : lambda a, b: ((a ^ 0x8000) < (b ^ 0x8000)).astype(np.int64),
+    ALU_SLTU    : lambda a, b: (a < b).astype(np.int64),
+    ALU_SLL     : lambda a, b: (a << (b & 0x1f)) & 0xffff,
+    ALU_SRA     : lambda a, b: (((a ^ 0x8000) - 0x8000) >> (b & 0x1f)) & 0xffff,
+    ALU_SRL     : lambda a, b: a >> (b & 0x1f),
+    ALU_COPY1   : lambda a, b: a + 0 * b,
+    ALU_COPY2   : lambda a, b: b + 0 * a,
+    ALU_X       : lambda a, b: 0 * a,
+}
+
+
+#--------------------------------------------------------------------------
+#   Lockstep: steps N single-cycle machines together
+#--------------------------------------------------------------------------
+
+class Lockstep(object):
+
+    STATS           = [ 'cycle', 'icount', 'inst_alu', 'inst_mem', 'inst_ctrl' ]
+
+    def __init__(self, cpus):
+        """
+        stacks the state of cpus (TSC__1_cycle instances, with the same
+        memory range) into NumPy arrays, one lane per cpu
+        """
+        self.cpus       = cpus
+        self.mem_start  = cpus[0].dmem.mem_start
+        self.mem_end    = cpus[0].dmem.mem_end
+        for cpu in cpus:
+            if cpu.dmem.mem_start != self.mem_start or cpu.dmem.mem_end != self.mem_end:
+                raise ValueError("all machines must have the same memory range")
+            if cpu.icache is not None or cpu.dcache is not None:
+                raise ValueError("machines with caches cannot run in lockstep")
+            if cpu.profile is not None:
+                raise ValueError("profiled machines cannot run in lockstep")
+
+        n               = len(cpus)
+        size            = self.mem_end - self.mem_start
+        self.reg        = np.array([ [ int(v) for v in cpu.rf.reg ] for cpu in cpus ], dtype=np.int64)
+        self.pc         = np.zeros(n, dtype=np.int64)
+        self.mem        = np.zeros((n, len(cpus[0].dmem.pages) << Memory.PAGE_SHIFT), dtype=np.uint16)
+        for (lane, cpu) in enumerate(cpus):
+            for (index, page) in enumerate(cpu.dmem.pages):
+                if page is not Memory.ZERO_PAGE:
+                    base = index << Memory.PAGE_SHIFT
+                    self.mem[lane, base:base + Memory.PAGE_SIZE] = np.frombuffer(page, dtype=np.uint16)
+        self.mem        = self.mem[:, :size]
+
+        self.status     = np.zeros(n, dtype=np.int64)
+        self.limit      = np.array([ sys.maxsize if cpu.max_cycles is None else cpu.max_cycles
+                                     for cpu in cpus ], dtype=np.int64)
+        self.max_time   = np.array([ np.inf if cpu.max_time is None else cpu.max_time
+                                     for cpu in cpus ], dtype=np.float64)
+        self.cycle      = np.array([ cpu.stat.cycle for cpu in cpus ], dtype=np.int64)
+        self.icount     = np.array([ cpu.stat.icount for cpu in cpus ], dtype=np.int64)
+        self.inst_alu   = np.array([ cpu.stat.inst_alu for cpu in cpus ], dtype=np.int64)
+        self.inst_mem   = np.array([ cpu.stat.inst_mem for cpu in cpus ], dtype=np.int64)
+        self.inst_ctrl  = np.array([ cpu.stat.inst_ctrl for cpu in cpus ], dtype=np.int64)
+
+        # Stationary loops, per lane (see Simple.loop_idle): the pc, stores
+        # and registers after the last backward transfer, and the counters
+        # at that point
+        self.idle       = np.array([ cpu.idle != IDLE_OFF for cpu in cpus ])
+        self.stores     = np.zeros(n, dtype=np.int64)
+        self.seen       = np.full((n, 2 + NUM_REGS), -1, dtype=np.int64)
+        self.since      = np.zeros((n, len(Lockstep.STATS)), dtype=np.int64)
+
+    def run(self, entry_point):
+        """
+        runs every lane until it stops, returns the status of each lane
+        """
+        self.pc[:] = int(entry_point) & 0xffff
+        timed = np.isfinite(self.max_time).any()
+        start = time.perf_counter()
+        while self.step():
+            # Lanes share the wall clock, but each one has its own budget
+            if timed:
+                late = (self.status == EXC_NONE) & (self.max_time <= time.perf_counter() - start)
+                self.status[late] = EXC_TIMEOUT
+        self.sync()
+        for (lane, cpu) in enumerate(self.cpus):
+            cpu.engine.finish(int(self.status[lane]))
+        return [ int(s) for s in self.status ]
+
+    def step(self):
+        """
+        executes one instruction in every running lane, returns the number
+        of lanes still running
+        """
+        status      = self.status
+        start       = self.mem_start
+        end         = self.mem_end
+
+        # Lanes which reached their cycle limit stop before the next fetch
+        lanes       = np.flatnonzero(status == EXC_NONE)
+        stop        = self.cycle[lanes] >= self.limit[lanes]
+        if stop.any():
+            status[lanes[stop]] = EXC_LIMIT
+            lanes   = lanes[~stop]
+        if lanes.size == 0:
+            return 0
+
+        # Faulting instructions still take a cycle
+        self.cycle[lanes]   += 1
+        self.icount[lanes]  += 1
+
+        # Instruction fetch
+        pc          = self.pc[lanes]
+        ok          = (pc >= start) & (pc < end)
+        if not ok.all():
+            status[lanes[~ok]] = EXC_IMEM_ERROR
+            lanes, pc = lanes[ok], pc[ok]
+        inst        = self.mem[lanes, pc - start].astype(np.int64)
+
+        # Instruction decode
+        opid        = VEC_OPID[inst]
+        ok          = opid >= 0
+        if not ok.all():
+            status[lanes[~ok]] = EXC_ILLEGAL_INST
+            lanes, pc, inst, opid = lanes[ok], pc[ok], inst[ok], opid[ok]
+
+        # Execute: lanes at the same opcode share their control signals
+        if opid.size and (opid == opid[0]).all():
+            groups  = [ (opid[0], slice(None)) ]
+        else:
+            groups  = [ (k, opid == k) for k in np.unique(opid) ]
+        for (k, sel) in groups:
+            cs      = VEC_CS[k]
+            w       = inst[sel]
+            cls     = VEC_CLASS[w[0]]
+            if cls == CL_ALU:
+                self.run_alu(cs, lanes[sel], pc[sel], w)
+            elif cls == CL_MEM:
+                self.run_mem(cs, lanes[sel], pc[sel], w)
+            else:
+                self.run_ctrl(cs, lanes[sel], pc[sel], w)
+
+        if self.idle.any():
+            self.idle_loops(lanes, pc)
+
+        return np.count_nonzero(status == EXC_NONE)
+
+    def counters(self, lanes):
+        return np.stack([ getattr(self, name)[lanes] for name in Lockstep.STATS ], axis=-1)
+
+    def idle_loops(self, lanes, pc):
+        """
+        looks for stationary loops in lanes, which just executed the
+        instructions at pc, and skips or stops them as Simple.idle_loop does
+        """
+        back        = (self.status[lanes] == EXC_NONE) & self.idle[lanes] & (self.pc[lanes] <= pc)
+        lanes       = lanes[back]
+        if lanes.size == 0:
+            return
+        key         = np.column_stack((self.pc[lanes], self.stores[lanes], self.reg[lanes]))
+        same        = (self.seen[lanes] == key).all(axis=1)
+        first       = lanes[~same]
+        self.seen[first]    = key[~same]
+        self.since[first]   = self.counters(first)
+
+        for lane in lanes[same]:
+            cpu     = self.cpus[lane]
+            period  = int(self.cycle[lane] - self.since[lane, 0])
+            if cpu.idle == IDLE_STOP or cpu.max_cycles is None:
+                self.status[lane] = EXC_IDLE
+                continue
+
+            # Skip the iterations which start before the limit
+            times   = (cpu.max_cycles - int(self.cycle[lane])) // period
+            if times > 0:
+                print("Idle loop at 0x%08x: skipped %d cycles" % (self.pc[lane], times * period))
+            for (k, name) in enumerate(Lockstep.STATS):
+                count = getattr(self, name)
+                count[lane] += (count[lane] - self.since[lane, k]) * times
+
+    def dest(self, cs, w):
+        dest        = cs[CS_DEST_SEL]
+        return VEC_RD[w]            if dest == DEST_RD   else \
+               VEC_RT[w]            if dest == DEST_RT   else \
+               2                    if dest == DEST_R2   else \
+               0
+
+    def run_alu(self, cs, lanes, pc, w):
+
+        self.inst_alu[lanes] += 1
+
+        reg         = self.reg
+        rs1_data    = reg[lanes, VEC_RS[w]]
+        op1         = cs[CS_OP1_SEL]
+        op2         = cs[CS_OP2_SEL]
+        alu1        = rs1_data                  if op1 == OP1_RS     else \
+                      pc                        if op1 == OP1_PC     else \
+                      0 * pc
+        alu2        = reg[lanes, VEC_RT[w]]     if op2 == OP2_RT     else \
+                      rs1_data                  if op2 == OP2_RS     else \
+                      VEC_IMM_I[w]              if op2 == OP2_IM     else \
+                      VEC_IMM_U[w]              if op2 == OP2_IL     else \
+                      VEC_IMM_H[w]              if op2 == OP2_IH     else \
+                      0 * pc + 0xffff           if op2 == OP2_N1     else \
+                      0 * pc + 1                if op2 == OP2_P1     else \
+                      0 * pc
+
+        reg[lanes, self.dest(cs, w)] = VEC_ALU[cs[CS_ALU_FUN]](alu1, alu2)
+        self.pc[lanes] = (pc + 1) & 0xffff
+
+    def run_mem(self, cs, lanes, pc, w):
+
+        self.inst_mem[lanes] += 1
+
+        reg         = self.reg
+        addr        = reg[lanes, VEC_RS[w]] + VEC_IMM_S[w]
+        ok          = (addr >= self.mem_start) & (addr < self.mem_end)
+        if not ok.all():
+            self.status[lanes[~ok]] = EXC_DMEM_ERROR
+            lanes, pc, w, addr = lanes[ok], pc[ok], w[ok], addr[ok]
+
+        offset      = addr - self.mem_start
+        rt          = VEC_RT[w]
+        if cs[CS_MEM_FCN] == M_XRD:
+            reg[lanes, rt] = self.mem[lanes, offset]
+        else:
+            self.mem[lanes, offset] = reg[lanes, rt]
+            self.stores[lanes] += 1
+        self.pc[lanes] = (pc + 1) & 0xffff
+
+    def run_ctrl(self, cs, lanes, pc, w):
+
+        self.inst_ctrl[lanes] += 1
+
+        # HLT leaves the pc at the HLT instruction
+        if cs[CS_HALT]:
+            self.status[lanes] = EXC_HALT
+            return
+
+        reg         = self.reg
+        rs1_data    = reg[lanes, VEC_RS[w]]
+        pc_plus1    = (pc + 1) & 0xffff
+        br_type     = cs[CS_BR_TYPE]
+        if br_type == BrJ_B:
+            alu_out = VEC_ALU[cs[CS_ALU_FUN]](rs1_data, reg[lanes, VEC_RT[w]])
+            flags   = (alu_out == 0) * 0b01 | ((alu_out & 0x8000) != 0) * 0b10
+            pc_next = np.where((flags & cs[CS_BR_MASK]) == cs[CS_BR_COND],
+                               (pc + 1 + VEC_IMM_I[w]) & 0xffff, pc_plus1)
+        elif br_type == BrJ_J:
+            pc_next = (pc & 0xf000) | VEC_IMM_J[w]
+        elif br_type == BrJ_I:
+            pc_next = rs1_data
+        else:
+            pc_next = pc_plus1
+
+        if cs[CS_RF_WEN]:
+            reg[lanes, self.dest(cs, w)] = pc_plus1 if cs[CS_WB_SEL] == WB_PC1 else 0
+        self.pc[lanes] = pc_next
+
+    def sync(self):
+        """
+        writes the lanes back to their machines
+        """
+        for (lane, cpu) in enumerate(self.cpus):
+            for i in range(NUM_REGS):
+                cpu.rf.write(i, int(self.reg[lane, i]))
+            cpu.pc.write(int(self.pc[lane]))
+
+            for (index, page) in enumerate(cpu.dmem.pages):
+                words = self.mem[lane, index << Memory.PAGE_SHIFT:(index + 1) << Memory.PAGE_SHIFT]
+                if page is not Memory.ZERO_PAGE or words.any():
+                    cpu.dmem.page(index)[:len(words)] = array('H', words.tobytes())
+
+            stat            = cpu.stat
+            stat.cycle      = int(self.cycle[lane])
+            stat.icount     = int(self.icount[lane])
+            stat.inst_alu   = int(self.inst_alu[lane])
+            stat.inst_mem   = int(self.inst_mem[lane])
+            stat.inst_ctrl  = int(self.inst_ctrl[lane])
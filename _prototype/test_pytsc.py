@@ -0,0 +1,242 @@
+#==========================================================================
+#
+#   The PyTSC Project
+#
+#   Regression tests (python3 -m pytest test_pytsc.py)
+#
+#==========================================================================
+
+import contextlib
+import glob
+import io
+import os
+import re
+import subprocess
+import sys
+
+from isa import *
+from run_batch import mem_digest
+from run_tsc import *
+from sim_vector import *
+
+
+#--------------------------------------------------------------------------
+#   Helpers
+#--------------------------------------------------------------------------
+
+HERE        = os.path.dirname(os.path.abspath(__file__))
+BENCHMARK   = os.path.join(HERE, 'benchmarks', 'bubble_sort.hex')
+BENCHMARKS  = sorted(glob.glob(os.path.join(HERE, 'benchmarks', '*.hex')))
+
+def load_words(cpu, words):
+    """
+    stores { address: word, ... } in the memory of cpu
+    """
+    for (addr, word) in words.items():
+        cpu.dmem.copy_to(addr, int(word).to_bytes(2, 'big'))
+
+
+def run_quietly(cpu, entry_point = 0):
+    cpu.log.level = 0
+    with contextlib.redirect_stdout(io.StringIO()):
+        return cpu.run(entry_point)
+
+
+def run_tsc(*args):
+    """
+    runs run_tsc.py with args, returns the instructions and cycles of its stats
+    """
+    out = subprocess.run([ sys.executable, os.path.join(HERE, 'run_tsc.py'), '-l', '0', *args ],
+                         capture_output=True, text=True, check=True).stdout
+    m = re.search(r'^(\d+) instructions executed in (\d+) cycles', out, re.M)
+    return (int(m.group(1)), int(m.group(2)))
+
+
+def load_image(cpu, filename):
+    with open(filename, 'rb') as f:
+        cpu.dmem.copy_to(0, f.read())
+    return cpu
+
+
+def state(cpu, status):
+    return (status, int(cpu.pc.read()), [ int(r) for r in cpu.rf.reg ],
+            cpu.stat.icount, cpu.stat.cycle)
+
+
+def full_state(cpu, status):
+    """
+    state, with the memory digest and every Stat counter
+    """
+    return (status, int(cpu.pc.read()), [ int(r) for r in cpu.rf.reg ], mem_digest(cpu.dmem),
+            { name: getattr(cpu.stat, name) for name in Snapshot.STATS })
+
+
+#--------------------------------------------------------------------------
+#   Engines: Fast, DBT and Lockstep are bit-identical to Simple
+#--------------------------------------------------------------------------
+
+def test_engines_on_benchmarks():
+    expected = []
+    for name in BENCHMARKS:
+        cpu = load_image(TSC__1_cycle(0, UMEM_SIZE, Simple), name)
+        expected.append(full_state(cpu, run_quietly(cpu)))
+    assert all(result[0] == EXC_HALT for result in expected)
+
+    for engine in (Fast, DBT):
+        for (name, result) in zip(BENCHMARKS, expected):
+            cpu = load_image(TSC__1_cycle(0, UMEM_SIZE, engine), name)
+            assert full_state(cpu, run_quietly(cpu)) == result, (engine.__name__, name)
+
+    cpus = [ load_image(TSC__1_cycle(0, UMEM_SIZE), name) for name in BENCHMARKS ]
+    with contextlib.redirect_stdout(io.StringIO()):
+        statuses = Lockstep(cpus).run(0)
+    assert [ full_state(cpu, status) for (cpu, status) in zip(cpus, statuses) ] == expected
+
+
+IDLE_PROGRAM = {
+    0x0000: ADI | 0 << 10 | 0 << 8 | 3,     # r0 = 3
+    0x0001: ADI | 0 << 10 | 0 << 8 | 0xff,  # r0 -= 1
+    0x0002: BNE | 0 << 10 | 1 << 8 | 0xfe,  # until r0 == r1
+    0x0003: JMP | 0x003,                    # then spins forever
+}
+
+def test_lockstep_idle_loops():
+    for (idle, max_cycles) in ((IDLE_SKIP, None), (IDLE_STOP, 1000), (IDLE_SKIP, 1000), (IDLE_OFF, 1000)):
+        cpus = [ TSC__1_cycle(0, UMEM_SIZE, Fast) for _ in range(2) ]
+        for cpu in cpus:
+            (cpu.idle, cpu.max_cycles) = (idle, max_cycles)
+            load_words(cpu, IDLE_PROGRAM)
+        expected = full_state(cpus[0], run_quietly(cpus[0]))
+        with contextlib.redirect_stdout(io.StringIO()):
+            (status,) = Lockstep(cpus[1:]).run(0)
+        assert full_state(cpus[1], status) == expected, (idle, max_cycles)
+        assert status == (EXC_LIMIT if idle != IDLE_STOP and max_cycles else EXC_IDLE)
+
+
+#--------------------------------------------------------------------------
+#   DBT: blocks which wrap around from 0xffff to 0x0000
+#--------------------------------------------------------------------------
+
+WRAP_PROGRAM = {
+    0x0000: JMP | 0x010,                # wraps into here from 0xffff
+    0x0010: LHI | 0 << 8 | 0xff,        # r0 = 0xfffe
+    0x0011: ORI | 0 << 10 | 0 << 8 | 0xfe,
+    0x0012: BGZ | 3 << 10 | 1,          # second time: patch the code
+    0x0013: JPR | 0 << 10,
+    0x0014: LWD | 0 << 10 | 1 << 8,     # stores into the block at 0xfffe
+    0x0015: SWD | 0 << 10 | 1 << 8,
+    0x0016: LHI | 1 << 8 | (HLT >> 8),  # and a HLT into its wrapped word
+    0x0017: ORI | 1 << 10 | 1 << 8 | (HLT & 0xff),
+    0x0018: SWD | 2 << 10 | 1 << 8,
+    0x0019: JPR | 0 << 10,
+    0xfffe: ADI | 3 << 10 | 3 << 8 | 1,
+    0xffff: ADI | 1 << 10 | 1 << 8 | 1,
+}
+
+def test_dbt_block_wrapping_around_memory():
+    results = []
+    for engine in (Simple, Fast, DBT):
+        cpu = TSC__1_cycle(0, UMEM_SIZE, engine)
+        cpu.max_cycles = 1000
+        load_words(cpu, WRAP_PROGRAM)
+        results.append(state(cpu, run_quietly(cpu)))
+    assert results[0][0] == EXC_HALT
+    assert results[1] == results[0]
+    assert results[2] == results[0]
+
+
+#--------------------------------------------------------------------------
+#   DBT: counted loops skipped in closed form match stepping them
+#--------------------------------------------------------------------------
+
+def counted_loop_program(start, step, branch):
+    """
+    r0 = start, then adds step to r0 while branch (on r0 and r1 = 0) is taken
+    """
+    return {
+        0x0000: LHI | 0 << 8 | (start >> 8),
+        0x0001: ORI | 0 << 10 | 0 << 8 | (start & 0xff),
+        0x0002: ADI | 0 << 10 | 0 << 8 | (step & 0xff),
+        0x0003: branch | 0 << 10 | 1 << 8 | 0xfe,   # back to 0x0002
+        0x0004: HLT,
+    }
+
+COUNTED_LOOPS = [
+    # (start, step, branch, max_cycles)
+    (1, 2, BNE, 100000),            # gap of one value, even step: never exits
+    (1, 3, BNE, None),              # odd step: wraps around to 0
+    (1000, -1, BGZ, None),          # negative steps
+    (1000, -7, BGZ, None),
+    (0xff00, 5, BLZ, None),
+    (30000, -1, BGZ, 10001),        # cut short by max_cycles
+    (1, 2, BNE, 20000),
+]
+
+def test_dbt_skip_loops():
+    for (start, step, branch, max_cycles) in COUNTED_LOOPS:
+        results = []
+        for (engine, skip_loops) in ((Fast, False), (DBT, True)):
+            cpu = TSC__1_cycle(0, UMEM_SIZE, engine)
+            (cpu.skip_loops, cpu.max_cycles) = (skip_loops, max_cycles)
+            load_words(cpu, counted_loop_program(start, step, branch))
+            results.append(full_state(cpu, run_quietly(cpu)))
+        assert cpu.engine.blocks[0x0002][7] is not None
+        assert results[1] == results[0], (start, step, max_cycles)
+        assert results[0][0] == (EXC_HALT if max_cycles is None else EXC_LIMIT)
+
+
+#--------------------------------------------------------------------------
+#   Self-modifying code: stores over instructions already in the pipeline
+#--------------------------------------------------------------------------
+
+ADD5        = ADI | 3 << 10 | 3 << 8 | 5            # ADI $3, $3, 5
+NOP         = ORI | 2 << 10 | 2 << 8                # ORI $2, $2, 0
+
+SMC_PROGRAM = {
+    0x0000: LHI | 1 << 8 | (ADD5 >> 8),
+    0x0001: ORI | 1 << 10 | 1 << 8 | (ADD5 & 0xff),
+    0x0002: SWD | 0 << 10 | 1 << 8 | 3,             # into the next word (IF/ID)
+    0x0003: NOP,
+    0x0004: SWD | 0 << 10 | 1 << 8 | 6,             # into the word after next (ID/EX)
+    0x0005: NOP,
+    0x0006: NOP,
+    0x0007: HLT,
+}
+
+def test_self_modifying_code():
+    machines = [ TSC__1_cycle(0, UMEM_SIZE, engine) for engine in (Simple, Fast, DBT) ]
+    machines.append(TSC__multi_cycle())
+    for forwarding in (True, False):
+        for predictor in PREDICTORS.values():
+            machines.append(TSC__pipe(0, UMEM_SIZE, forwarding, predictor(256)))
+    for cpu in machines:
+        load_words(cpu, SMC_PROGRAM)
+        assert run_quietly(cpu) == EXC_HALT
+        assert (int(cpu.pc.read()), cpu.stat.icount, int(cpu.rf.reg[3])) == (7, 8, 10)
+
+#--------------------------------------------------------------------------
+
+def test_resume_after_halt(tmp_path):
+    snapshot = str(tmp_path / 'halted.st')
+    for machine in ([ '-e', 'fast' ], [ '-m', 'M' ], [ '-m', 'P' ]):
+        full = run_tsc(*machine, '--save-state', snapshot, '--hex', BENCHMARK)
+        assert run_tsc(*machine, '--load-state', snapshot) == full
+
+
+#--------------------------------------------------------------------------
+#   Caches: every machine looks up the same instructions and data
+#--------------------------------------------------------------------------
+
+def cache_counts(cpu, config):
+    attach_caches(cpu, parse_cache(config))
+    run_quietly(load_image(cpu, BENCHMARK))
+    return [ (cache.hits, cache.misses, cache.evictions, cache.writebacks)
+             for cache in { id(cache): cache for cache in (cpu.icache, cpu.dcache) }.values() ]
+
+def test_pipe_cache_counts():
+    for config in ('U64-4-2', 'I64-4-2-D64-4-2'):
+        expected = cache_counts(TSC__1_cycle(0, UMEM_SIZE, Simple), config)
+        assert cache_counts(TSC__multi_cycle(), config) == expected
+        for predictor in ('nt', '2bit'):
+            cpu = TSC__pipe(predictor=PREDICTORS[predictor](256))
+            assert cache_counts(cpu, config) == expected